@@ -1,23 +1,26 @@
 import logging
-from typing import Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from azure.cosmos import ContainerProxy
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
 from azure.functions import HttpResponse, HttpRequest
 import bcrypt
-from cosmos import CosmosDB, query_by_key, query_by_sql
+from cosmos import CosmosDB, compile_projection, project, query_by_key, query_by_sql, query_page, upsert_item
 from entities import Chatbot, ChatbotStatus, User, UserRole
 from exceptions import BackendException, BackendExceptionCode
+from repository import get_chatbot, get_developer, update_chatbot
 import json
 
 # TODO: Edit backend commands
 
+MAX_PAGE_SIZE = 1000
+
 class BackendClient:
 
     @staticmethod
     async def _get_chatbots_by_sql(req: HttpRequest) -> HttpResponse:
         # SQL Query passed via request body
         try:
-            db = CosmosDB()
-            await db.initialize()
+            db = await CosmosDB.shared()
             query = req.get_json().get("query", "")
             if query:
                 results = await query_by_sql(container=db.chatbot_container, queryStr=query)
@@ -39,35 +42,44 @@ class BackendClient:
     @staticmethod
     async def _get_chatbots(req: HttpRequest) -> HttpResponse:
         # Parameters passed via REQUEST PARAMS (NOTE: NOT REQUEST ROUTE PARAMETERS)
+        # page_size/continuation are optional, without page_size every chatbot is returned at once
+        # fields (comma separated, e.g. fields=name,status) limits the properties returned, id is always included
+        # and fields a chatbot does not have are left out, whichever way the chatbots are looked up
         try:
-            db = CosmosDB()
-            await db.initialize()
+            db = await CosmosDB.shared()
             dev_id: str = req.params.get("developer_id", "")
             chatbot_id: str = req.params.get("chatbot_id", "")
+            page_size, continuation = BackendClient._get_paging_params(req)
+            fields = BackendClient._get_fields_param(req)
+            filter_params = [key for key in req.params if key not in ("page_size", "continuation", "fields")]
+            next_continuation = None
 
-            if len(req.params) == 0:
-                query = "SELECT * FROM c"
-                chatbots_result = await query_by_sql(container=db.chatbot_container, queryStr=query)
+            if len(filter_params) == 0:
+                chatbots_result, next_continuation = await BackendClient._list_chatbots(db.chatbot_container, page_size=page_size, continuation=continuation, fields=fields)
             elif dev_id:
-                query_result = await query_by_key(db.developer_container, key="id", val=dev_id)
-                the_user = query_result[0]
+                the_user = await get_developer(db.developer_container, dev_id)
+                if not the_user:
+                    raise BackendException(message=f"No developer found with id {dev_id}", method_name="_get_chatbots", error_code=BackendExceptionCode.NOT_FOUND)
                 logging.warning(json.dumps(the_user))
 
                 if the_user.get("role") == UserRole.ADMIN.value:
-                    query = "SELECT * FROM c"
-                    chatbots_result = await query_by_sql(container=db.chatbot_container, queryStr=query)
+                    chatbots_result, next_continuation = await BackendClient._list_chatbots(db.chatbot_container, page_size=page_size, continuation=continuation, fields=fields)
                 elif the_user.get("role") == UserRole.DEVELOPER.value:
-                    chatbots_result = await query_by_key(container=db.chatbot_container, key="developer_id", val=str(dev_id))
+                    chatbots_result, next_continuation = await BackendClient._list_chatbots(db.chatbot_container, developer_id=str(dev_id), page_size=page_size, continuation=continuation, fields=fields)
                 else:
                     chatbots_result = []
 
             elif chatbot_id:
-                chatbots_result = await query_by_key(container=db.chatbot_container, key="id", val=str(chatbot_id))
+                the_chatbot = await get_chatbot(db.chatbot_container, chatbot_id)
+                chatbots_result = [project(the_chatbot, fields)] if the_chatbot else []
             else:
                 raise BackendException(message=f"Invalid request parameters", method_name="_get_chatbots", error_code=BackendExceptionCode.FORBIDDEN) 
-            
+
+            response_body = {"chatbots": chatbots_result}
+            if page_size:
+                response_body["continuation"] = next_continuation
             return HttpResponse(
-                body=json.dumps({"chatbots": chatbots_result}),
+                body=json.dumps(response_body),
                 mimetype="application/json",
                 status_code=200
             )
@@ -86,27 +98,78 @@ class BackendClient:
                     status_code=400
                 )
 
+    @staticmethod
+    def _get_paging_params(req: HttpRequest) -> Tuple[Optional[int], Optional[str]]:
+        page_size = req.params.get("page_size", "")
+        continuation = req.params.get("continuation", "") or None
+        if not page_size:
+            if continuation:
+                raise BackendException(message=f"continuation requires page_size", method_name="_get_chatbots", field="continuation")
+            return None, None
+        if not page_size.isdigit() or not 0 < int(page_size) <= MAX_PAGE_SIZE:
+            raise BackendException(message=f"page_size must be between 1 and {MAX_PAGE_SIZE}", method_name="_get_chatbots", error_code=BackendExceptionCode.INVALID_FIELD, field="page_size")
+        return int(page_size), continuation
+
+    @staticmethod
+    def _get_fields_param(req: HttpRequest) -> Optional[List[str]]:
+        fields = [field.strip() for field in req.params.get("fields", "").split(",") if field.strip()]
+        if not fields:
+            return None
+        fields = list(dict.fromkeys(["id", *fields]))
+        try:
+            compile_projection(fields)
+        except ValueError as e:
+            raise BackendException(message=str(e), method_name="_get_chatbots", error_code=BackendExceptionCode.INVALID_FIELD, field="fields")
+        return fields
+
+    @staticmethod
+    async def _list_chatbots(chatbot_container: ContainerProxy, developer_id: Optional[str] = None, page_size: Optional[int] = None, continuation: Optional[str] = None, fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        if not page_size:
+            if developer_id:
+                return await query_by_key(container=chatbot_container, key="developer_id", val=developer_id, fields=fields), None
+            return await query_by_sql(container=chatbot_container, queryStr=f"SELECT {compile_projection(fields)} FROM c"), None
+
+        try:
+            if developer_id:
+                # developer_id is the partition key, so a developer's page stays in one partition
+                return await query_page(chatbot_container, where="c.developer_id = @developer_id", parameters=[dict(name="@developer_id", value=developer_id)], max_item_count=page_size, continuation=continuation, partition_key=developer_id, fields=fields)
+            return await query_page(chatbot_container, max_item_count=page_size, continuation=continuation, fields=fields)
+        except ValueError as e:
+            raise BackendException(message=str(e), method_name="_get_chatbots", error_code=BackendExceptionCode.INVALID_FIELD, field="continuation")
+
+    @staticmethod
+    async def _patch_chatbot(chatbot_container: ContainerProxy, chatbot_id: str, method_name: str, change: Callable[[Chatbot], None]) -> Chatbot:
+        '''
+        Runs change against the current chatbot and patches only the fields it touched (If-Match on _etag)
+        '''
+        def mutate(chatbot_json: Dict[str, Any]) -> Dict[str, Any]:
+            the_chatbot = Chatbot.from_dict(chatbot_json)
+            change(the_chatbot)
+            return the_chatbot.to_dict()
+
+        try:
+            response = await update_chatbot(chatbot_container, chatbot_id, mutate)
+        except CosmosAccessConditionFailedError:
+            raise BackendException(message=f"Chatbot {chatbot_id} is being modified concurrently, try again", method_name=method_name, error_code=BackendExceptionCode.DUPLICATE)
+        if not response:
+            raise BackendException(message=f"No chatbot found with id {chatbot_id}", method_name=method_name, error_code=BackendExceptionCode.NOT_FOUND)
+        return Chatbot.from_dict(response)
+
     @staticmethod
     async def _activate_chatbot(req: HttpRequest) -> HttpResponse:
-        db = CosmosDB()
-        await db.initialize()
+        db = await CosmosDB.shared()
         try:
             # Get chatbot_uuid
             chatbot_id = req.params.get("chatbot_id", "")
             if not chatbot_id:
                 raise BackendException(message=f"No chatbot id found in request parameters", method_name="_activate_chatbot")
             
-            # Get chatbot
-            the_chatbot_json = await query_by_key(container=db.chatbot_container, key="id", val=chatbot_id)
-            if not the_chatbot_json:
-                raise BackendException(message=f"No chatbot found with id {chatbot_id}", method_name="_activate_chatbot", error_code=BackendExceptionCode.NOT_FOUND)
-            
-            # Check status
-            the_chatbot = Chatbot.from_dict(the_chatbot_json[0])
+            # Patch the status, a no-op if the chatbot is already active
+            def set_active(the_chatbot: Chatbot) -> None:
+                if the_chatbot.status != ChatbotStatus.ACTIVE:
+                    the_chatbot.set_status(ChatbotStatus.ACTIVE)
 
-            if the_chatbot.status != 'active':
-                the_chatbot.set_status(ChatbotStatus.ACTIVE)
-                response = db.chatbot_container.upsert_item(body=the_chatbot.to_dict())
+            the_chatbot = await BackendClient._patch_chatbot(db.chatbot_container, chatbot_id, "_activate_chatbot", set_active)
             return HttpResponse(
                 body=json.dumps({"chatbot": the_chatbot.to_dict()}),
                 mimetype="text/plain",
@@ -130,25 +193,19 @@ class BackendClient:
 
     @staticmethod
     async def _deactivate_chatbot(req: HttpRequest) -> HttpResponse:
-        db = CosmosDB()
-        await db.initialize()
+        db = await CosmosDB.shared()
         try:
             # Get chatbot_uuid
             chatbot_id = req.params.get("chatbot_id", "")
             if not chatbot_id:
                 raise BackendException(message=f"No chatbot id found in request parameters", method_name="_deactivate_chatbot")
             
-            # Get chatbot
-            the_chatbot_json = await query_by_key(container=db.chatbot_container, key="id", val=chatbot_id)
-            if not the_chatbot_json:
-                raise BackendException(message=f"No chatbot found with id {chatbot_id}", method_name="_deactivate_chatbot", error_code=BackendExceptionCode.NOT_FOUND)
-            
-            # Check status
-            the_chatbot = Chatbot.from_dict(the_chatbot_json[0])
+            # Patch the status, a no-op if the chatbot is already inactive
+            def set_inactive(the_chatbot: Chatbot) -> None:
+                if the_chatbot.status != ChatbotStatus.INACTIVE:
+                    the_chatbot.set_status(ChatbotStatus.INACTIVE)
 
-            if the_chatbot.status != 'inactive':
-                the_chatbot.set_status(ChatbotStatus.INACTIVE)
-                response = db.chatbot_container.upsert_item(body=the_chatbot.to_dict())
+            the_chatbot = await BackendClient._patch_chatbot(db.chatbot_container, chatbot_id, "_deactivate_chatbot", set_inactive)
             return HttpResponse(
                 body=json.dumps({"chatbot": the_chatbot.to_dict()}),
                 mimetype="text/plain",
@@ -171,40 +228,43 @@ class BackendClient:
 
     @staticmethod
     async def _update_chatbot(req: HttpRequest) -> HttpResponse:
-        db = CosmosDB()
-        await db.initialize()
+        db = await CosmosDB.shared()
         try:
             # Get chatbot_uuid
             chatbot_id = req.params.get("chatbot_id", "")
             if not chatbot_id:
                 raise BackendException(message=f"No chatbot id found in request parameters", method_name="_update_chatbot")
-            # Get chatbot
-            the_chatbot_json = await query_by_key(container=db.chatbot_container, key="id", val=chatbot_id)
-            if not the_chatbot_json:
-                raise BackendException(message=f"No chatbot found with id {chatbot_id}", method_name="_update_chatbot", error_code=BackendExceptionCode.NOT_FOUND)
-            
-            # Check status
-            the_chatbot = Chatbot.from_dict(the_chatbot_json[0])
-
+            # Apply the requested changes, re-applied to the fresh document if someone else wrote first
             try:
-                if req.get_json().get("chatbot_name", ""):
-                    new_name = req.get_json().get("chatbot_name", "")
-                    the_chatbot.set_name(new_name=new_name)
-                if req.get_json().get("chatbot_desc", ""):
-                    the_chatbot.set_desc(req.get_json().get("chatbot_desc"))
-                if req.get_json().get("chatbot_status", ""):
-                    the_chatbot.set_status(ChatbotStatus(req.get_json().get("chatbot_status")))
-                if req.get_json().get("chatbot_version", ""):
-                    the_chatbot.set_version(req.get_json().get("chatbot_version"))
-                if isinstance(req.get_json().get("chatbot_telegram_support", ""), bool):
-                    the_chatbot.set_telegram_support(req.get_json().get("chatbot_telegram_support"))
-
-                if the_chatbot.validate_json():
-                    response = db.chatbot_container.upsert_item(body=the_chatbot.to_dict())
-                else:
-                    raise BackendException(message=f"Chatbot.to_dict() not json serialisable", method_name="_update_chatbot")
-            except Exception as e:
+                changes = req.get_json()
+            except ValueError as e:
                 raise BackendException(message=f"Invalid chatbot parameters,  {e}", method_name="_update_chatbot")
+
+            def apply_changes(the_chatbot: Chatbot) -> None:
+                try:
+                    if changes.get("chatbot_name", ""):
+                        the_chatbot.set_name(new_name=changes.get("chatbot_name", ""))
+                    if changes.get("chatbot_desc", ""):
+                        the_chatbot.set_desc(changes.get("chatbot_desc"))
+                    if changes.get("chatbot_status", ""):
+                        the_chatbot.set_status(ChatbotStatus(changes.get("chatbot_status")))
+                    if changes.get("chatbot_version", ""):
+                        the_chatbot.set_version(changes.get("chatbot_version"))
+                    if isinstance(changes.get("chatbot_telegram_support", ""), bool):
+                        the_chatbot.set_telegram_support(changes.get("chatbot_telegram_support"))
+                    if isinstance(changes.get("chatbot_stateful", ""), bool):
+                        the_chatbot.set_stateful(changes.get("chatbot_stateful"))
+                    if "chatbot_response_cache_ttl" in changes or "chatbot_response_cache_size" in changes:
+                        the_chatbot.set_response_cache(
+                            changes.get("chatbot_response_cache_ttl", the_chatbot.response_cache_ttl),
+                            changes.get("chatbot_response_cache_size")
+                        )
+                except Exception as e:
+                    raise BackendException(message=f"Invalid chatbot parameters,  {e}", method_name="_update_chatbot")
+                if not the_chatbot.validate_json():
+                    raise BackendException(message=f"Chatbot.to_dict() not json serialisable", method_name="_update_chatbot")
+
+            the_chatbot = await BackendClient._patch_chatbot(db.chatbot_container, chatbot_id, "_update_chatbot", apply_changes)
             
             return HttpResponse(
                 body=json.dumps({"chatbot": the_chatbot.to_dict()}),
@@ -228,12 +288,11 @@ class BackendClient:
         
     @staticmethod
     async def addDummyUser() -> HttpResponse:
-        db = CosmosDB()
-        await db.initialize()
+        db = await CosmosDB.shared()
         newDeveloperUser: User = User(id=None, full_name="Elunify Developer", email="developer@email.com", password="password", role=UserRole.DEVELOPER, selected_chatbot_id=None)
-        db._developer_container.upsert_item(body=newDeveloperUser.to_dict())
+        await upsert_item(db.developer_container, body=newDeveloperUser.to_dict())
         newAdminUser: User = User(id=None, full_name="Elunify Admin", email="admin@email.com", password="password", role=UserRole.ADMIN, selected_chatbot_id=None)
-        db._developer_container.upsert_item(body=newAdminUser.to_dict())
+        await upsert_item(db.developer_container, body=newAdminUser.to_dict())
         return HttpResponse(
         "Admin and developer dummy added",
         status_code=200
@@ -248,8 +307,7 @@ class BackendClient:
             password: str = req.get_json().get("password", "")
             logging.warning(email)
 
-            db = CosmosDB()
-            await db.initialize()
+            db = await CosmosDB.shared()
             
             if not email or not password:
                 return HttpResponse(
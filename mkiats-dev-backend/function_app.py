@@ -8,6 +8,8 @@ from backendClient import BackendClient
 from cosmos import CosmosDB, query_by_key, query_by_sql
 from entities import Chatbot, ChatbotStatus
 from exceptions import BackendException, BackendExceptionCode
+from metrics import operation_stats, track_invocation
+from repository import chatbot_cache
 import json
 # Instantiate function app
 load_dotenv()
@@ -21,45 +23,60 @@ def get_health_status(req: func.HttpRequest) -> func.HttpResponse:
             status_code=200
     )
 
+@app.route(route="cache/stats", auth_level=func.AuthLevel.ANONYMOUS)
+def get_cache_stats(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+            body=json.dumps({"chatbots": chatbot_cache.stats(), "cosmos": operation_stats()}),
+            mimetype="application/json",
+            status_code=200
+    )
+
 @app.route(route="addDummyUser", auth_level=func.AuthLevel.ANONYMOUS)
 async def addDummyUser(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('Python HTTP trigger function processed a request.')
     theClient = BackendClient()
-    return await theClient.addDummyUser()
+    with track_invocation("backend.addDummyUser"):
+        return await theClient.addDummyUser()
 
 
 @app.route(route="login", auth_level=func.AuthLevel.ANONYMOUS)
 async def login(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('Python HTTP trigger function processed a request.')
     theClient = BackendClient()
-    return await theClient.login(req)
+    with track_invocation("backend.login"):
+        return await theClient.login(req)
 
 @app.route(route="chatbots/search", auth_level=func.AuthLevel.ANONYMOUS)
 async def search_chatbots(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('Python HTTP trigger function processed a request.')
     theClient = BackendClient()
-    return await theClient._get_chatbots_by_sql(req)
+    with track_invocation("backend.chatbots/search"):
+        return await theClient._get_chatbots_by_sql(req)
 
 @app.route(route="chatbots", auth_level=func.AuthLevel.ANONYMOUS)
 async def get_chatbots(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('Python HTTP trigger function processed a request.')
     theClient = BackendClient()
-    return await theClient._get_chatbots(req)
+    with track_invocation("backend.chatbots"):
+        return await theClient._get_chatbots(req)
 
 @app.route(route="chatbots/activate", auth_level=func.AuthLevel.ANONYMOUS)
 async def activate_chatbot(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('activate_chatbot executed...')
     theClient = BackendClient()
-    return await theClient._activate_chatbot(req)
+    with track_invocation("backend.chatbots/activate"):
+        return await theClient._activate_chatbot(req)
 
 @app.route(route="chatbots/deactivate", auth_level=func.AuthLevel.ANONYMOUS)
 async def deactivate_chatbot(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('deactivate_chatbot executed...')
     theClient = BackendClient()
-    return await theClient._deactivate_chatbot(req)
+    with track_invocation("backend.chatbots/deactivate"):
+        return await theClient._deactivate_chatbot(req)
 
 @app.route(route="chatbots/update", auth_level=func.AuthLevel.ANONYMOUS)
 async def update_chatbot(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('update_chatbot executed...')
     theClient = BackendClient()
-    return await theClient._update_chatbot(req)
+    with track_invocation("backend.chatbots/update"):
+        return await theClient._update_chatbot(req)
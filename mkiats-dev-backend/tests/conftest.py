@@ -0,0 +1,9 @@
+'''
+Tests run against the in-memory Cosmos backend (cosmosMemory), nothing leaves the process.
+Run from mkiats-dev-backend: python -m pytest tests
+'''
+import os
+import sys
+
+os.environ.setdefault("COSMOS_DB_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
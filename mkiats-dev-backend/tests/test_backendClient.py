@@ -0,0 +1,36 @@
+from azure.functions import HttpRequest
+from backendClient import BackendClient
+from cosmos import CosmosDB, upsert_item
+from entities import Chatbot, User, UserRole
+import asyncio
+import json
+
+
+def _get_chatbots(**params):
+    request = HttpRequest(method="GET", url="/api/chatbots", params=params, body=b"")
+    response = asyncio.run(BackendClient._get_chatbots(request))
+    assert response.status_code == 200, response.get_body()
+    return json.loads(response.get_body())["chatbots"]
+
+
+def test_fields_give_the_same_keys_on_every_lookup_path():
+    async def seed():
+        db = await CosmosDB.shared()
+        await upsert_item(db.developer_container, body=User(id="dev-fields", full_name="Fields Developer", email="fields@example.com", password="password123", role=UserRole.DEVELOPER).to_dict())
+        for index in range(3):
+            chatbot = Chatbot(id=f"fields-bot-{index}", name=f"fields {index}", endpoint="https://example.com/chat/query", developer_id="dev-fields")
+            await upsert_item(db.chatbot_container, body=chatbot.to_dict())
+    asyncio.run(seed())
+
+    fields = "name,no_such_field"
+    results = {
+        "all": _get_chatbots(fields=fields),
+        "all paged": _get_chatbots(fields=fields, page_size="2"),
+        "developer": _get_chatbots(fields=fields, developer_id="dev-fields"),
+        "developer paged": _get_chatbots(fields=fields, developer_id="dev-fields", page_size="2"),
+        "chatbot": _get_chatbots(fields=fields, chatbot_id="fields-bot-1")
+    }
+    for path, chatbots in results.items():
+        assert chatbots, path
+        for chatbot in chatbots:
+            assert set(chatbot) == {"id", "name"}, path
@@ -0,0 +1,53 @@
+from azure.functions import HttpRequest
+from backendClient import BackendClient
+from cosmos import CosmosDB, upsert_item
+from entities import Chatbot
+from exceptions import EntityException, EntityExceptionCode
+import asyncio
+import json
+import pytest
+
+ENDPOINT = "https://example.com/chat/query"
+INVALID_VALUES = {
+    "stateful": "yes",
+    "response_cache_ttl": -1,
+    "response_cache_size": "large"
+}
+
+
+@pytest.mark.parametrize("field", sorted(INVALID_VALUES))
+def test_invalid_value_is_an_invalid_field_error(field):
+    chatbot = Chatbot(name="invalid", endpoint=ENDPOINT, **{field: INVALID_VALUES[field]})
+    with pytest.raises(EntityException) as raised:
+        chatbot.validate()
+    assert raised.value.error_code == EntityExceptionCode.INVALID_FIELD
+    assert raised.value.field == field
+    assert raised.value.to_dict()["field"] == field
+
+
+@pytest.mark.parametrize("field", sorted(INVALID_VALUES))
+def test_invalid_value_is_refused_by_the_setters(field):
+    chatbot = Chatbot(name="valid", endpoint=ENDPOINT)
+    with pytest.raises(EntityException) as raised:
+        if field == "stateful":
+            chatbot.set_stateful(INVALID_VALUES[field])
+        elif field == "response_cache_ttl":
+            chatbot.set_response_cache(INVALID_VALUES[field])
+        else:
+            chatbot.set_response_cache(60, INVALID_VALUES[field])
+    assert raised.value.error_code == EntityExceptionCode.INVALID_FIELD
+    assert raised.value.field == field
+
+
+@pytest.mark.parametrize("change", [{"chatbot_response_cache_ttl": -1}, {"chatbot_response_cache_size": "large"}])
+def test_update_with_an_invalid_value_is_a_client_error(change):
+    async def scenario():
+        db = await CosmosDB.shared()
+        chatbot = Chatbot(id="entity-bot", name="entity", endpoint=ENDPOINT, developer_id="dev-entities")
+        await upsert_item(db.chatbot_container, body=chatbot.to_dict())
+        request = HttpRequest(method="PUT", url="/api/chatbot", params={"chatbot_id": "entity-bot"}, body=json.dumps(change).encode())
+        return await BackendClient._update_chatbot(request)
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 400
+    assert "response_cache" in response.get_body().decode()
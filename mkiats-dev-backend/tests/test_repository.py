@@ -0,0 +1,25 @@
+from cosmos import CosmosDB, upsert_item
+from entities import Chatbot
+import asyncio
+import repository
+
+
+def test_concurrent_updates_to_one_chatbot_all_land():
+    writers = 8
+
+    async def scenario():
+        db = await CosmosDB.shared()
+        chatbot = Chatbot(id="contended-bot", name="contended", endpoint="https://example.com/chat/query", developer_id="dev-1")
+        await upsert_item(db.chatbot_container, body=chatbot.to_dict())
+
+        def add_tag(index):
+            def mutate(document):
+                document["tags"] = sorted(set(document.get("tags") or []) | {f"tag-{index}"})
+                return document
+            return mutate
+
+        await asyncio.gather(*(repository.update_chatbot(db.chatbot_container, "contended-bot", add_tag(index)) for index in range(writers)))
+        updated = await repository.get_chatbot(db.chatbot_container, "contended-bot", use_cache=False)
+        assert len(updated["tags"]) == writers
+
+    asyncio.run(scenario())
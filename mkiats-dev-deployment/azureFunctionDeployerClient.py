@@ -6,7 +6,7 @@ from azure.mgmt.storage import StorageManagementClient
 from typing import Dict, Any, List, Optional, Tuple
 from exceptions import DeploymentException
 from entities import Chatbot, ChatbotStatus
-from cosmos import CosmosDB
+from cosmos import CosmosDB, upsert_item
 import azure.functions as func
 import requests
 import copy
@@ -21,6 +21,65 @@ import base64
 import ast
 import uuid
 
+STREAMING_REQUIREMENT = "azurefunctions-extensions-http-fastapi"
+
+# function_app.py for chatbots that define main_stream. HTTP streams need the FastAPI request/response
+# types on every route, so chat/query is served through them as well (same JSON body as before).
+# chat/query/stream answers with the chunks main_stream yields as a chunked text/plain body.
+STREAMING_FUNCTION_APP_CONTENT = '''
+import azure.functions as func
+from azurefunctions.extensions.http.fastapi import JSONResponse, Request, StreamingResponse
+from chatbot import main, main_stream
+import logging
+
+app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+
+
+async def _read_query(req: Request):
+    try:
+        request_body = await req.json()
+    except ValueError:
+        return None, JSONResponse({"error": "Invalid JSON in request body"}, status_code=400)
+    if not request_body or 'query' not in request_body:
+        return None, JSONResponse({"error": "Missing 'query' in request body"}, status_code=400)
+    return str(request_body.get('query')), None
+
+
+@app.route(route="chat/query", auth_level=func.AuthLevel.ANONYMOUS)
+async def get_chatbot_response(req: Request) -> JSONResponse:
+    logging.info('Processing get_chatbot_response')
+    query, error = await _read_query(req)
+    if error:
+        return error
+    try:
+        response_body = await main(query)
+        return JSONResponse(response_body)
+    except Exception as e:
+        logging.error(f"Unexpected error: {str(e)}")
+        return JSONResponse({"error": "Unknown error from processing get_chatbot_response"}, status_code=500)
+
+
+@app.route(route="chat/query/stream", auth_level=func.AuthLevel.ANONYMOUS)
+async def stream_chatbot_response(req: Request) -> StreamingResponse:
+    logging.info('Processing stream_chatbot_response')
+    query, error = await _read_query(req)
+    if error:
+        return error
+
+    async def chunks():
+        try:
+            async for chunk in main_stream(query):
+                if chunk:
+                    yield str(chunk)
+        except Exception as e:
+            # Headers are already sent: re-raise so the connection is aborted instead of the chunked body
+            # being ended, the forwarder must not mistake a crashed answer for a complete one
+            logging.error(f"Unexpected error while streaming: {str(e)}")
+            raise
+
+    return StreamingResponse(chunks(), media_type="text/plain; charset=utf-8")
+'''
+
 
 class AzureFunctionDeployerClient:
     def __init__(self):
@@ -32,6 +91,7 @@ class AzureFunctionDeployerClient:
         self.description = "Some description"
         self.developer_id = "123123123"
         self.telegram_support = True
+        self.streaming_support = False
         self.deployment_type = None
         self.subscription_id = None
         self.resource_group_name = None
@@ -259,6 +319,18 @@ class AzureFunctionDeployerClient:
                 if not main_function_found:
                     raise DeploymentException(message="main function not found in chatbot.py", deployment_stage="ValidateZipFolder")
 
+                # Optional streaming entry point, an async generator main_stream(query: str) yielding str chunks
+                self.streaming_support = False
+                for node in ast.walk(tree):
+                    if isinstance(node, ast.AsyncFunctionDef) and node.name == 'main_stream':
+                        if len(node.args.args) != 1:
+                            raise DeploymentException(message="main_stream function must have exactly one parameter", deployment_stage="ValidateZipFolder")
+                        if not any(isinstance(child, ast.Yield) for child in ast.walk(node)):
+                            raise DeploymentException(message="main_stream function must yield its response chunks", deployment_stage="ValidateZipFolder")
+                        self.streaming_support = True
+                        logging.warning(f"main_stream found, chat/query/stream will be deployed")
+                        break
+
             except SyntaxError:
                 raise DeploymentException(message="Invalid Python syntax in chatbot.py", deployment_stage="ValidateZipFolder")
             
@@ -355,6 +427,9 @@ async def get_chatbot_response(req: func.HttpRequest) -> func.HttpResponse:
         )
 '''
             
+            if self.streaming_support:
+                function_app_content = STREAMING_FUNCTION_APP_CONTENT
+
             azure_data['files'][f'{root_directory}/function_app.py'] = {
                 'is_binary': False,
                 'mime_type': 'text/x-python',
@@ -377,6 +452,13 @@ pypdf
                     'mime_type': 'text/plain',
                     'content': requirements_content.strip()
                 }
+
+            # HTTP streaming needs the FastAPI extension in the chatbot's own environment
+            if self.streaming_support:
+                requirements_file = azure_data['files'][f'{root_directory}/requirements.txt']
+                requirements = requirements_file['content'].splitlines()
+                if not any(line.strip().startswith(STREAMING_REQUIREMENT) for line in requirements):
+                    requirements_file['content'] = "\n".join([*requirements, STREAMING_REQUIREMENT])
             
             # Add .funcignore if it doesn't exist
             funcignore_content = '''
@@ -620,7 +702,13 @@ test
                                 #     "name": "WEBSITE_RUN_FROM_PACKAGE",
                                 #     "value": "1"
                                 # }
-                            ]
+                            ] + ([
+                                # HTTP streams are only available with init indexing
+                                {
+                                    "name": "PYTHON_ENABLE_INIT_INDEXING",
+                                    "value": "1"
+                                }
+                            ] if self.streaming_support else [])
                         }
                     }
                 }
@@ -719,6 +807,7 @@ test
                 status=self.status,
                 developer_id=self.developer_id,
                 telegram_support=self.telegram_support,
+                streaming_support=self.streaming_support,
                 deployment_resource={
                     'deployment_type': self.deployment_type,
                     'resource_group_name': self.resource_group_name,
@@ -729,9 +818,8 @@ test
                 }
             )
             newChatbot.validate()
-            db = CosmosDB()
-            await db.initialize()
-            db.chatbot_container.upsert_item(body=newChatbot.to_dict())
+            db = await CosmosDB.shared()
+            await upsert_item(db.chatbot_container, body=newChatbot.to_dict())
             logging.warning(f"New chatbot registered in cosmos")
         except Exception as e:
             raise DeploymentException(message=f"Unknown error {e}", deployment_stage="RegisterNewChatbot")
@@ -1,49 +1,206 @@
 import logging
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient, ContainerProxy, PartitionKey
-from azure.cosmos.exceptions import CosmosHttpResponseError
-from typing import List, Dict, Any
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosHttpResponseError, CosmosResourceExistsError, CosmosResourceNotFoundError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from metrics import CosmosCall, record
+from typing import AsyncIterator, Callable, List, Dict, Any, Optional, Tuple
+import asyncio
+import base64
+import contextvars
+import functools
+import inspect
+import json
 import os
+import re
+import time
+
+# container id -> (database id, partition key path, default ttl in seconds)
+# A default ttl of -1 enables expiry without a container-wide limit, items then expire by their own "ttl"
+CONTAINER_SPECS: Dict[str, Tuple[str, str, Optional[int]]] = {
+    "users": ("UserDB", "/partition", None),
+    "developers": ("UserDB", "/partition", None),
+    "chatbots": ("ChatbotDB", "/developer_id", None),
+    # Short-lived coordination documents (chat leases, processed update ids), each expires by its own ttl
+    "leases": ("UserDB", "/id", -1),
+}
+
+# Projected field names are spliced into the query text, so only plain property names are accepted
+_FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Cosmos rejects patch requests with more operations than this
+PATCH_MAX_OPERATIONS = 10
+
+# The sync SDK blocks, so every data-plane call runs on this bounded pool instead of the event loop
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("COSMOS_DB_MAX_WORKERS", "16")),
+            thread_name_prefix="cosmos"
+        )
+    return _executor
+
+
+async def _run_blocking(func: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def _measured(operation: str, func: Callable[[CosmosCall], Any]) -> Any:
+    '''
+    Run func(response_hook) on the executor and record its RU charge, server duration, item count
+    and client latency under the operation name (see metrics)
+    '''
+    call = CosmosCall()
+    started = time.perf_counter()
+    try:
+        result = await _run_blocking(func, call)
+    except (CosmosResourceNotFoundError, CosmosResourceExistsError, CosmosAccessConditionFailedError):
+        # 404/409/412 are expected outcomes of point reads and conditional writes, not failures
+        record(operation, call, (time.perf_counter() - started) * 1000)
+        raise
+    except Exception:
+        record(operation, call, (time.perf_counter() - started) * 1000, error=True)
+        raise
+    record(operation, call, (time.perf_counter() - started) * 1000)
+    return result
+
+
+def use_memory_backend() -> bool:
+    return os.getenv("COSMOS_DB_BACKEND", "cosmos").lower() == "memory"
+
 
 class CosmosDB:
+    '''
+    Worker-lifetime Cosmos handle. Use `await CosmosDB.shared()` from request handlers,
+    container handles are resolved locally on first use and reused afterwards.
+    Database/container creation only happens in `provision()`.
+    COSMOS_DB_BACKEND=memory swaps the account for the in-memory stand-in in cosmosMemory (always provisioned).
+    '''
+    _shared: Optional['CosmosDB'] = None
+    _shared_lock = asyncio.Lock()
+
     def __init__(self):
-        self._client = CosmosClient.from_connection_string(os.getenv("COSMOS_DB_CONNECTION_STRING"))
-        self._user_container = None
-        self._chatbot_container = None
-
-    async def initialize(self):
-        user_db = self._client.create_database_if_not_exists("UserDB")
-        chatbot_db = self._client.create_database_if_not_exists("ChatbotDB")
-        
-        self._user_container = user_db.create_container_if_not_exists(
-            id="users",
-            partition_key=PartitionKey(path="/partition")
-        )
-        self._chatbot_container = chatbot_db.create_container_if_not_exists(
-            id="chatbots", 
-            partition_key=PartitionKey(path="/developer_id")
-        )
+        if use_memory_backend():
+            from cosmosMemory import MemoryCosmosClient
+            self._client = MemoryCosmosClient.from_environment()
+        else:
+            self._client = CosmosClient.from_connection_string(os.getenv("COSMOS_DB_CONNECTION_STRING"))
+        self._containers: Dict[str, ContainerProxy] = {}
+        self._available: Dict[str, bool] = {}
+
+    @classmethod
+    async def shared(cls) -> 'CosmosDB':
+        if cls._shared is None:
+            async with cls._shared_lock:
+                if cls._shared is None:
+                    db = await _run_blocking(cls)
+                    await db.initialize(provision=use_memory_backend() or os.getenv("COSMOS_DB_PROVISION", "false").lower() == "true")
+                    cls._shared = db
+        return cls._shared
+
+    async def initialize(self, provision: bool = False):
+        if provision:
+            await self.provision()
+
+    async def provision(self):
+        '''
+        Create databases and containers if they do not exist (control plane, keep off the request path)
+        '''
+        databases = {}
+        for container_id, (database_id, partition_key_path, default_ttl) in CONTAINER_SPECS.items():
+            if database_id not in databases:
+                databases[database_id] = await _run_blocking(self._client.create_database_if_not_exists, database_id)
+            options = {"default_ttl": default_ttl} if default_ttl is not None else {}
+            self._containers[container_id] = await _run_blocking(
+                databases[database_id].create_container_if_not_exists,
+                id=container_id,
+                partition_key=PartitionKey(path=partition_key_path),
+                **options
+            )
+            self._available[container_id] = True
+        logging.warning(f"Cosmos DB provisioned: {', '.join(CONTAINER_SPECS)}")
+
+    async def has_container(self, container_id: str) -> bool:
+        '''
+        Whether a container exists in the account, read once per worker. For containers added after a
+        deployment was provisioned ("leases"), so callers can fall back instead of failing every request.
+        '''
+        if container_id not in self._available:
+            try:
+                await _measured(f"{container_id}.read_container", lambda hook: self.container(container_id).read(response_hook=hook))
+                self._available[container_id] = True
+            except CosmosResourceNotFoundError:
+                logging.warning(f"Cosmos container {container_id} does not exist, run once with COSMOS_DB_PROVISION=true to create it")
+                self._available[container_id] = False
+        return self._available[container_id]
+
+    def container(self, container_id: str) -> ContainerProxy:
+        if container_id not in self._containers:
+            database_id = CONTAINER_SPECS[container_id][0]
+            self._containers[container_id] = self._client.get_database_client(database_id).get_container_client(container_id)
+        return self._containers[container_id]
 
     @property
     def user_container(self) -> ContainerProxy:
-        return self._user_container
+        return self.container("users")
 
-    @property 
+    @property
+    def developer_container(self) -> ContainerProxy:
+        return self.container("developers")
+
+    @property
     def chatbot_container(self) -> ContainerProxy:
-        return self._chatbot_container
+        return self.container("chatbots")
+
+    @property
+    def lease_container(self) -> ContainerProxy:
+        return self.container("leases")
+
 
+def compile_projection(fields: Optional[List[str]] = None, required: Tuple[str, ...] = ()) -> str:
+    '''
+    Turn a field list into a SELECT list, e.g. ["id", "name"] -> "c.id, c.name". No fields selects everything
+    '''
+    if not fields:
+        return "*"
+    projected = list(dict.fromkeys([*required, *fields]))
+    for field in projected:
+        if not _FIELD_PATTERN.match(field):
+            raise ValueError(f"Invalid field name: {field}")
+    return ", ".join(f"c.{field}" for field in projected)
 
-async def query_by_key(container: ContainerProxy, key: str, val: str) -> List[Dict[str, Any]]:
+
+def project(document: Dict[str, Any], fields: Optional[List[str]] = None, required: Tuple[str, ...] = ()) -> Dict[str, Any]:
+    '''
+    The same projection for a document already in hand (e.g. from a cache), fields the document lacks are left out
+    '''
+    if not fields:
+        return document
+    return {field: document[field] for field in dict.fromkeys([*required, *fields]) if field in document}
+
+
+async def query_by_key(container: ContainerProxy, key: str, val: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    '''
+    Retrieve by key id
+    '''
     try:
-        query = f"SELECT * FROM c WHERE c.{key} = @{key}"
+        query = f"SELECT {compile_projection(fields)} FROM c WHERE c.{key} = @{key}"
         params = [dict(name=f"@{key}", value=str(val))]
-        
-        items = list(container.query_items(
+
+        items = await _measured(f"{container.id}.query_by_key.{key}", lambda hook: list(container.query_items(
             query=query,
             parameters=params,
-            enable_cross_partition_query=True
-        ))
+            enable_cross_partition_query=True,
+            response_hook=hook
+        )))
         return items
-        
+
     except CosmosHttpResponseError as e:
         logging.error(f"Cosmos DB query error: {str(e)}")
         raise
@@ -52,16 +209,256 @@ async def query_by_key(container: ContainerProxy, key: str, val: str) -> List[Di
         raise
 
 async def query_by_sql(container: ContainerProxy, queryStr: str) -> List[Dict[str, Any]]:
+    '''
+    Retrueve by SQL
+    '''
     try:
-        results = list(container.query_items(
-            query=queryStr,             
-            enable_cross_partition_query=True
-        )
-    )
+        results = await _measured(f"{container.id}.query_by_sql", lambda hook: list(container.query_items(
+            query=queryStr,
+            enable_cross_partition_query=True,
+            response_hook=hook
+        )))
         return results
     except CosmosHttpResponseError as e:
         logging.error(f"Cosmos DB query error: {str(e)}")
         raise
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def _encode_continuation(last_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": last_id}).encode("utf-8")).decode("utf-8")
+
+
+def _decode_continuation(continuation: str) -> str:
+    try:
+        return json.loads(base64.urlsafe_b64decode(continuation.encode("utf-8")))["after"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid continuation token")
+
+
+async def query_page(
+    container: ContainerProxy,
+    where: str = "",
+    parameters: Optional[List[Dict[str, Any]]] = None,
+    max_item_count: int = 100,
+    continuation: Optional[str] = None,
+    partition_key: Optional[Any] = None,
+    fields: Optional[List[str]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''
+    Retrieve one page ordered by id, plus an opaque continuation token (None on the last page).
+    Pages are keyed on the last id seen rather than the SDK continuation, so they stay valid
+    across partitions and across workers.
+    '''
+    try:
+        conditions = [f"({where})"] if where else []
+        params = list(parameters or [])
+        if continuation:
+            conditions.append("c.id > @__after")
+            params.append(dict(name="@__after", value=_decode_continuation(continuation)))
+        params.append(dict(name="@__limit", value=max_item_count + 1))
+        # id is always projected, the continuation is keyed on it
+        query = f"SELECT TOP @__limit {compile_projection(fields, required=('id',))} FROM c" + (f" WHERE {' AND '.join(conditions)}" if conditions else "") + " ORDER BY c.id"
+
+        items = await _measured(f"{container.id}.query_page", lambda hook: list(container.query_items(
+            query=query,
+            parameters=params,
+            partition_key=partition_key,
+            enable_cross_partition_query=partition_key is None,
+            response_hook=hook
+        )))
+        if len(items) <= max_item_count:
+            return items, None
+        items = items[:max_item_count]
+        return items, _encode_continuation(items[-1]["id"])
+
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB query error: {str(e)}")
+        raise
+
+async def stream_query(
+    container: ContainerProxy,
+    where: str = "",
+    parameters: Optional[List[Dict[str, Any]]] = None,
+    page_size: int = 100,
+    partition_key: Optional[Any] = None,
+    fields: Optional[List[str]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    '''
+    Stream every matching item, holding at most one page in memory
+    '''
+    continuation = None
+    while True:
+        items, continuation = await query_page(container, where, parameters, page_size, continuation, partition_key, fields)
+        for item in items:
+            yield item
+        if not continuation:
+            return
+
+async def read_item(container: ContainerProxy, item_id: str, partition_key: Any) -> Optional[Dict[str, Any]]:
+    '''
+    Point read by id and partition key, None if the item does not exist
+    '''
+    try:
+        return await _measured(f"{container.id}.read_item", lambda hook: container.read_item(item=item_id, partition_key=partition_key, response_hook=hook))
+    except CosmosResourceNotFoundError:
+        return None
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB read error: {str(e)}")
+        raise
+
+async def upsert_item(container: ContainerProxy, body: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Upsert a full document
+    '''
+    try:
+        return await _measured(f"{container.id}.upsert_item", lambda hook: container.upsert_item(body=body, response_hook=hook))
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB upsert error: {str(e)}")
+        raise
+
+async def create_item(container: ContainerProxy, body: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Create a document, raises CosmosResourceExistsError if the id is already taken in its partition
+    '''
+    try:
+        return await _measured(f"{container.id}.create_item", lambda hook: container.create_item(body=body, response_hook=hook))
+    except CosmosResourceExistsError:
+        raise
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB create error: {str(e)}")
+        raise
+
+def _if_match(etag: Optional[str]) -> Dict[str, Any]:
+    if not etag:
+        return {}
+    return {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+
+async def patch_item(
+    container: ContainerProxy,
+    item_id: str,
+    partition_key: Any,
+    operations: List[Dict[str, Any]],
+    etag: Optional[str] = None
+) -> Dict[str, Any]:
+    '''
+    Partial update. With an etag the patch only applies if the document is unchanged (If-Match),
+    otherwise CosmosAccessConditionFailedError is raised for the caller to re-read and retry
+    '''
+    try:
+        return await _measured(f"{container.id}.patch_item", lambda hook: container.patch_item(
+            item=item_id,
+            partition_key=partition_key,
+            patch_operations=operations,
+            response_hook=hook,
+            **_if_match(etag)
+        ))
+    except CosmosAccessConditionFailedError:
+        raise
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB patch error: {str(e)}")
+        raise
+
+async def replace_item(container: ContainerProxy, body: Dict[str, Any], etag: Optional[str] = None) -> Dict[str, Any]:
+    '''
+    Replace a full document, guarded by etag like patch_item. Raises CosmosResourceNotFoundError if it does not exist
+    '''
+    try:
+        return await _measured(f"{container.id}.replace_item", lambda hook: container.replace_item(item=body["id"], body=body, response_hook=hook, **_if_match(etag)))
+    except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+        raise
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB replace error: {str(e)}")
+        raise
+
+async def delete_item(container: ContainerProxy, item_id: str, partition_key: Any, etag: Optional[str] = None) -> None:
+    '''
+    Delete a document, guarded by etag like patch_item. Raises CosmosResourceNotFoundError if it is already gone
+    '''
+    try:
+        await _measured(f"{container.id}.delete_item", lambda hook: container.delete_item(item=item_id, partition_key=partition_key, response_hook=hook, **_if_match(etag)))
+    except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+        raise
+    except CosmosHttpResponseError as e:
+        logging.error(f"Cosmos DB delete error: {str(e)}")
+        raise
+
+def diff_operations(before: Dict[str, Any], after: Dict[str, Any]) -> List[Dict[str, Any]]:
+    '''
+    Patch "set" operations for the top-level fields that differ between two versions of a document.
+    System properties (_etag, _ts, ...) and id are never patched.
+    '''
+    return [
+        {"op": "set", "path": f"/{key}", "value": value}
+        for key, value in after.items()
+        if key != "id" and not key.startswith("_") and (key not in before or before[key] != value)
+    ]
+
+
+class ChangeFeedWatcher:
+    '''
+    Polls a container's change feed and hands every batch of changed documents to the subscribers.
+    Each poll starts from the previous poll time (minus a small overlap for clock skew) instead of a
+    continuation token, the sync SDK only exposes that through the client's shared last_response_headers.
+    Subscribers must therefore tolerate seeing the same document twice.
+    '''
+    OVERLAP = timedelta(seconds=2)
+
+    def __init__(self, container: ContainerProxy, interval: Optional[float] = None):
+        self._container = container
+        self.interval = interval if interval is not None else float(os.getenv("COSMOS_DB_CHANGE_FEED_INTERVAL", "5"))
+        self._subscribers: List[Callable[[List[Dict[str, Any]]], Any]] = []
+        self._since: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, callback: Callable[[List[Dict[str, Any]]], Any]) -> None:
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def start(self) -> None:
+        if self.interval <= 0 or (self._task is not None and not self._task.done()):
+            return
+        if self._since is None:
+            self._since = datetime.now(timezone.utc)
+        # Run in a fresh context, the task would otherwise charge its polls to the invocation that started it
+        self._task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def poll(self) -> int:
+        started = datetime.now(timezone.utc)
+        since = (self._since or started) - self.OVERLAP
+        changes = await _measured(f"{self._container.id}.change_feed", lambda hook: list(self._container.query_items_change_feed(start_time=since, response_hook=hook)))
+        self._since = started
+        if changes:
+            for callback in self._subscribers:
+                result = callback(changes)
+                if inspect.isawaitable(result):
+                    await result
+        return len(changes)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Cosmos DB change feed error: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+
+_watchers: Dict[str, ChangeFeedWatcher] = {}
+
+
+def change_feed_watcher(container: ContainerProxy) -> ChangeFeedWatcher:
+    '''
+    One watcher per container per worker, shared by every subscriber
+    '''
+    if container.id not in _watchers:
+        _watchers[container.id] = ChangeFeedWatcher(container)
+    return _watchers[container.id]
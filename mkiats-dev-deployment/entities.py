@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 import logging
-from exceptions import EntityException
+from exceptions import EntityException, EntityExceptionCode
 from typing import Optional, Dict, Union
 from enum import Enum
 from uuid import uuid4
@@ -39,6 +39,10 @@ class Chatbot:
         status: ChatbotStatus = ChatbotStatus.INACTIVE,
         developer_id: Optional[str] = None,
         telegram_support: bool = False,
+        streaming_support: bool = False,
+        stateful: bool = False,
+        response_cache_ttl: int = 0,
+        response_cache_size: int = 0,
         deployment_resource: Optional[Union[Dict, DeploymentResource]] = None,
         created_at: Optional[int] = None,
         updated_at: Optional[int] = None
@@ -66,6 +70,14 @@ class Chatbot:
         self.status = status
         self.developer_id = developer_id
         self.telegram_support = telegram_support
+        # chatbot.py defines main_stream, so the deployment also serves <endpoint>/stream
+        self.streaming_support = streaming_support
+        # Answers depend on earlier messages, the forwarder never serves them from its response cache
+        self.stateful = stateful
+        # Identical queries are answered from the forwarder's cache for this many seconds, 0 turns it off.
+        # response_cache_size caps the cached answers, 0 uses the forwarder's default
+        self.response_cache_ttl = response_cache_ttl
+        self.response_cache_size = response_cache_size
         self.deployment_resource = deployment_resource
         
         # Set timestamps
@@ -101,6 +113,18 @@ class Chatbot:
             
         if not isinstance(self.telegram_support, bool):
             raise EntityException("telegram_support must be boolean", "Chatbot", "telegram_support")
+
+        if not isinstance(self.streaming_support, bool):
+            raise EntityException("streaming_support must be boolean", "Chatbot", "streaming_support")
+
+        if not isinstance(self.stateful, bool):
+            raise EntityException("stateful must be boolean", "Chatbot", error_code=EntityExceptionCode.INVALID_FIELD, field="stateful")
+
+        if not isinstance(self.response_cache_ttl, int) or isinstance(self.response_cache_ttl, bool) or self.response_cache_ttl < 0:
+            raise EntityException("response_cache_ttl must be a non-negative integer", "Chatbot", error_code=EntityExceptionCode.INVALID_FIELD, field="response_cache_ttl")
+
+        if not isinstance(self.response_cache_size, int) or isinstance(self.response_cache_size, bool) or self.response_cache_size < 0:
+            raise EntityException("response_cache_size must be a non-negative integer", "Chatbot", error_code=EntityExceptionCode.INVALID_FIELD, field="response_cache_size")
             
         return True
 
@@ -115,6 +139,10 @@ class Chatbot:
             "status": self.status.value,
             "developer_id": self.developer_id,
             "telegram_support": self.telegram_support,
+            "streaming_support": self.streaming_support,
+            "stateful": self.stateful,
+            "response_cache_ttl": self.response_cache_ttl,
+            "response_cache_size": self.response_cache_size,
             "deployment_resource": self.deployment_resource,
             "created_at": self.created_at,
             "updated_at": self.updated_at
@@ -160,6 +188,24 @@ class Chatbot:
         self.telegram_support = new_telegram_support
         self.updated_at = int(time.time())
         self.validate()
+
+    def set_stateful(self, new_stateful: bool):
+        if not isinstance(new_stateful, bool):
+            raise EntityException("Invalid stateful value", "Chatbot", error_code=EntityExceptionCode.INVALID_FIELD, field="stateful")
+        self.stateful = new_stateful
+        self.updated_at = int(time.time())
+        self.validate()
+
+    def set_response_cache(self, new_ttl: int, new_size: Optional[int] = None):
+        if not isinstance(new_ttl, int) or isinstance(new_ttl, bool) or new_ttl < 0:
+            raise EntityException("Invalid response cache ttl value", "Chatbot", error_code=EntityExceptionCode.INVALID_FIELD, field="response_cache_ttl")
+        if new_size is not None and (not isinstance(new_size, int) or isinstance(new_size, bool) or new_size < 0):
+            raise EntityException("Invalid response cache size value", "Chatbot", error_code=EntityExceptionCode.INVALID_FIELD, field="response_cache_size")
+        self.response_cache_ttl = new_ttl
+        if new_size is not None:
+            self.response_cache_size = new_size
+        self.updated_at = int(time.time())
+        self.validate()
         
     def validate_json(self):
         try:
@@ -186,6 +232,10 @@ class Chatbot:
                 status=ChatbotStatus(data.get('status', 'inactive')),
                 developer_id=data.get('developer_id'),
                 telegram_support=data.get('telegram_support', False),
+                streaming_support=data.get('streaming_support', False),
+                stateful=data.get('stateful', False),
+                response_cache_ttl=data.get('response_cache_ttl', 0),
+                response_cache_size=data.get('response_cache_size', 0),
                 deployment_resource=data.get('deployment_resource'),
                 created_at=data.get('created_at'),
                 updated_at=data.get('updated_at')
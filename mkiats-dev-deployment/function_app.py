@@ -1,6 +1,7 @@
 from typing import Any
 from dotenv import load_dotenv
 from azureFunctionDeployerClient import AzureFunctionDeployerClient
+from metrics import track_invocation
 import azure.functions as func
 import logging
 import os
@@ -28,11 +29,13 @@ def get_health_status(req: func.HttpRequest) -> func.HttpResponse:
 async def deploy_chatbot_validate(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('deploy_chatbot_validate executed...')
     theClient = AzureFunctionDeployerClient()
-    return await theClient.deploy_chatbot_validate(req)
+    with track_invocation("deployment.chatbots/deploy/validate"):
+        return await theClient.deploy_chatbot_validate(req)
 
 @app.route(route="chatbots/deploy/application", auth_level=func.AuthLevel.ANONYMOUS)
 async def deploy_chatbot_full(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('deploy_chatbot_full executed...')
     theClient = AzureFunctionDeployerClient()
-    return await theClient.deploy_chatbot_full(req)
+    with track_invocation("deployment.chatbots/deploy/application"):
+        return await theClient.deploy_chatbot_full(req)
 
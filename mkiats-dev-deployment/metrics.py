@@ -0,0 +1,205 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Mapping, Optional
+import bisect
+import json
+import os
+import time
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+REQUEST_DURATION_HEADER = "x-ms-request-duration-ms"
+
+# Aggregated operation stats are logged at most this often (seconds), 0 disables the periodic line
+METRICS_LOG_INTERVAL = float(os.getenv("COSMOS_METRICS_LOG_INTERVAL", "300"))
+
+
+class CosmosCall:
+    '''
+    response_hook for one logical Cosmos operation. The SDK calls it once per HTTP response
+    (every page of a query), always with that response's own headers.
+    '''
+    def __init__(self):
+        self.requests = 0
+        self.request_charge = 0.0
+        self.server_ms = 0.0
+        self.items = 0
+
+    def __call__(self, headers: Mapping[str, Any], result: Any) -> None:
+        # query_items also reports the lazy iterable it returns, that call carries no response of its own
+        if not isinstance(result, (dict, list)) and result is not None:
+            return
+        self.requests += 1
+        self.request_charge += _header_float(headers, REQUEST_CHARGE_HEADER)
+        self.server_ms += _header_float(headers, REQUEST_DURATION_HEADER)
+        if isinstance(result, dict) and isinstance(result.get("Documents"), list):
+            self.items += len(result["Documents"])
+        elif isinstance(result, list):
+            self.items += len(result)
+        elif isinstance(result, dict):
+            self.items += 1
+
+
+def _header_float(headers: Mapping[str, Any], name: str) -> float:
+    try:
+        return float(headers.get(name) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.requests = 0
+        self.request_charge = 0.0
+        self.server_ms = 0.0
+        self.client_ms = 0.0
+        self.client_ms_max = 0.0
+        self.items = 0
+
+    def add(self, call: CosmosCall, client_ms: float, error: bool) -> None:
+        self.calls += 1
+        self.errors += int(error)
+        self.requests += call.requests
+        self.request_charge += call.request_charge
+        self.server_ms += call.server_ms
+        self.client_ms += client_ms
+        self.client_ms_max = max(self.client_ms_max, client_ms)
+        self.items += call.items
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "requests": self.requests,
+            "ru": round(self.request_charge, 2),
+            "ru_avg": round(self.request_charge / self.calls, 2) if self.calls else 0.0,
+            "server_ms": round(self.server_ms, 2),
+            "client_ms": round(self.client_ms, 2),
+            "client_ms_avg": round(self.client_ms / self.calls, 2) if self.calls else 0.0,
+            "client_ms_max": round(self.client_ms_max, 2),
+            "items": self.items
+        }
+
+
+class InvocationMetrics:
+    '''
+    Cosmos cost of one function invocation (a Telegram update, a backend route), broken down by operation
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.operations: Dict[str, OperationStats] = {}
+        self.started = time.perf_counter()
+        self.closed = False
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "invocation": self.name,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "ru": round(sum(stats.request_charge for stats in self.operations.values()), 2),
+            "calls": sum(stats.calls for stats in self.operations.values()),
+            "operations": {name: stats.to_dict() for name, stats in self.operations.items()}
+        }
+
+
+class LatencyHistogram:
+    '''
+    Fixed-bucket latency histogram (milliseconds), cheap enough to update on every call
+    '''
+    BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms: float, error: bool = False) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.errors += int(error)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def quantile(self, q: float) -> float:
+        '''
+        Upper bound of the bucket holding the q-th observation, capped at the largest value seen
+        '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return round(min(self.BUCKETS_MS[index], self.max_ms) if index < len(self.BUCKETS_MS) else self.max_ms, 2)
+        return round(self.max_ms, 2)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 2),
+            "buckets": {f"le_{bound}": count for bound, count in zip(self.BUCKETS_MS, self.counts)} | {"inf": self.counts[-1]}
+        }
+
+
+_operations: Dict[str, OperationStats] = {}
+_invocation: ContextVar[Optional[InvocationMetrics]] = ContextVar("cosmos_invocation", default=None)
+_last_logged = time.monotonic()
+
+
+def record(operation: str, call: CosmosCall, client_ms: float, error: bool = False) -> None:
+    '''
+    Add one finished operation to the worker totals and to the current invocation, if any
+    '''
+    global _last_logged
+    _operations.setdefault(operation, OperationStats()).add(call, client_ms, error)
+
+    invocation = _invocation.get()
+    # Background tasks inherit the context of the invocation that started them, do not charge them to it
+    if invocation is not None and not invocation.closed:
+        invocation.operations.setdefault(operation, OperationStats()).add(call, client_ms, error)
+
+    if METRICS_LOG_INTERVAL > 0 and time.monotonic() - _last_logged > METRICS_LOG_INTERVAL:
+        _last_logged = time.monotonic()
+        logging.warning(f"cosmos_metrics {json.dumps(operation_stats())}")
+
+
+def operation_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: stats.to_dict() for name, stats in sorted(_operations.items())}
+
+
+def current_invocation() -> Optional[InvocationMetrics]:
+    return _invocation.get()
+
+
+def name_invocation(name: str) -> None:
+    '''
+    Rename the current invocation once the handler knows what it is serving (e.g. the Telegram command)
+    '''
+    invocation = _invocation.get()
+    if invocation is not None:
+        invocation.name = name
+
+
+@contextmanager
+def track_invocation(name: str) -> Iterator[InvocationMetrics]:
+    '''
+    Collect the Cosmos calls made inside the block and log them as one structured line when it exits
+    '''
+    invocation = InvocationMetrics(name)
+    token = _invocation.set(invocation)
+    try:
+        yield invocation
+    finally:
+        invocation.closed = True
+        _invocation.reset(token)
+        if invocation.operations:
+            logging.warning(f"cosmos_invocation {json.dumps(invocation.summary())}")
@@ -1,10 +1,26 @@
 from azure.functions import HttpResponse
-from typing import Tuple
+from botApiClient import BotApiClient
+from chatbotClient import ChatbotClient, ChatbotStreamError
+from contextlib import contextmanager
+from contextvars import ContextVar
+from messageFormatter import CAPTION_LIMIT, DOCUMENT_FALLBACK, MAX_MESSAGE_PARTS, MESSAGE_LIMIT, split_message, telegram_length
+from responseCache import response_cache, response_key
+from singleflight import chatbot_queries
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import logging
 import os
-import httpx
 import json
-import aiohttp
+import time
+
+# With TELEGRAM_INLINE_REPLIES=true the first reply of a webhook update is returned as the webhook
+# response ({"method": "sendMessage", ...}) instead of a separate Bot API call. Only the webhook enables it.
+INLINE_REPLIES = os.getenv("TELEGRAM_INLINE_REPLIES", "false").lower() == "true"
+_inline_reply: ContextVar[Optional[Dict[str, bool]]] = ContextVar("inline_reply", default=None)
+
+# Chatbots deployed with main_stream have their replies streamed into one message that is edited as text arrives
+STREAM_REPLIES = os.getenv("TELEGRAM_STREAM_REPLIES", "true").lower() == "true"
+# Telegram allows about one edit per second per chat
+STREAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.0"))
 
 def _parse_payload(payload: dict) -> Tuple[dict, str, str, dict, str]:
     message = payload.get('message', {})
@@ -22,63 +38,225 @@ def _parse_payload(payload: dict) -> Tuple[dict, str, str, dict, str]:
     return message, chat_id, text, callback_query, callback_data
 
 
+# Callback command -> the short prefix its callback_data starts with (callback_data is capped at 64 bytes)
+CALLBACK_PREFIXES = {
+    "command_callback_select": "select",
+    "command_callback_list_next": "next",
+    "command_callback_list_prev": "prev"
+}
+_CALLBACK_COMMANDS = {prefix: command for command, prefix in CALLBACK_PREFIXES.items()}
+
+
 def _command_mapper(command_string: str, reverse: bool = False) -> str:
-    command_map = {
-            "command_callback_select" : "select"
-        }
-    
-    reverse_command_map =  {
-            "select" : "command_callback_select"
-        }
-    
     if not reverse:
-        return command_map.get(command_string, "")
+        return CALLBACK_PREFIXES.get(command_string, "")
     else:
-        return reverse_command_map.get(command_string, "")
-
-async def _execute_url(method, params="", json="") -> HttpResponse:
-    with httpx.Client() as client:
-        URL = os.getenv("TELEGRAM_API_URL")
-        TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-
-        try:
-            if params:
-                logging.info(f'\nSendMessage params payload:\n {params}\n')
-            if json:
-                logging.info(f'\nSendMessage json payload:\n {json}\n')
-            response = client.post(f'{URL}{TOKEN}/{method}', params=params, json=json)
-            # logging.info(f"executing {method}: {response}")
-            return HttpResponse(body="Successfully executed _execute_url", 
-                                mimetype="text/plain",
-                                status_code=200)
-        except Exception as e:
-            logging.error(f"Error executing _execute_url: {str(e)}")
-            return HttpResponse(str(e), 
-                                mimetype="text/plain",
-                                status_code=500)
+        return _CALLBACK_COMMANDS.get(command_string, "")
+
+async def _execute_url(method, params="", json="", files=None) -> HttpResponse:
+    try:
+        if params:
+            logging.info(f'\nSendMessage params payload:\n {params}\n')
+        if json:
+            logging.info(f'\nSendMessage json payload:\n {json}\n')
+        response = await BotApiClient.shared().call(method, json=json, params=params, files=files)
+        # Pass Telegram's status through so failed sends are visible to the caller
+        return HttpResponse(body=response.body,
+                            mimetype="application/json",
+                            status_code=response.status_code)
+    except Exception as e:
+        logging.error(f"Error executing _execute_url: {str(e)}")
+        return HttpResponse(str(e), 
+                            mimetype="text/plain",
+                            status_code=500)
         
 
-async def _query_chatbot(chatbot_endpoint: str, user_query: str) -> str:
+async def _query_chatbot(chatbot_endpoint: str, user_query: str, chatbot: Any = None) -> str:
+    '''
+    Forward a query to a chatbot. Pass the Chatbot entity to use its response cache (see responseCache) and
+    to share one upstream call between identical queries in flight (see singleflight), stateful chatbots
+    get neither.
+    '''
     logging.warning("Executing _query_chatbot...")
     try:
+        if chatbot is not None:
+            cached = response_cache.get(chatbot, user_query)
+            if cached is not None:
+                logging.warning(f"Answered from the response cache of {chatbot.name}")
+                return cached
         request_payload = {
             'query': user_query
         }
         logging.warning(f"{chatbot_endpoint}, {json.dumps(request_payload)}")
-        
-        async with aiohttp.request('POST', chatbot_endpoint, json=request_payload) as response:
-            return await response.text()
+
+        async def forward() -> str:
+            response = await ChatbotClient.shared().query(chatbot_endpoint, request_payload)
+            if chatbot is not None:
+                response_cache.set(chatbot, user_query, response)
+            return response
+
+        if chatbot is None or chatbot.stateful:
+            return await forward()
+        return await chatbot_queries.do(response_key(chatbot, user_query), forward)
             
     except Exception as e:
         logging.error(f"Error executing _query_chatbot: {str(e)}")
         raise Exception("Error occurred in query chatbot")
 
 
+def _message_id(response: HttpResponse) -> Optional[int]:
+    if response.status_code != 200:
+        return None
+    try:
+        return json.loads(response.get_body()).get("result", {}).get("message_id")
+    except (ValueError, AttributeError):
+        return None
+
+
+async def _stream_chatbot(chat_id: str, chatbot_endpoint: str, user_query: str, chatbot: Any = None) -> HttpResponse:
+    '''
+    Forward a query to a streaming chatbot and deliver the reply while it is generated: the first chunk is
+    sent as a new message, later text is added with editMessageText at most every STREAM_EDIT_INTERVAL seconds.
+    Always sent outbound (never inline), the edits need the message_id. If the streaming route is not
+    available the query is forwarded the usual way. A cached answer is sent whole, without streaming.
+    '''
+    logging.warning("Executing _stream_chatbot...")
+    if chatbot is not None:
+        cached = response_cache.get(chatbot, user_query)
+        if cached is not None:
+            logging.warning(f"Answered from the response cache of {chatbot.name}")
+            return await _echo_message(chat_id=chat_id, text=cached)
+    text = ""
+    shown = ""
+    message_id = None
+    # Only one sendMessage is ever tried, without a message_id to edit there are no live updates
+    first_sent = False
+    last_flush = 0.0
+    response = None
+
+    async def flush() -> None:
+        nonlocal shown, message_id, first_sent, last_flush, response
+        # Once the text outgrows one message the first part stays put, the rest follows at the end
+        preview = split_message(text)[0]
+        if preview == shown:
+            return
+        if not first_sent:
+            first_sent = True
+            response = await _execute_url("sendMessage", json={'chat_id': chat_id, 'text': preview})
+            message_id = _message_id(response)
+        elif message_id is not None:
+            response = await _execute_url("editMessageText", json={'chat_id': chat_id, 'message_id': message_id, 'text': preview})
+        else:
+            return
+        if response.status_code == 200:
+            shown = preview
+        last_flush = time.monotonic()
+
+    try:
+        async for chunk in ChatbotClient.shared().stream(chatbot_endpoint, {'query': user_query}):
+            text += chunk
+            if not first_sent or (message_id is not None and time.monotonic() - last_flush >= STREAM_EDIT_INTERVAL):
+                await flush()
+    except ChatbotStreamError as e:
+        logging.warning(f"{str(e)}, forwarding without streaming")
+        response_msg = await _query_chatbot(chatbot_endpoint=chatbot_endpoint, user_query=user_query, chatbot=chatbot)
+        return await _echo_message(chat_id=chat_id, text=response_msg)
+    except Exception as e:
+        if not shown:
+            logging.error(f"Error executing _stream_chatbot: {str(e)}")
+            raise Exception("Error occurred in query chatbot")
+        # Keep what the user has already seen, finish with the text received so far
+        logging.error(f"Chatbot stream interrupted after {len(text)} characters: {str(e)}")
+    else:
+        # Only complete answers are cached: stream() refuses anything but a 200 and raises when the chatbot
+        # aborts mid-answer, an interrupted stream never gets here
+        if chatbot is not None:
+            response_cache.set(chatbot, user_query, text)
+
+    if not text:
+        raise Exception("Chatbot returned an empty stream")
+    if message_id is None:
+        # The first message failed or cannot be edited, deliver the finished reply once instead
+        logging.warning(f"Could not stream into a message for chat {chat_id}, sending the reply when complete")
+        return await _echo_message(chat_id=chat_id, text=text)
+    await flush()
+    # Text past the first message is sent as follow-up messages
+    return await _send_parts(chat_id, split_message(text)[1:]) or response
+
+
+@contextmanager
+def inline_replies() -> Iterator[None]:
+    '''
+    Let one reply of the current webhook update ride on the webhook response
+    '''
+    token = _inline_reply.set({"available": INLINE_REPLIES})
+    try:
+        yield
+    finally:
+        _inline_reply.reset(token)
+
+
+async def _reply(method: str, payload: Dict[str, Any]) -> HttpResponse:
+    '''
+    Send a single-message reply. Inside a webhook with inline replies on, the first one becomes the
+    webhook response body and saves an outbound call, its delivery errors are not reported back to us.
+    Handlers must return the HttpResponse they get here for that to work.
+    '''
+    slot = _inline_reply.get()
+    if slot and slot["available"]:
+        slot["available"] = False
+        return HttpResponse(body=json.dumps({"method": method, **payload}),
+                            mimetype="application/json",
+                            status_code=200)
+    return await _execute_url(method, json=payload)
+
+
+async def _send_parts(chat_id: str, parts: List[str]) -> Optional[HttpResponse]:
+    '''
+    Send the parts of a long reply strictly one after another, a part only goes once Telegram has taken
+    the previous one (concurrent sends can arrive out of order). Pacing is left to the rate limiter.
+    Stops at the first part that fails rather than leave a gap.
+    '''
+    response = None
+    for part in parts:
+        response = await _execute_url("sendMessage", json={'chat_id': chat_id, 'text': part})
+        if response.status_code != 200:
+            logging.error(f"Stopped sending a long reply to chat {chat_id} after a failed part")
+            break
+    return response
+
+
+async def _send_document(chat_id: str, text: str, filename: str = "response.txt") -> HttpResponse:
+    params = {
+        'chat_id': chat_id,
+        'caption': split_message(text, CAPTION_LIMIT)[0]
+    }
+    files = {'document': (filename, text.encode("utf-8"), "text/plain")}
+    return await _execute_url("sendDocument", params=params, files=files)
+
+
+async def _send_long_message(chat_id: str, text: str) -> HttpResponse:
+    '''
+    Deliver a reply longer than one message, split on paragraph and code block boundaries, or as a
+    document when it would take more than MAX_MESSAGE_PARTS messages. Never inline: the webhook
+    response is delivered after our outbound calls, so an inline first part would arrive last.
+    '''
+    parts = split_message(text)
+    if DOCUMENT_FALLBACK and len(parts) > MAX_MESSAGE_PARTS:
+        response = await _send_document(chat_id, text)
+        if response.status_code == 200:
+            return response
+        logging.warning(f"Sending the reply to chat {chat_id} as a document failed, sending {len(parts)} messages")
+    return await _send_parts(chat_id, parts)
+
+
 async def _echo_message(chat_id: str, text: str) -> HttpResponse:
+    if telegram_length(text) > MESSAGE_LIMIT:
+        return await _send_long_message(chat_id, text)
     response_payload = {
         'chat_id': chat_id,
         'text': text
         }
-    response = await _execute_url("sendMessage", json=response_payload)
+    response = await _reply("sendMessage", response_payload)
     return response
 
@@ -1,41 +1,67 @@
-from _common import _echo_message, _execute_url
-from entities import ChatbotCallbackData, inline_keyboard_button
+from _common import _echo_message, _reply
 from azure.functions import HttpResponse
-from azure.cosmos import ContainerProxy
-from cosmos import query_by_sql
+from catalog import telegram_catalog
+from updateContext import UpdateContext
 import logging
 import json
 
 
+def _list_text(start: int, end: int) -> str:
+    total = len(telegram_catalog.chatbots())
+    if total <= telegram_catalog.page_size:
+        return f'The following chatbots are available'
+    return f'The following chatbots are available ({start + 1}-{end} of {total})'
+
+
 # # For the /list command
-async def command_telegram_list(chat_id: str, container: ContainerProxy) -> HttpResponse:
+async def command_telegram_list(context: UpdateContext) -> HttpResponse:
+    chat_id = context.chat_id
     try:
         logging.warning("Executing command_telegram_list...")
 
-        # Query active chatbot in Cosmos DB
-        query = "SELECT * FROM c WHERE c.status = 'active' and c.telegram_support = true"
-        results = await query_by_sql(container=container, queryStr=query)
-
-        chatbots = list()
-        for chatbot in results:
-            theChatbotCallbackDataString = ChatbotCallbackData.create_callback_str(command="command_callback_select", chatbot_id=chatbot.get("id"))
-            theInlineKeyboardButton = inline_keyboard_button(text=chatbot.get("name"), callback_data=theChatbotCallbackDataString)
-            theInlineKeyboardButton = theInlineKeyboardButton.to_dict()
-            chatbots.append([theInlineKeyboardButton])
-        text = f'The following chatbots are available'
-        inline_keyboard = {
-            'inline_keyboard': chatbots
+        # Active chatbots come from the in-memory catalog, kept current by the change feed
+        await telegram_catalog.ensure_loaded(context.db.chatbot_container)
+
+        start, end = telegram_catalog.page()
+        json_payload = {
+            'chat_id': chat_id,
+            'text': _list_text(start, end),
+            'reply_markup': telegram_catalog.reply_markup(start)
         }
-        
+
+        response = await _reply("sendMessage", json_payload)
+        return response
+    except:
+        if context.retry_on_error:
+            raise
+        response_msg = "Error in executing command_telegram_list"
+        response = await _echo_message(chat_id, text=response_msg)
+        return response
+
+
+# Prev/Next buttons of the /list keyboard, the page is swapped in place
+async def command_telegram_list_page(context: UpdateContext, command_str: str, cursor: str) -> HttpResponse:
+    chat_id = context.chat_id
+    try:
+        logging.warning("Executing command_telegram_list_page...")
+        await telegram_catalog.ensure_loaded(context.db.chatbot_container)
+
+        if command_str == "command_callback_list_next":
+            start, end = telegram_catalog.page(after=cursor)
+        else:
+            start, end = telegram_catalog.page(before=cursor)
         json_payload = {
             'chat_id': chat_id,
-            'text': text,
-            'reply_markup': inline_keyboard
+            'message_id': context.callback_message_id,
+            'text': _list_text(start, end),
+            'reply_markup': telegram_catalog.reply_markup(start)
         }
-    
-        response = await _execute_url("sendMessage", json=json_payload)
+
+        response = await _reply("editMessageText", json_payload)
         return response
     except:
-        response_msg = "Error in executing command_telegram_list", 
+        if context.retry_on_error:
+            raise
+        response_msg = "Error in executing command_telegram_list_page"
         response = await _echo_message(chat_id, text=response_msg)
-        return response
\ No newline at end of file
+        return response
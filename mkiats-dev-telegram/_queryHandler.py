@@ -1,27 +1,26 @@
-from azure.cosmos import ContainerProxy
 from azure.functions import HttpResponse
-from _common import _query_chatbot, _echo_message
-from entities import User, Chatbot, ChatbotStatus
+from _common import STREAM_REPLIES, _query_chatbot, _stream_chatbot, _echo_message
+from chatLock import chat_lock
+from entities import Chatbot, ChatbotStatus
 from exceptions import TelegramException, TelegramExceptionCode
-from cosmos import query_by_key
+from updateContext import UpdateContext
 import logging
 
 
 
-async def command_telegram_query(chat_id: str, chatbot_id: str, user_query: str, chatbot_container: ContainerProxy, user_container: ContainerProxy) -> HttpResponse:
+async def command_telegram_query(context: UpdateContext, user_query: str) -> HttpResponse:
+    chat_id = context.chat_id
     try:
         logging.warning("Executing command_telegram_query...")
-        query_result = await query_by_key(container=chatbot_container, key="id", val=chatbot_id)
-        user_result = await query_by_key(container=user_container, key="id", val=chat_id)
-        the_chatbot: Chatbot = query_result[0]
-        the_user: User = user_result[0]
+        # The user's selected chatbot, loaded by TelegramClient._process_update
+        the_chatbot = context.chatbot
 
         # Chatbot not found
-        if len(the_chatbot) == 0:
+        if not the_chatbot:
             response_msg =  f"No chatbots of that name found! Try /list to refresh the chatbot list."
-        
-        the_chatbot = Chatbot.from_dict(the_chatbot)
-        the_user = User.from_dict(the_user)
+            return await _echo_message(chat_id=chat_id, text=response_msg)
+
+        the_chatbot: Chatbot = Chatbot.from_dict(the_chatbot)
 
         # Chatbot not acgtive
         if the_chatbot.status != ChatbotStatus.ACTIVE:
@@ -31,21 +30,24 @@ async def command_telegram_query(chat_id: str, chatbot_id: str, user_query: str,
         elif the_chatbot.telegram_support != True:
             response_msg = f"{the_chatbot.name}'s currently doesn't support telegram, Try /list to refresh the chatbot list."
 
-        elif the_user.is_querying == True:
-            response_msg = f"Please wait for the current query to finish."
         else:
-            the_user.update_is_querying(True)
-            user_container.upsert_item(body=the_user.to_dict())
-            the_chatbot_endpoint = the_chatbot.endpoint
-            logging.warning(the_chatbot_endpoint)
-            response_msg = await _query_chatbot(chatbot_endpoint=the_chatbot_endpoint, user_query=user_query)
-            logging.warning(response_msg)
+            # One query per chat at a time, the lease expires on its own if this worker dies mid-query
+            async with chat_lock.hold(chat_id) as acquired:
+                if not acquired:
+                    response_msg = f"Please wait for the current query to finish."
+                elif the_chatbot.streaming_support and STREAM_REPLIES:
+                    # The reply is delivered while it streams in, nothing is left to send afterwards
+                    return await _stream_chatbot(chat_id=chat_id, chatbot_endpoint=the_chatbot.endpoint, user_query=user_query, chatbot=the_chatbot)
+                else:
+                    the_chatbot_endpoint = the_chatbot.endpoint
+                    logging.warning(the_chatbot_endpoint)
+                    response_msg = await _query_chatbot(chatbot_endpoint=the_chatbot_endpoint, user_query=user_query, chatbot=the_chatbot)
+                    logging.warning(response_msg)
         response = await _echo_message(chat_id=chat_id, text=response_msg)
         return response
     except Exception as e:
+        if context.retry_on_error:
+            raise
         response_msg = f"Unknown error occured when querying chatbot, Try /list to refresh and select another chatbot."
         response = await _echo_message(chat_id, text=response_msg)
         return response
-    finally:
-        the_user.update_is_querying(False)
-        user_container.upsert_item(body=the_user.to_dict())
\ No newline at end of file
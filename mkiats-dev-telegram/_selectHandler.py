@@ -1,20 +1,20 @@
-from azure.cosmos import ContainerProxy
 from azure.functions import HttpResponse
 from _common import _echo_message
 from entities import ChatbotStatus, User, Chatbot
 from exceptions import TelegramException, TelegramExceptionCode
-from cosmos import query_by_key
+from cosmos import upsert_item
+from updateContext import UpdateContext, remember_selection
 import logging
 
 
 
-async def command_telegram_select(chat_id: str, callback_data: str, user_container: ContainerProxy, chatbot_container: ContainerProxy) -> HttpResponse:
+async def command_telegram_select(context: UpdateContext, chatbot_id: str) -> HttpResponse:
+    chat_id = context.chat_id
     try:
         logging.warning("Executing command_telegram_select...")
-        [short_command_str, chatbot_id] = callback_data.split('_')
-        query_result = await query_by_key(container=chatbot_container, key="id", val=chatbot_id)
-        the_chatbot = query_result[0]
-        if len(the_chatbot) == 0:
+        # Loaded by TelegramClient._process_update
+        the_chatbot = context.chatbot
+        if not the_chatbot:
             response_msg =  f"No chatbots of that name found! Try /list to refresh the chatbot list."
         
         the_chatbot = Chatbot.from_dict(the_chatbot)
@@ -29,11 +29,14 @@ async def command_telegram_select(chat_id: str, callback_data: str, user_contain
 
         else:
             the_user = User(id=chat_id, selected_chatbot_id=chatbot_id)
-            user_container.upsert_item(body=the_user.to_dict())
+            await upsert_item(context.db.user_container, body=the_user.to_dict())
+            remember_selection(chat_id, chatbot_id)
             response_msg = f"{the_chatbot.name} has been chosen, future messages would be forward there!"
         response = await _echo_message(chat_id, text=response_msg)
         return response
     except:
+        if context.retry_on_error:
+            raise
         response_msg = f"Unknown error occured when selecting chatbot, Try /list to refresh and select another chatbot."
         response = await _echo_message(chat_id, text=response_msg)
         return response
\ No newline at end of file
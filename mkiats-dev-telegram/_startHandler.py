@@ -1,9 +1,11 @@
 from _common import _echo_message
 from azure.functions import HttpResponse
+from updateContext import UpdateContext
 import logging
 
-async def command_telegram_start(chat_id: str) -> HttpResponse:
+async def command_telegram_start(context: UpdateContext) -> HttpResponse:
     logging.warning("Executing command_telegram_start...")
+    chat_id = context.chat_id
     start_msg = f"Welcome to Chatbot marketplace!\nType /list to see available chatbots"
     response = await _echo_message(chat_id, text=start_msg)
     return response
\ No newline at end of file
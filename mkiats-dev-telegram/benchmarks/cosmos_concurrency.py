@@ -0,0 +1,73 @@
+"""
+Throughput of cosmos.query_by_key as concurrency grows, against the in-memory
+Cosmos stand-in (COSMOS_DB_BACKEND=memory), which blocks for a fixed round trip
+like the sync SDK does and reports RU charges.
+
+    python benchmarks/cosmos_concurrency.py --latency-ms 20 --requests 200
+
+"inline" calls the container on the event loop (the old behaviour),
+"executor" goes through cosmos.query_by_key.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cosmos
+from azure.cosmos import ContainerProxy
+from cosmos import CosmosDB, query_by_key
+from metrics import operation_stats
+
+
+async def _users_container(latency_ms: float, users: int) -> ContainerProxy:
+    os.environ["COSMOS_DB_BACKEND"] = "memory"
+    os.environ["COSMOS_DB_MEMORY_LATENCY_MS"] = str(latency_ms)
+    db = await CosmosDB.shared()
+    for i in range(users):
+        db.user_container._write({"id": str(i), "partition": str(i)[:4], "selected_chatbot_id": None})
+    return db.user_container
+
+
+async def _inline_query(container: ContainerProxy, val: str):
+    return list(container.query_items(query="SELECT * FROM c WHERE c.id = @id", parameters=[dict(name="@id", value=val)]))
+
+
+async def _run(mode: str, container: ContainerProxy, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            if mode == "inline":
+                await _inline_query(container, str(i))
+            else:
+                await query_by_key(container=container, key="id", val=str(i))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return requests / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    container = await _users_container(args.latency_ms, args.requests)
+    print(f"{'concurrency':>11} {'inline req/s':>13} {'executor req/s':>15}")
+    for concurrency in args.concurrency:
+        inline = await _run("inline", container, args.requests, concurrency)
+        executor = await _run("executor", container, args.requests, concurrency)
+        print(f"{concurrency:>11} {inline:>13.1f} {executor:>15.1f}")
+    print(f"executor workers: {cosmos._get_executor()._max_workers} (COSMOS_DB_MAX_WORKERS)")
+    print(f"recorded: {json.dumps(operation_stats())}")
+    print(f"container: {json.dumps(container.stats())}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""
+Throughput of pollingRunner.PollingRunner against a fake Bot API that serves
+--chats x --messages updates through getUpdates, with a handler that takes
+--work-ms per update. Checks that every chat's updates ran in update_id order.
+
+    python benchmarks/polling_load.py --chats 50 --messages 20 --work-ms 20
+
+With W workers the expected rate is about W * 1000 / work-ms updates/s while
+there are at least W chats with work, a single chat never goes faster than
+1000 / work-ms however many workers there are.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+
+
+def _updates(chats: int, messages: int):
+    # Interleaved the way busy chats arrive: one message from every chat, then the next round
+    return [
+        {"update_id": 1000 + n * chats + chat, "message": {"message_id": n, "chat": {"id": chat}, "text": f"message {n}"}}
+        for n in range(messages)
+        for chat in range(chats)
+    ]
+
+
+async def _fake_bot_api(updates, batch: int) -> web.AppRunner:
+    async def get_updates(request: web.Request) -> web.Response:
+        body = await request.json()
+        offset = body.get("offset", 0)
+        limit = min(body.get("limit", 100), batch)
+        result = [update for update in updates if update["update_id"] >= offset][:limit]
+        if not result:
+            # Long poll with nothing to deliver
+            await asyncio.sleep(0.05)
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/getUpdates", get_updates)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+async def _run(concurrency: int, updates, work_ms: float):
+    from pollingRunner import PollingRunner
+
+    seen = {}
+    done = asyncio.Event()
+
+    async def handler(payload):
+        seen.setdefault(payload["message"]["chat"]["id"], []).append(payload["update_id"])
+        await asyncio.sleep(work_ms / 1000)
+        if sum(len(ids) for ids in seen.values()) == len(updates):
+            done.set()
+
+    runner = PollingRunner(handler=handler, concurrency=concurrency)
+    started = time.perf_counter()
+    task = asyncio.get_running_loop().create_task(runner.run())
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    runner.stop()
+    await task
+    ordered = all(ids == sorted(ids) for ids in seen.values())
+    return len(updates) / elapsed, ordered, runner.stats()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--work-ms", type=float, default=20)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    updates = _updates(args.chats, args.messages)
+    server = await _fake_bot_api(updates, args.batch)
+    port = server.addresses[0][1]
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{port}/bot"
+    os.environ["TELEGRAM_BOT_TOKEN"] = "benchmark"
+    os.environ["TELEGRAM_POLL_TIMEOUT"] = "1"
+
+    print(f"{len(updates)} updates from {args.chats} chats, {args.work_ms}ms per update")
+    print(f"{'workers':>7} {'updates/s':>10} {'in order':>9}")
+    stats = None
+    for concurrency in args.concurrency:
+        rate, ordered, stats = await _run(concurrency, updates, args.work_ms)
+        print(f"{concurrency:>7} {rate:>10.1f} {str(ordered):>9}")
+    print(f"last run: {json.dumps(stats)}")
+    await server.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
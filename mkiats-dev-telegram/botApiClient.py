@@ -0,0 +1,125 @@
+import logging
+from rateLimiter import RateLimiter
+from typing import Any, Dict, Optional
+import asyncio
+import httpx
+import json
+import os
+
+
+class BotApiResponse:
+    def __init__(self, status_code: int, body: bytes):
+        self.status_code = status_code
+        self.body = body
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 300
+
+    def json(self) -> Dict[str, Any]:
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return {}
+
+
+class BotApiClient:
+    '''
+    Worker-lifetime Telegram Bot API client. One pooled httpx.AsyncClient is shared by every handler,
+    so api.telegram.org connections (and their TLS sessions) are kept alive between updates.
+    HTTP/2 is used when TELEGRAM_API_HTTP2=true and the h2 package is installed.
+    Calls addressed to a chat are paced by the rate limiter and retried after Telegram's 429 retry_after.
+    '''
+    _shared: Optional['BotApiClient'] = None
+
+    def __init__(self):
+        self.base_url = f'{os.getenv("TELEGRAM_API_URL")}{os.getenv("TELEGRAM_BOT_TOKEN")}'
+        self.timeout = httpx.Timeout(
+            connect=float(os.getenv("TELEGRAM_API_CONNECT_TIMEOUT", "5")),
+            read=float(os.getenv("TELEGRAM_API_READ_TIMEOUT", "30")),
+            write=float(os.getenv("TELEGRAM_API_WRITE_TIMEOUT", "30")),
+            pool=float(os.getenv("TELEGRAM_API_POOL_TIMEOUT", "5"))
+        )
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv("TELEGRAM_API_MAX_CONNECTIONS", "32")),
+            max_keepalive_connections=int(os.getenv("TELEGRAM_API_MAX_KEEPALIVE", "16")),
+            keepalive_expiry=float(os.getenv("TELEGRAM_API_KEEPALIVE_EXPIRY", "60"))
+        )
+        self.http2 = os.getenv("TELEGRAM_API_HTTP2", "false").lower() == "true" and self._h2_available()
+        self.limiter = RateLimiter()
+        # 429s retried per call before the response is handed back, retry_after above this is not waited out
+        self.max_retries = int(os.getenv("TELEGRAM_API_MAX_RETRIES", "3"))
+        self.max_retry_after = float(os.getenv("TELEGRAM_API_MAX_RETRY_AFTER", "60"))
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def shared(cls) -> 'BotApiClient':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @staticmethod
+    def _h2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logging.warning("TELEGRAM_API_HTTP2 is set but h2 is not installed, using HTTP/1.1 keep-alive")
+            return False
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # The pool belongs to the loop it was created on, start a new one if the loop changed
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits, http2=self.http2)
+            self._loop = loop
+        return self._client
+
+    @staticmethod
+    def _chat_id(json: Optional[Dict[str, Any]], params: Optional[Dict[str, Any]]) -> Optional[Any]:
+        for source in (json, params):
+            if source and source.get("chat_id") is not None:
+                return str(source["chat_id"])
+        return None
+
+    async def call(
+        self,
+        method: str,
+        json: Optional[Dict[str, Any]] = None,
+        params: Optional[Dict[str, Any]] = None,
+        files: Optional[Dict[str, Any]] = None,
+        read_timeout: Optional[float] = None
+    ) -> BotApiResponse:
+        '''
+        POST a Bot API method and return Telegram's own status and body, raises httpx.HTTPError on transport failures.
+        Sends to a chat wait for a rate limiter slot first, calls without a chat (getUpdates, answerCallbackQuery, ...) are not
+        paced but still wait out a retry_after Telegram set for the whole bot.
+        files are uploaded as multipart/form-data, pass the other arguments in params alongside them.
+        read_timeout overrides TELEGRAM_API_READ_TIMEOUT, long polls need more than their own timeout.
+        '''
+        chat_id = self._chat_id(json, params)
+        timeout = self.timeout if read_timeout is None else httpx.Timeout(connect=self.timeout.connect, read=read_timeout, write=self.timeout.write, pool=self.timeout.pool)
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self.limiter.acquire(chat_id)
+            else:
+                await self.limiter.wait_unblocked()
+            response = await self._get_client().post(f'/{method}', json=json or None, params=params or None, files=files or None, timeout=timeout)
+            result = BotApiResponse(response.status_code, response.content)
+            if response.status_code == 429:
+                retry_after = float(result.json().get("parameters", {}).get("retry_after", 1))
+                self.limiter.defer(retry_after, chat_id)
+                if attempt < self.max_retries and retry_after <= self.max_retry_after:
+                    continue
+            if response.status_code != 200:
+                logging.warning(f"Telegram {method} failed with {response.status_code}: {response.text}")
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rate_limiter": self.limiter.stats()}
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
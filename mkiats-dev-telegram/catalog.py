@@ -0,0 +1,168 @@
+import logging
+from azure.cosmos import ContainerProxy
+from cosmos import change_feed_watcher, query_by_sql
+from entities import ChatbotCallbackData, ChatbotStatus, inline_keyboard_button
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+CATALOG_QUERY = "SELECT c.id, c.name FROM c WHERE c.status = 'active' and c.telegram_support = true"
+LIST_PAGE_SIZE = int(os.getenv("TELEGRAM_LIST_PAGE_SIZE", "8"))
+
+
+class TelegramCatalog:
+    '''
+    Materialized view of the chatbots /list offers (active and Telegram enabled), id -> name only.
+    Built once per worker (or from the local snapshot), then maintained from the chatbots change feed.
+    A full refresh still runs every TELEGRAM_CATALOG_REFRESH seconds because the change feed does not report deletes.
+    /list pages are slices of the sorted catalog addressed by a chatbot id cursor, see page().
+    '''
+    def __init__(self, snapshot_path: Optional[str] = None, page_size: int = LIST_PAGE_SIZE):
+        self._chatbots: Dict[str, str] = {}
+        self._sorted: Optional[List[Dict[str, str]]] = None
+        self._positions: Dict[str, int] = {}
+        self._page_markups: Dict[int, str] = {}
+        self.page_size = page_size
+        self._refreshed_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+        self.version = 0
+        self.refresh_interval = float(os.getenv("TELEGRAM_CATALOG_REFRESH", "3600"))
+        self.snapshot_max_age = float(os.getenv("TELEGRAM_CATALOG_SNAPSHOT_MAX_AGE", "600"))
+        self.snapshot_path = snapshot_path or os.getenv(
+            "TELEGRAM_CATALOG_SNAPSHOT",
+            os.path.join(tempfile.gettempdir(), "telegram_catalog.json")
+        )
+
+    async def ensure_loaded(self, chatbot_container: ContainerProxy) -> None:
+        watcher = change_feed_watcher(chatbot_container)
+        watcher.subscribe(self.apply_changes)
+        watcher.start()
+
+        if self.version == 0 and self._load_snapshot():
+            self._refresh_in_background(chatbot_container)
+        elif self.version == 0:
+            await self.refresh(chatbot_container)
+        elif time.time() - self._refreshed_at > self.refresh_interval:
+            self._refresh_in_background(chatbot_container)
+
+    async def refresh(self, chatbot_container: ContainerProxy) -> None:
+        results = await query_by_sql(container=chatbot_container, queryStr=CATALOG_QUERY)
+        self._refreshed_at = time.time()
+        self._replace({str(chatbot["id"]): chatbot.get("name", "") for chatbot in results})
+
+    def _refresh_in_background(self, chatbot_container: ContainerProxy) -> None:
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.get_running_loop().create_task(self._safe_refresh(chatbot_container))
+
+    async def _safe_refresh(self, chatbot_container: ContainerProxy) -> None:
+        try:
+            await self.refresh(chatbot_container)
+        except Exception as e:
+            logging.error(f"Error refreshing telegram catalog: {str(e)}")
+
+    def apply_changes(self, changes: List[Dict[str, Any]]) -> None:
+        chatbots = dict(self._chatbots)
+        for chatbot in changes:
+            chatbot_id = str(chatbot.get("id"))
+            if chatbot.get("status") == ChatbotStatus.ACTIVE.value and chatbot.get("telegram_support") is True:
+                chatbots[chatbot_id] = chatbot.get("name", "")
+            else:
+                chatbots.pop(chatbot_id, None)
+        self._replace(chatbots)
+
+    def _replace(self, chatbots: Dict[str, str]) -> None:
+        if chatbots == self._chatbots and self.version > 0:
+            return
+        self._chatbots = chatbots
+        self._invalidate_views()
+        self.version += 1
+        self._save_snapshot()
+
+    def _invalidate_views(self) -> None:
+        self._sorted = None
+        self._positions = {}
+        self._page_markups = {}
+
+    def chatbots(self) -> List[Dict[str, str]]:
+        if self._sorted is None:
+            self._sorted = [
+                {"id": chatbot_id, "name": name}
+                for chatbot_id, name in sorted(self._chatbots.items(), key=lambda item: (item[1].lower(), item[0]))
+            ]
+            self._positions = {chatbot["id"]: position for position, chatbot in enumerate(self._sorted)}
+        return self._sorted
+
+    def page(self, after: Optional[str] = None, before: Optional[str] = None) -> Tuple[int, int]:
+        '''
+        (start, end) of the page following the chatbot id after, or preceding the chatbot id before.
+        The first page when no cursor is given or the cursor chatbot is no longer listed.
+        '''
+        chatbots = self.chatbots()
+        start = 0
+        if after is not None and after in self._positions:
+            start = self._positions[after] + 1
+        elif before is not None and before in self._positions:
+            start = max(0, self._positions[before] - self.page_size)
+        start = min(start, max(0, len(chatbots) - 1))
+        return start, min(start + self.page_size, len(chatbots))
+
+    def reply_markup(self, start: int = 0) -> str:
+        '''
+        JSON-serialized inline keyboard of the page starting at start, with Prev/Next buttons carrying
+        the cursor chatbot id. Pages are only rebuilt after the catalog changes.
+        '''
+        if start not in self._page_markups:
+            chatbots = self.chatbots()
+            end = min(start + self.page_size, len(chatbots))
+            inline_keyboard = list()
+            for chatbot in chatbots[start:end]:
+                theChatbotCallbackDataString = ChatbotCallbackData.create_callback_str(command="command_callback_select", chatbot_id=chatbot["id"])
+                theInlineKeyboardButton = inline_keyboard_button(text=chatbot["name"], callback_data=theChatbotCallbackDataString)
+                inline_keyboard.append([theInlineKeyboardButton.to_dict()])
+            navigation = list()
+            if start > 0:
+                callback_data = ChatbotCallbackData.create_callback_str(command="command_callback_list_prev", chatbot_id=chatbots[start]["id"])
+                navigation.append(inline_keyboard_button(text="« Prev", callback_data=callback_data).to_dict())
+            if end < len(chatbots):
+                callback_data = ChatbotCallbackData.create_callback_str(command="command_callback_list_next", chatbot_id=chatbots[end - 1]["id"])
+                navigation.append(inline_keyboard_button(text="Next »", callback_data=callback_data).to_dict())
+            if navigation:
+                inline_keyboard.append(navigation)
+            self._page_markups[start] = json.dumps({'inline_keyboard': inline_keyboard})
+        return self._page_markups[start]
+
+    def _load_snapshot(self) -> bool:
+        try:
+            with open(self.snapshot_path, "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if time.time() - snapshot.get("saved_at", 0) > self.snapshot_max_age:
+                return False
+            self._chatbots = {str(k): v for k, v in snapshot.get("chatbots", {}).items()}
+            self._invalidate_views()
+            self._refreshed_at = snapshot["saved_at"]
+            self.version += 1
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _save_snapshot(self) -> None:
+        try:
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w") as snapshot_file:
+                json.dump({"saved_at": time.time(), "chatbots": self._chatbots}, snapshot_file)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logging.warning(f"Could not write telegram catalog snapshot: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._chatbots),
+            "version": self.version,
+            "refreshed_at": int(self._refreshed_at)
+        }
+
+
+telegram_catalog = TelegramCatalog()
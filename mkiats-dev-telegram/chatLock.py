@@ -0,0 +1,253 @@
+'''
+Per-chat query lock, so a chat only ever has one chatbot query in flight.
+
+Two layers:
+    local   a per-worker map of held leases, concurrent updates for a busy chat are turned away without any I/O
+    cosmos  a small lease document per chat in the "leases" container, shared by every worker
+The shared lease is held for TELEGRAM_CHAT_LEASE_WINDOW seconds per write and renewed while the query runs,
+so a worker that dies mid-query frees the chat within one window. Releasing expires the lease with an If-Match
+replace, so the chat is free on every worker as soon as its query ends. Lease documents are reused: the worker
+that released one takes it back with its etag and no read, other workers read it and replace it once it has
+expired. A lease recorded under this worker's owner id is always this worker's to take back, another query
+here cannot hold it (the local layer turns those away first). No query holds a chat longer than
+TELEGRAM_CHAT_LEASE_SECONDS.
+
+The "leases" container is only created by CosmosDB.provision() (COSMOS_DB_PROVISION=true). Without it the
+lock uses the local layer only, checked once per worker. TELEGRAM_CHAT_LOCK=local skips the shared lease,
+for single-instance and local runs.
+'''
+import logging
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+from cache import TTLCache
+from contextlib import asynccontextmanager
+from cosmos import CosmosDB, create_item, read_item, replace_item
+from typing import Any, AsyncIterator, Dict, Optional
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+CHAT_LOCK_BACKEND = os.getenv("TELEGRAM_CHAT_LOCK", "cosmos").lower()
+# Longer than a chatbot query may take (CHATBOT_READ_TIMEOUT), shorter than users are willing to wait after a crash
+LEASE_SECONDS = int(os.getenv("TELEGRAM_CHAT_LEASE_SECONDS", "150"))
+# How long one write holds the shared lease, and so how long a chat stays locked after its worker died
+LEASE_WINDOW = float(os.getenv("TELEGRAM_CHAT_LEASE_WINDOW", "15"))
+# Lease documents are reused by later queries of the chat, Cosmos removes them after a quiet hour
+LEASE_DOCUMENT_TTL = 3600
+
+# This worker, unique across restarts that reuse a pid
+_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class ChatLease:
+    def __init__(self, chat_id: str, expires_at: float, owner: str = _OWNER):
+        self.chat_id = str(chat_id)
+        self.owner = owner
+        # Local deadline, the longest this query may hold the chat
+        self.expires_at = expires_at
+        # Until when the shared lease document holds the chat, and its etag
+        self.shared_until = 0.0
+        self.etag: Optional[str] = None
+        self.renewal: Optional[asyncio.Task] = None
+
+    @property
+    def key(self) -> str:
+        return f"chat-{self.chat_id}"
+
+    def to_dict(self, until: float) -> Dict[str, Any]:
+        return {"id": self.key, "owner": self.owner, "expires_at": until, "ttl": LEASE_DOCUMENT_TTL}
+
+
+class ChatLock:
+    def __init__(self, lease_seconds: int = LEASE_SECONDS, backend: str = CHAT_LOCK_BACKEND, window: float = LEASE_WINDOW, owner: str = _OWNER):
+        self.lease_seconds = lease_seconds
+        self.owner = owner
+        self.backend = backend
+        self.window = window
+        # Renew with this much of the window left, enough for a slow write
+        self.renew_margin = window / 5
+        self._held: Dict[str, ChatLease] = {}
+        # chat id -> etag of the lease document this worker last released, taken back without a read
+        self._released = TTLCache(maxsize=10000, ttl=LEASE_DOCUMENT_TTL / 2, name="released_leases")
+        self.shared: Optional[bool] = None
+        self.acquired = 0
+        self.busy = 0
+        self.reclaimed = 0
+        self.takeovers = 0
+        self.renewals = 0
+        self.errors = 0
+
+    async def _use_shared(self) -> bool:
+        if self.backend != "cosmos":
+            return False
+        if self.shared is None:
+            self.shared = await (await CosmosDB.shared()).has_container("leases")
+            if not self.shared:
+                logging.warning("No leases container, chat locks only cover this worker")
+        return self.shared
+
+    async def acquire(self, chat_id: str) -> Optional[ChatLease]:
+        '''
+        A lease on the chat, or None while another query for it is still running
+        '''
+        now = time.time()
+        held = self._held.get(str(chat_id))
+        if held is not None and held.expires_at > now:
+            self.busy += 1
+            return None
+
+        # Claim locally before awaiting anything, so concurrent updates on this worker stop at the check above
+        lease = ChatLease(chat_id, now + self.lease_seconds, self.owner)
+        self._held[lease.chat_id] = lease
+        try:
+            shared = not await self._use_shared() or await self._acquire_shared(lease)
+        except Exception as e:
+            # Fail open on the local lock, a Cosmos hiccup should not stop every query
+            self.errors += 1
+            logging.error(f"Chat lease error for chat {lease.chat_id}, using the local lock only: {str(e)}")
+            shared = True
+        if not shared:
+            self._forget(lease)
+            self.busy += 1
+            return None
+        if lease.etag is not None:
+            lease.renewal = asyncio.get_running_loop().create_task(self._renew(lease))
+        self.acquired += 1
+        return lease
+
+    async def _acquire_shared(self, lease: ChatLease) -> bool:
+        container = (await CosmosDB.shared()).lease_container
+        until = time.time() + self.window
+        document = lease.to_dict(until)
+
+        etag = self._released.get(lease.chat_id)
+        if etag is not None:
+            # This worker released it last, nobody has written it since if the etag still matches. A renewal
+            # cancelled mid-write can have moved the etag on, the read below still recognises our owner id
+            self._released.invalidate(lease.chat_id)
+            try:
+                written = await replace_item(container, document, etag=etag)
+                self.reclaimed += 1
+                return self._hold_shared(lease, written, until)
+            except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+                pass
+
+        current = await read_item(container, lease.key, lease.key)
+        ours = current is not None and current.get("owner") == self.owner
+        if current is not None and not ours and current.get("expires_at", 0) > time.time():
+            return False
+        try:
+            if current is None:
+                written = await create_item(container, document)
+            else:
+                written = await replace_item(container, document, etag=current.get("_etag"))
+                if ours:
+                    self.reclaimed += 1
+                else:
+                    self.takeovers += 1
+        except (CosmosResourceExistsError, CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+            # Another worker got there first
+            return False
+        return self._hold_shared(lease, written, until)
+
+    @staticmethod
+    def _hold_shared(lease: ChatLease, written: Dict[str, Any], until: float) -> bool:
+        lease.etag = written.get("_etag")
+        lease.shared_until = until
+        return True
+
+    async def _renew(self, lease: ChatLease) -> None:
+        '''
+        Keep the shared lease alive while the query runs, up to the lease's local deadline
+        '''
+        container = (await CosmosDB.shared()).lease_container
+        while True:
+            await asyncio.sleep(max(0.0, lease.shared_until - self.renew_margin - time.time()))
+            if time.time() >= lease.expires_at:
+                # Held for lease_seconds already, let it run out rather than keep a hung query's chat locked
+                return
+            until = min(time.time() + self.window, lease.expires_at)
+            try:
+                renewed = await replace_item(container, lease.to_dict(until), etag=lease.etag)
+            except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+                logging.error(f"Chat lease for chat {lease.chat_id} expired and was taken over while its query ran")
+                lease.etag = None
+                return
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Error renewing chat lease for chat {lease.chat_id}: {str(e)}")
+                await asyncio.sleep(1.0)
+                continue
+            self._hold_shared(lease, renewed, until)
+            self.renewals += 1
+
+    async def release(self, lease: ChatLease) -> None:
+        if lease.renewal is not None:
+            lease.renewal.cancel()
+        try:
+            if lease.etag is not None:
+                await self._expire(lease)
+        except Exception as e:
+            # The lease still runs out by itself within the window
+            self.errors += 1
+            logging.error(f"Could not release the chat lease for chat {lease.chat_id}: {str(e)}")
+        finally:
+            # Held locally until the shared lease is expired, so a query here cannot race the release write
+            self._forget(lease)
+
+    async def _expire(self, lease: ChatLease) -> None:
+        '''
+        Free the chat for every worker, keeping the document and its etag for the next query here
+        '''
+        container = (await CosmosDB.shared()).lease_container
+        document = lease.to_dict(0)
+        etag = lease.etag
+        for _ in range(2):
+            try:
+                written = await replace_item(container, document, etag=etag)
+                self._released.set(lease.chat_id, written.get("_etag"))
+                return
+            except CosmosAccessConditionFailedError:
+                # A renewal cancelled mid-write may have landed after all, the lease is still ours if the owner is
+                current = await read_item(container, lease.key, lease.key)
+                if current is None or current.get("owner") != self.owner:
+                    return
+                etag = current.get("_etag")
+            except CosmosResourceNotFoundError:
+                return
+
+    def _forget(self, lease: ChatLease) -> None:
+        if self._held.get(lease.chat_id) is lease:
+            del self._held[lease.chat_id]
+
+    @asynccontextmanager
+    async def hold(self, chat_id: str) -> AsyncIterator[bool]:
+        '''
+        async with chat_lock.hold(chat_id) as acquired: ... releases the lease on exit if one was taken
+        '''
+        lease = await self.acquire(chat_id)
+        try:
+            yield lease is not None
+        finally:
+            if lease is not None:
+                await self.release(lease)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "backend": self.backend,
+            "shared": self.shared,
+            "lease_seconds": self.lease_seconds,
+            "window": self.window,
+            "held": sum(1 for lease in self._held.values() if lease.expires_at > now),
+            "acquired": self.acquired,
+            "busy": self.busy,
+            "reclaimed": self.reclaimed,
+            "takeovers": self.takeovers,
+            "renewals": self.renewals,
+            "errors": self.errors
+        }
+
+
+chat_lock = ChatLock()
@@ -0,0 +1,154 @@
+import logging
+from metrics import LatencyHistogram
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit, urlunsplit
+import aiohttp
+import asyncio
+import codecs
+import os
+import time
+
+
+class ChatbotStreamError(Exception):
+    '''
+    The streaming route answered with something other than 200, nothing has been read from it
+    '''
+    def __init__(self, status: int, endpoint: str):
+        super().__init__(f"Streaming query to {endpoint} failed with {status}")
+        self.status = status
+
+
+class ChatbotQueryError(Exception):
+    '''
+    The chatbot answered a query with a non-2xx status, body is what it sent instead of an answer
+    '''
+    def __init__(self, status: int, endpoint: str, body: str):
+        super().__init__(f"Query to {endpoint} failed with {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+
+class ChatbotClient:
+    '''
+    Worker-lifetime client for forwarding queries to chatbot endpoints. One aiohttp session with a
+    per-host connection pool and DNS cache is shared by every update, so follow-up messages to the same
+    chatbot reuse a warm connection instead of paying DNS, TCP and TLS setup each time.
+    '''
+    _shared: Optional['ChatbotClient'] = None
+
+    def __init__(self):
+        self.limit = int(os.getenv("CHATBOT_MAX_CONNECTIONS", "100"))
+        self.limit_per_host = int(os.getenv("CHATBOT_MAX_CONNECTIONS_PER_HOST", "16"))
+        self.dns_cache_ttl = int(os.getenv("CHATBOT_DNS_CACHE_TTL", "300"))
+        # Azure front ends drop idle connections after ~4 minutes, stay well under that
+        self.keepalive_timeout = float(os.getenv("CHATBOT_KEEPALIVE_TIMEOUT", "60"))
+        total_timeout = float(os.getenv("CHATBOT_TOTAL_TIMEOUT", "0"))
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout or None,
+            connect=float(os.getenv("CHATBOT_CONNECT_TIMEOUT", "10")),
+            sock_read=float(os.getenv("CHATBOT_READ_TIMEOUT", "120"))
+        )
+        self.latency: Dict[str, LatencyHistogram] = {}
+        # Time until the first chunk of a streamed reply, what users actually wait for
+        self.first_chunk: Dict[str, LatencyHistogram] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def shared(cls) -> 'ChatbotClient':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions belong to the loop they were created on, start a new one if the loop changed
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    @staticmethod
+    def endpoint_key(endpoint: str) -> str:
+        '''
+        Histogram key for an endpoint, scheme://host/path without the query string (function keys live there)
+        '''
+        parts = urlsplit(endpoint)
+        return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+    @staticmethod
+    def stream_endpoint(endpoint: str) -> str:
+        '''
+        The streaming route next to a chatbot endpoint, .../chat/query -> .../chat/query/stream (query string kept)
+        '''
+        parts = urlsplit(endpoint)
+        return urlunsplit(parts._replace(path=parts.path.rstrip("/") + "/stream"))
+
+    async def query(self, endpoint: str, payload: Dict[str, Any]) -> str:
+        '''
+        Forward a query and return the chatbot's answer, raises ChatbotQueryError if it does not answer 2xx
+        '''
+        started = time.perf_counter()
+        failed = True
+        try:
+            async with self._get_session().post(endpoint, json=payload) as response:
+                text = await response.text()
+                failed = response.status >= 500
+                if not 200 <= response.status < 300:
+                    raise ChatbotQueryError(response.status, self.endpoint_key(endpoint), text)
+                return text
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.latency.setdefault(self.endpoint_key(endpoint), LatencyHistogram()).observe(elapsed_ms, error=failed)
+
+    async def stream(self, endpoint: str, payload: Dict[str, Any]) -> AsyncIterator[str]:
+        '''
+        Query the chatbot's streaming route and yield the reply text as it arrives.
+        Raises ChatbotStreamError before yielding anything if the route does not answer 200. A chatbot that
+        fails mid-answer aborts the connection (aiohttp.ClientPayloadError), only a clean end is a complete reply.
+        '''
+        stream_endpoint = self.stream_endpoint(endpoint)
+        key = self.endpoint_key(stream_endpoint)
+        started = time.perf_counter()
+        failed = True
+        try:
+            async with self._get_session().post(stream_endpoint, json=payload) as response:
+                if response.status != 200:
+                    failed = response.status >= 500
+                    raise ChatbotStreamError(response.status, key)
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                first = True
+                async for data in response.content.iter_any():
+                    text = decoder.decode(data)
+                    if not text:
+                        continue
+                    if first:
+                        first = False
+                        self.first_chunk.setdefault(key, LatencyHistogram()).observe((time.perf_counter() - started) * 1000)
+                    yield text
+                tail = decoder.decode(b"", final=True)
+                if tail:
+                    yield tail
+                failed = False
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.latency.setdefault(key, LatencyHistogram()).observe(elapsed_ms, error=failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "endpoints": {endpoint: histogram.to_dict() for endpoint, histogram in sorted(self.latency.items())},
+            "first_chunk": {endpoint: histogram.to_dict() for endpoint, histogram in sorted(self.first_chunk.items())}
+        }
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,823 @@
+'''
+In-memory stand-in for the parts of the sync azure-cosmos SDK these apps use, so handlers and
+benchmarks run without a Cosmos account. Enable with COSMOS_DB_BACKEND=memory.
+
+Behaves like the service where the code depends on it: partition keys, _etag/_ts system properties,
+If-Match conditions, 404/409/412 errors (raised as the SDK's own exceptions), container and item TTL,
+a change feed without deletes, and paged queries reported through response_hook.
+Queries support the SQL subset used here: SELECT [TOP n] [VALUE] * | projections, FROM, WHERE with
+comparisons, AND/OR/NOT, IN and a few functions, ORDER BY and OFFSET/LIMIT.
+
+Every request sleeps COSMOS_DB_MEMORY_LATENCY_MS (+ up to COSMOS_DB_MEMORY_JITTER_MS) like a real round
+trip, and reports an approximate RU charge in x-ms-request-charge. The charges follow the published
+rules of thumb (1 RU per 1 KB point read, ~5.7 RU per 1 KB write, queries grow with documents scanned)
+and are only meant for comparing approaches.
+'''
+import logging
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError
+)
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import copy
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+DEFAULT_PAGE_SIZE = 100
+
+
+class _Undefined:
+    '''
+    Value of a missing property, comparisons against it are neither true nor false
+    '''
+    def __repr__(self):
+        return "undefined"
+
+
+UNDEFINED = _Undefined()
+
+
+def _size_kb(document: Any) -> float:
+    return len(json.dumps(document, default=str)) / 1024
+
+
+def _bad_request(message: str) -> CosmosHttpResponseError:
+    return CosmosHttpResponseError(status_code=400, message=message)
+
+
+# ---------------------------------------------------------------------------
+# SQL subset
+# ---------------------------------------------------------------------------
+
+_TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<param>@[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<op><=|>=|!=|<>|=|<|>|\(|\)|,|\.|\*|\[|\])
+    )""", re.VERBOSE)
+
+_KEYWORDS = {
+    "SELECT", "TOP", "VALUE", "DISTINCT", "FROM", "WHERE", "AND", "OR", "NOT", "IN", "BETWEEN",
+    "ORDER", "BY", "ASC", "DESC", "AS", "OFFSET", "LIMIT", "TRUE", "FALSE", "NULL", "UNDEFINED"
+}
+
+
+def _tokenize(sql: str) -> List[Tuple[str, Any]]:
+    tokens: List[Tuple[str, Any]] = []
+    position = 0
+    sql = sql.strip()
+    while position < len(sql):
+        match = _TOKEN_PATTERN.match(sql, position)
+        if not match or match.end() == position:
+            raise _bad_request(f"Syntax error near '{sql[position:position + 20]}'")
+        position = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("value", bytes(text[1:-1], "utf-8").decode("unicode_escape")))
+        elif kind == "number":
+            tokens.append(("value", float(text) if "." in text else int(text)))
+        elif kind == "name" and text.upper() in _KEYWORDS:
+            tokens.append(("keyword", text.upper()))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+
+class _Query:
+    def __init__(self):
+        self.top: Any = None
+        self.value = False
+        self.distinct = False
+        self.projections: Optional[List[Tuple[Callable, str]]] = None
+        self.aggregate: Optional[str] = None
+        self.alias = "c"
+        self.where: Optional[Callable] = None
+        self.order_by: List[Tuple[Callable, bool]] = []
+        self.offset: Any = None
+        self.limit: Any = None
+
+
+class _Parser:
+    '''
+    Recursive descent parser that compiles a query into closures over (document, parameters)
+    '''
+    def __init__(self, sql: str):
+        self.tokens = _tokenize(sql)
+        self.position = 0
+        self.query = _Query()
+
+    def peek(self, kind: str, text: Any = None) -> bool:
+        if self.position >= len(self.tokens):
+            return False
+        token_kind, token_text = self.tokens[self.position]
+        return token_kind == kind and (text is None or token_text == text)
+
+    def accept(self, kind: str, text: Any = None) -> Optional[Any]:
+        if self.peek(kind, text):
+            self.position += 1
+            return self.tokens[self.position - 1][1]
+        return None
+
+    def expect(self, kind: str, text: Any = None) -> Any:
+        value = self.accept(kind, text)
+        if value is None:
+            found = self.tokens[self.position][1] if self.position < len(self.tokens) else "end of query"
+            raise _bad_request(f"Syntax error, expected {text or kind} but found '{found}'")
+        return value
+
+    def parse(self) -> _Query:
+        query = self.query
+        self.expect("keyword", "SELECT")
+        if self.accept("keyword", "DISTINCT"):
+            query.distinct = True
+        if self.accept("keyword", "TOP"):
+            query.top = self.parse_literal_or_param()
+        if self.accept("keyword", "VALUE"):
+            query.value = True
+
+        # The FROM alias is only known after the select list, so skip it now and compile it afterwards
+        select_start = self.position
+        if ("keyword", "FROM") not in self.tokens[select_start:]:
+            raise _bad_request("Syntax error, missing FROM")
+        select_end = self.tokens.index(("keyword", "FROM"), select_start)
+        self.position = select_end
+
+        self.expect("keyword", "FROM")
+        source = self.expect("name")
+        self.accept("keyword", "AS")
+        query.alias = self.accept("name") or source
+
+        if self.accept("keyword", "WHERE"):
+            query.where = self.parse_or()
+        if self.accept("keyword", "ORDER"):
+            self.expect("keyword", "BY")
+            while True:
+                expression = self.parse_operand()
+                descending = bool(self.accept("keyword", "DESC"))
+                if not descending:
+                    self.accept("keyword", "ASC")
+                query.order_by.append((expression, descending))
+                if not self.accept("op", ","):
+                    break
+        if self.accept("keyword", "OFFSET"):
+            query.offset = self.parse_literal_or_param()
+            self.expect("keyword", "LIMIT")
+            query.limit = self.parse_literal_or_param()
+        if self.position != len(self.tokens):
+            raise _bad_request(f"Syntax error near '{self.tokens[self.position][1]}'")
+
+        end = self.position
+        self.position = select_start
+        self.tokens, tail = self.tokens[:select_end], self.tokens
+        self.parse_select_list()
+        if self.position != select_end:
+            raise _bad_request(f"Syntax error near '{self.tokens[self.position][1]}'")
+        self.tokens, self.position = tail, end
+        return query
+
+    def parse_select_list(self) -> None:
+        query = self.query
+        if self.accept("op", "*"):
+            query.projections = None
+            return
+        if query.value and self.peek("name") and self.tokens[self.position][1].upper() == "COUNT":
+            self.position += 1
+            self.expect("op", "(")
+            self.parse_operand()
+            self.expect("op", ")")
+            query.aggregate = "COUNT"
+            return
+        query.projections = []
+        while True:
+            expression, name = self.parse_operand(with_name=True)
+            if self.accept("keyword", "AS"):
+                name = self.expect("name")
+            query.projections.append((expression, name))
+            if not self.accept("op", ","):
+                break
+        if query.value and len(query.projections) != 1:
+            raise _bad_request("SELECT VALUE takes a single expression")
+
+    def parse_literal_or_param(self) -> Any:
+        if self.peek("param"):
+            name = self.expect("param")
+            return lambda parameters: parameters.get(name, UNDEFINED)
+        value = self.expect("value")
+        return lambda parameters: value
+
+    def parse_or(self) -> Callable:
+        left = self.parse_and()
+        while self.accept("keyword", "OR"):
+            right = self.parse_and()
+            left = (lambda l, r: lambda d, p: _or(l(d, p), r(d, p)))(left, right)
+        return left
+
+    def parse_and(self) -> Callable:
+        left = self.parse_not()
+        while self.accept("keyword", "AND"):
+            right = self.parse_not()
+            left = (lambda l, r: lambda d, p: _and(l(d, p), r(d, p)))(left, right)
+        return left
+
+    def parse_not(self) -> Callable:
+        if self.accept("keyword", "NOT"):
+            operand = self.parse_not()
+            return lambda d, p: (not operand(d, p)) if isinstance(operand(d, p), bool) else UNDEFINED
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> Callable:
+        left = self.parse_operand()
+        negate = bool(self.accept("keyword", "NOT"))
+        if self.accept("keyword", "IN"):
+            self.expect("op", "(")
+            options = [self.parse_operand()]
+            while self.accept("op", ","):
+                options.append(self.parse_operand())
+            self.expect("op", ")")
+            return lambda d, p: _negate(any(_compare("=", left(d, p), option(d, p)) is True for option in options), negate)
+        if self.accept("keyword", "BETWEEN"):
+            low = self.parse_operand()
+            self.expect("keyword", "AND")
+            high = self.parse_operand()
+            return lambda d, p: _negate(_and(_compare(">=", left(d, p), low(d, p)), _compare("<=", left(d, p), high(d, p))), negate)
+        if negate:
+            raise _bad_request("Syntax error near NOT")
+        for operator in ("=", "!=", "<>", "<=", ">=", "<", ">"):
+            if self.accept("op", operator):
+                right = self.parse_operand()
+                return lambda d, p: _compare(operator, left(d, p), right(d, p))
+        return left
+
+    def parse_operand(self, with_name: bool = False) -> Any:
+        name = None
+        if self.accept("op", "("):
+            expression = self.parse_or()
+            self.expect("op", ")")
+        elif self.peek("param"):
+            parameter = self.expect("param")
+            expression = lambda d, p: p.get(parameter, UNDEFINED)
+        elif self.peek("value"):
+            value = self.expect("value")
+            expression = lambda d, p: value
+        elif self.accept("keyword", "TRUE"):
+            expression = lambda d, p: True
+        elif self.accept("keyword", "FALSE"):
+            expression = lambda d, p: False
+        elif self.accept("keyword", "NULL"):
+            expression = lambda d, p: None
+        elif self.accept("keyword", "UNDEFINED"):
+            expression = lambda d, p: UNDEFINED
+        elif self.peek("name"):
+            identifier = self.expect("name")
+            if self.peek("op", "("):
+                expression = self.parse_function(identifier)
+                name = identifier
+            else:
+                path, name = self.parse_path(identifier)
+                expression = lambda d, p: _resolve(d, path)
+        else:
+            found = self.tokens[self.position][1] if self.position < len(self.tokens) else "end of query"
+            raise _bad_request(f"Syntax error near '{found}'")
+        return (expression, name or "$1") if with_name else expression
+
+    def parse_path(self, root: str) -> Tuple[List[Any], str]:
+        if root != self.query.alias:
+            raise _bad_request(f"Identifier '{root}' could not be resolved")
+        path: List[Any] = []
+        while True:
+            if self.accept("op", "."):
+                path.append(self.expect("name"))
+            elif self.accept("op", "["):
+                path.append(self.expect("value"))
+                self.expect("op", "]")
+            else:
+                break
+        return path, str(path[-1]) if path else root
+
+    def parse_function(self, name: str) -> Callable:
+        function = _FUNCTIONS.get(name.upper())
+        if function is None:
+            raise _bad_request(f"Unsupported function {name}")
+        self.expect("op", "(")
+        arguments = []
+        if not self.accept("op", ")"):
+            arguments.append(self.parse_or())
+            while self.accept("op", ","):
+                arguments.append(self.parse_or())
+            self.expect("op", ")")
+        return lambda d, p: function(*[argument(d, p) for argument in arguments])
+
+
+def _resolve(document: Any, path: List[Any]) -> Any:
+    value = document
+    for segment in path:
+        if isinstance(value, dict) and isinstance(segment, str) and segment in value:
+            value = value[segment]
+        elif isinstance(value, list) and isinstance(segment, int) and 0 <= segment < len(value):
+            value = value[segment]
+        else:
+            return UNDEFINED
+    return value
+
+
+def _type_rank(value: Any) -> Optional[int]:
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    return None
+
+
+def _compare(operator: str, left: Any, right: Any) -> Any:
+    if left is UNDEFINED or right is UNDEFINED:
+        return UNDEFINED
+    if operator in ("=", "!=", "<>"):
+        equal = left == right and _type_rank(left) == _type_rank(right)
+        return equal if operator == "=" else not equal
+    if _type_rank(left) is None or _type_rank(left) != _type_rank(right):
+        return UNDEFINED
+    return {"<": left < right, ">": left > right, "<=": left <= right, ">=": left >= right}[operator]
+
+
+def _and(left: Any, right: Any) -> Any:
+    if left is False or right is False:
+        return False
+    if left is True and right is True:
+        return True
+    return UNDEFINED
+
+
+def _or(left: Any, right: Any) -> Any:
+    if left is True or right is True:
+        return True
+    if left is False and right is False:
+        return False
+    return UNDEFINED
+
+
+def _negate(value: Any, negate: bool) -> Any:
+    if not negate or not isinstance(value, bool):
+        return value
+    return not value
+
+
+def _string_function(function: Callable[..., Any]) -> Callable[..., Any]:
+    def wrapper(*arguments):
+        if not all(isinstance(argument, str) for argument in arguments[:2]):
+            return UNDEFINED
+        return function(*arguments)
+    return wrapper
+
+
+_FUNCTIONS: Dict[str, Callable[..., Any]] = {
+    "IS_DEFINED": lambda value: value is not UNDEFINED,
+    "IS_NULL": lambda value: value is None,
+    "ARRAY_CONTAINS": lambda array, value, *_: value in array if isinstance(array, list) else UNDEFINED,
+    "ARRAY_LENGTH": lambda array: len(array) if isinstance(array, list) else UNDEFINED,
+    "CONTAINS": _string_function(lambda text, part, ignore_case=False: part.lower() in text.lower() if ignore_case else part in text),
+    "STARTSWITH": _string_function(lambda text, part, ignore_case=False: text.lower().startswith(part.lower()) if ignore_case else text.startswith(part)),
+    "ENDSWITH": _string_function(lambda text, part, ignore_case=False: text.lower().endswith(part.lower()) if ignore_case else text.endswith(part)),
+    "LOWER": _string_function(lambda text: text.lower()),
+    "UPPER": _string_function(lambda text: text.upper()),
+    "LENGTH": _string_function(lambda text: len(text)),
+}
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    # undefined < null < false/true < numbers < strings < arrays/objects, like Cosmos ORDER BY
+    if value is UNDEFINED:
+        return (-1, 0)
+    rank = _type_rank(value)
+    if rank is None:
+        return (4, 0)
+    return (rank, 0 if value is None else value)
+
+
+# ---------------------------------------------------------------------------
+# Client, database, container
+# ---------------------------------------------------------------------------
+
+class MemoryContainer:
+    '''
+    Thread-safe in-memory ContainerProxy: the SDK is called from the cosmos executor threads
+    '''
+    def __init__(self, client: 'MemoryCosmosClient', database_id: str, id: str, partition_key_path: str, default_ttl: Optional[int] = None):
+        self._client = client
+        self.database_id = database_id
+        self.id = id
+        self.partition_key_path = partition_key_path
+        self.default_ttl = default_ttl
+        self._items: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self._lsn = 0
+        self.request_charge = 0.0
+        self.requests = 0
+
+    # -- plumbing --
+
+    def _partition_value(self, body: Dict[str, Any]) -> Any:
+        value = _resolve(body, self.partition_key_path.strip("/").split("/"))
+        return None if value is UNDEFINED else value
+
+    @staticmethod
+    def _key(item_id: str, partition_key: Any) -> Tuple[str, str]:
+        return (json.dumps(partition_key), str(item_id))
+
+    def _expired(self, document: Dict[str, Any], now: float) -> bool:
+        if self.default_ttl is None:
+            return False
+        ttl = document.get("ttl", self.default_ttl)
+        if not isinstance(ttl, (int, float)) or ttl < 0:
+            return False
+        return document["_ts"] + ttl <= now
+
+    def _live(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        document = self._items.get(key)
+        if document is not None and self._expired(document, time.time()):
+            del self._items[key]
+            return None
+        return document
+
+    def _respond(self, response_hook: Optional[Callable], request_charge: float, result: Any, started: float, item_count: Optional[int] = None) -> None:
+        self._client.wait()
+        self.requests += 1
+        self.request_charge += request_charge
+        if response_hook:
+            headers = {
+                "x-ms-request-charge": f"{request_charge:.2f}",
+                "x-ms-request-duration-ms": f"{(time.perf_counter() - started) * 1000:.3f}",
+                "x-ms-activity-id": str(uuid.uuid4())
+            }
+            if item_count is not None:
+                headers["x-ms-item-count"] = str(item_count)
+            if isinstance(result, dict) and "_etag" in result:
+                headers["etag"] = result["_etag"]
+            response_hook(headers, result)
+
+    def _check_condition(self, current: Optional[Dict[str, Any]], etag: Optional[str], match_condition: Optional[MatchConditions]) -> None:
+        if match_condition == MatchConditions.IfNotModified and (current is None or current.get("_etag") != etag):
+            raise CosmosAccessConditionFailedError(status_code=412, message="Operation cannot be performed because one of the specified precondition is not met.")
+        if match_condition == MatchConditions.IfModified and current is not None and current.get("_etag") == etag:
+            raise CosmosHttpResponseError(status_code=304, message="Not modified")
+
+    def _write(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        if not isinstance(body.get("id"), str) or not body["id"]:
+            raise _bad_request("The input content is invalid because the required properties - 'id; ' - are missing")
+        self._lsn += 1
+        document = copy.deepcopy(body)
+        for system_property in ("_rid", "_self", "_attachments"):
+            document.pop(system_property, None)
+        document["_etag"] = f'"{uuid.uuid4()}"'
+        document["_ts"] = int(time.time())
+        document["_lsn"] = self._lsn
+        self._items[self._key(document["id"], self._partition_value(document))] = document
+        return document
+
+    def _not_found(self) -> CosmosResourceNotFoundError:
+        return CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+
+    # -- point operations --
+
+    def read_item(self, item: Any, partition_key: Any, response_hook: Optional[Callable] = None, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        item_id = item["id"] if isinstance(item, dict) else item
+        with self._lock:
+            document = self._live(self._key(item_id, partition_key))
+            result = copy.deepcopy(document) if document is not None else None
+        if result is None:
+            self._respond(None, 1.0, None, started)
+            raise self._not_found()
+        self._check_condition(result, etag, match_condition)
+        self._respond(response_hook, max(1.0, math.ceil(_size_kb(result))), result, started)
+        return result
+
+    def read(self, response_hook: Optional[Callable] = None, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        properties = {"id": self.id, "partitionKey": {"paths": [self.partition_key_path]}, "defaultTtl": self.default_ttl}
+        self._respond(response_hook, 1.0, properties, started)
+        return properties
+
+    def create_item(self, body: Dict[str, Any], response_hook: Optional[Callable] = None, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        with self._lock:
+            exists = self._live(self._key(body.get("id"), self._partition_value(body))) is not None
+            result = None if exists else copy.deepcopy(self._write(body))
+        if exists:
+            self._respond(None, 1.0, None, started)
+            raise CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists in the system.")
+        self._respond(response_hook, self._write_charge(result), result, started)
+        return result
+
+    def upsert_item(self, body: Dict[str, Any], response_hook: Optional[Callable] = None, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        with self._lock:
+            current = self._live(self._key(body.get("id"), self._partition_value(body)))
+            if match_condition is not None:
+                self._check_condition(current, etag, match_condition)
+            result = copy.deepcopy(self._write(body))
+        self._respond(response_hook, self._write_charge(result), result, started)
+        return result
+
+    def replace_item(self, item: Any, body: Dict[str, Any], response_hook: Optional[Callable] = None, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        item_id = item["id"] if isinstance(item, dict) else item
+        if body.get("id") != item_id:
+            raise _bad_request("The id in the body does not match the item being replaced")
+        with self._lock:
+            current = self._live(self._key(item_id, self._partition_value(body)))
+            if current is None:
+                raise self._not_found()
+            self._check_condition(current, etag, match_condition)
+            result = copy.deepcopy(self._write(body))
+        self._respond(response_hook, self._write_charge(result), result, started)
+        return result
+
+    def patch_item(
+        self,
+        item: Any,
+        partition_key: Any,
+        patch_operations: List[Dict[str, Any]],
+        filter_predicate: Optional[str] = None,
+        response_hook: Optional[Callable] = None,
+        etag: Optional[str] = None,
+        match_condition: Optional[MatchConditions] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        started = time.perf_counter()
+        item_id = item["id"] if isinstance(item, dict) else item
+        if len(patch_operations) > 10:
+            raise _bad_request("Patch request has more than 10 operations")
+        with self._lock:
+            current = self._live(self._key(item_id, partition_key))
+            if current is None:
+                raise self._not_found()
+            self._check_condition(current, etag, match_condition)
+            if filter_predicate and _Parser(f"SELECT * {filter_predicate}").parse().where(current, {}) is not True:
+                raise CosmosAccessConditionFailedError(status_code=412, message="Precondition of the patch filter predicate is not met.")
+            document = copy.deepcopy(current)
+            for operation in patch_operations:
+                _apply_patch(document, operation)
+            if self._partition_value(document) != partition_key or document.get("id") != item_id:
+                raise _bad_request("Patch cannot modify the id or the partition key")
+            result = copy.deepcopy(self._write(document))
+        self._respond(response_hook, self._write_charge(result) + 0.5 * len(patch_operations), result, started)
+        return result
+
+    def delete_item(self, item: Any, partition_key: Any, response_hook: Optional[Callable] = None, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None, **kwargs) -> None:
+        started = time.perf_counter()
+        item_id = item["id"] if isinstance(item, dict) else item
+        with self._lock:
+            key = self._key(item_id, partition_key)
+            current = self._live(key)
+            if current is None:
+                raise self._not_found()
+            self._check_condition(current, etag, match_condition)
+            del self._items[key]
+        self._respond(response_hook, self._write_charge(current), None, started)
+
+    @staticmethod
+    def _write_charge(document: Dict[str, Any]) -> float:
+        return round(5.7 * max(1.0, math.ceil(_size_kb(document))), 2)
+
+    # -- queries --
+
+    def query_items(
+        self,
+        query: str,
+        parameters: Optional[List[Dict[str, Any]]] = None,
+        partition_key: Any = None,
+        enable_cross_partition_query: Optional[bool] = None,
+        max_item_count: Optional[int] = None,
+        response_hook: Optional[Callable] = None,
+        **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        parsed = _Parser(query).parse()
+        values = {parameter["name"]: parameter["value"] for parameter in (parameters or [])}
+        started = time.perf_counter()
+        with self._lock:
+            now = time.time()
+            candidates = [
+                copy.deepcopy(document) for key, document in list(self._items.items())
+                if not self._expired(document, now)
+                and (partition_key is None or key[0] == json.dumps(partition_key))
+            ]
+        results = _execute(parsed, candidates, values)
+        # Scanning cost grows with the documents touched, fanning out over partitions costs extra
+        request_charge = 2.3 + 0.01 * len(candidates) + _size_kb(results) + (0.0 if partition_key is not None else 0.5)
+        return self._pages(results, max_item_count or DEFAULT_PAGE_SIZE, request_charge, response_hook, started)
+
+    def _pages(self, results: List[Any], page_size: int, request_charge: float, response_hook: Optional[Callable], started: float) -> Iterator[Any]:
+        page_size = page_size if page_size > 0 else DEFAULT_PAGE_SIZE
+        for start in range(0, max(len(results), 1), page_size):
+            page = results[start:start + page_size]
+            charge = request_charge if start == 0 else 1.0 + _size_kb(page)
+            self._respond(response_hook, round(charge, 2), {"Documents": page, "_count": len(page)}, started, item_count=len(page))
+            started = time.perf_counter()
+            for document in page:
+                yield document
+
+    def query_items_change_feed(
+        self,
+        start_time: Any = None,
+        is_start_from_beginning: bool = False,
+        partition_key: Any = None,
+        max_item_count: Optional[int] = None,
+        response_hook: Optional[Callable] = None,
+        **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        '''
+        Latest version of every item modified since start_time, in modification order.
+        Like the service's latest-version mode, deletes and TTL expiries are not reported.
+        '''
+        started = time.perf_counter()
+        if is_start_from_beginning or start_time == "Beginning":
+            since = 0.0
+        elif start_time is None or start_time == "Now":
+            since = time.time()
+        elif isinstance(start_time, datetime):
+            since = (start_time if start_time.tzinfo else start_time.replace(tzinfo=timezone.utc)).timestamp()
+        else:
+            raise _bad_request(f"Unsupported change feed start_time {start_time!r}")
+        with self._lock:
+            now = time.time()
+            changes = sorted(
+                (copy.deepcopy(document) for key, document in self._items.items()
+                 if document["_ts"] >= math.floor(since) and not self._expired(document, now)
+                 and (partition_key is None or key[0] == json.dumps(partition_key))),
+                key=lambda document: document["_lsn"]
+            )
+        return self._pages(changes, max_item_count or DEFAULT_PAGE_SIZE, 1.0 + _size_kb(changes), response_hook, started)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"items": len(self._items), "requests": self.requests, "ru": round(self.request_charge, 2)}
+
+
+def _execute(query: _Query, documents: List[Dict[str, Any]], parameters: Dict[str, Any]) -> List[Any]:
+    if query.where is not None:
+        documents = [document for document in documents if query.where(document, parameters) is True]
+    for expression, descending in reversed(query.order_by):
+        documents.sort(key=lambda document: _sort_key(expression(document, parameters)), reverse=descending)
+
+    if query.aggregate == "COUNT":
+        return [len(documents)]
+
+    if query.projections is None:
+        results: List[Any] = documents
+    elif query.value:
+        expression = query.projections[0][0]
+        results = [value for value in (expression(document, parameters) for document in documents) if value is not UNDEFINED]
+    else:
+        results = []
+        for document in documents:
+            projected = {}
+            for expression, name in query.projections:
+                value = expression(document, parameters)
+                if value is not UNDEFINED:
+                    projected[name] = value
+            results.append(projected)
+
+    if query.distinct:
+        seen = set()
+        unique = []
+        for result in results:
+            marker = json.dumps(result, sort_keys=True, default=str)
+            if marker not in seen:
+                seen.add(marker)
+                unique.append(result)
+        results = unique
+    if query.offset is not None:
+        offset, limit = query.offset(parameters), query.limit(parameters)
+        results = results[offset:offset + limit]
+    if query.top is not None:
+        results = results[:query.top(parameters)]
+    return results
+
+
+def _apply_patch(document: Dict[str, Any], operation: Dict[str, Any]) -> None:
+    op = operation.get("op")
+    segments = [int(segment) if segment.isdigit() else segment for segment in operation.get("path", "").strip("/").split("/")]
+    if not segments or segments == [""]:
+        raise _bad_request("Patch path is required")
+    parent = _resolve(document, segments[:-1])
+    last = segments[-1]
+    if parent is UNDEFINED or not isinstance(parent, (dict, list)):
+        raise _bad_request(f"Patch path {operation.get('path')} does not exist")
+    exists = (isinstance(parent, dict) and last in parent) or (isinstance(parent, list) and isinstance(last, int) and last < len(parent))
+
+    if op in ("set", "add"):
+        if isinstance(parent, list) and op == "add":
+            parent.insert(last if isinstance(last, int) else len(parent), operation["value"])
+        else:
+            parent[last] = operation["value"]
+    elif op == "replace":
+        if not exists:
+            raise _bad_request(f"Patch path {operation.get('path')} does not exist")
+        parent[last] = operation["value"]
+    elif op == "remove":
+        if not exists:
+            raise _bad_request(f"Patch path {operation.get('path')} does not exist")
+        del parent[last]
+    elif op == "incr":
+        current = parent[last] if exists else 0
+        if not isinstance(current, (int, float)) or not isinstance(operation.get("value"), (int, float)):
+            raise _bad_request("Patch incr needs a number")
+        parent[last] = current + operation["value"]
+    else:
+        raise _bad_request(f"Unsupported patch operation {op}")
+
+
+class MemoryDatabase:
+    def __init__(self, client: 'MemoryCosmosClient', id: str):
+        self._client = client
+        self.id = id
+        self._containers: Dict[str, MemoryContainer] = {}
+        self._lock = threading.Lock()
+
+    def create_container_if_not_exists(self, id: str, partition_key: Any, default_ttl: Optional[int] = None, **kwargs) -> MemoryContainer:
+        self._client.wait()
+        with self._lock:
+            if id not in self._containers:
+                path = partition_key["paths"][0] if isinstance(partition_key, dict) else partition_key.path
+                self._containers[id] = MemoryContainer(self._client, self.id, id, path, default_ttl)
+                self._client.seed(self._containers[id])
+            return self._containers[id]
+
+    def get_container_client(self, container: str) -> MemoryContainer:
+        with self._lock:
+            if container not in self._containers:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Container {container} does not exist, provision it first")
+            return self._containers[container]
+
+
+class MemoryCosmosClient:
+    '''
+    Process-local account. All CosmosDB handles of a process share one instance so their data agrees.
+    '''
+    _instance: Optional['MemoryCosmosClient'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, seed: Optional[Dict[str, List[Dict[str, Any]]]] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self._seed = seed or {}
+        self._databases: Dict[str, MemoryDatabase] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls) -> 'MemoryCosmosClient':
+        with cls._instance_lock:
+            if cls._instance is None:
+                seed = None
+                seed_path = os.getenv("COSMOS_DB_MEMORY_SEED")
+                if seed_path:
+                    with open(seed_path, "r") as seed_file:
+                        seed = json.load(seed_file)
+                cls._instance = cls(
+                    latency_ms=float(os.getenv("COSMOS_DB_MEMORY_LATENCY_MS", "0")),
+                    jitter_ms=float(os.getenv("COSMOS_DB_MEMORY_JITTER_MS", "0")),
+                    seed=seed
+                )
+                logging.warning(f"Using in-memory Cosmos DB (latency {cls._instance.latency_ms}ms)")
+            return cls._instance
+
+    def wait(self) -> None:
+        # Blocking on purpose, like the sync SDK this stands in for
+        delay = self.latency_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def seed(self, container: MemoryContainer) -> None:
+        for document in self._seed.get(container.id, []):
+            with container._lock:
+                container._write(document)
+
+    def create_database_if_not_exists(self, id: str, **kwargs) -> MemoryDatabase:
+        self.wait()
+        with self._lock:
+            if id not in self._databases:
+                self._databases[id] = MemoryDatabase(self, id)
+            return self._databases[id]
+
+    def get_database_client(self, database: str) -> MemoryDatabase:
+        with self._lock:
+            if database not in self._databases:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Database {database} does not exist, provision it first")
+            return self._databases[database]
@@ -103,7 +103,7 @@ class BackendException(Exception):
         self.field = field
         self.message = message
         self.error_code = error_code
-        self.status_code = int(self.error_code.value[-3:-1])
+        self.status_code = int(self.error_code.value[-3:])
         self.details = details or {}
         
         self._formatted_message = (
@@ -147,7 +147,7 @@ class TelegramException(Exception):
         self.field = field
         self.message = message
         self.error_code = error_code
-        self.status_code = int(self.error_code.value[-3:-1])
+        self.status_code = int(self.error_code.value[-3:])
         self.details = details or {}
         
         self._formatted_message = (
@@ -1,8 +1,20 @@
 from typing import Any
 from dotenv import load_dotenv
-from telegramClient import TelegramClient
+from telegramClient import TelegramClient, router
+from _common import inline_replies
+from repository import chatbot_cache
+from catalog import telegram_catalog
+from botApiClient import BotApiClient
+from chatbotClient import ChatbotClient
+from chatLock import chat_lock
+from responseCache import response_cache
+from singleflight import chatbot_queries
+from updateDedup import update_dedup
+from updateQueue import MAX_ATTEMPTS, QUEUE_CONNECTION_SETTING, QUEUE_NAME, TELEGRAM_UPDATE_QUEUE, update_queue
+from metrics import operation_stats, track_invocation
 import azure.functions as func
 import logging
+import json
 import os
 
 # Instantiate function app
@@ -19,9 +31,31 @@ def get_health_status(req: func.HttpRequest) -> func.HttpResponse:
             status_code=200
     )
 
+@app.route(route="cache/stats", auth_level=func.AuthLevel.ANONYMOUS)
+def get_cache_stats(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+            body=json.dumps({"chatbots": chatbot_cache.stats(), "catalog": telegram_catalog.stats(), "cosmos": operation_stats(), "forwarding": ChatbotClient.shared().stats(), "chat_lock": chat_lock.stats(), "responses": response_cache.stats(), "coalescing": chatbot_queries.stats(), "dedup": update_dedup.stats(), "routes": router.stats(), "telegram_api": BotApiClient.shared().stats()}),
+            mimetype="application/json",
+            status_code=200
+    )
+
 # Regular HTTP-triggered functions
 @app.route(route="telegram")
 async def process_telegram_message(req: func.HttpRequest) -> func.HttpResponse:
     logging.warning('Python HTTP trigger function "processTelegramMessage" processed a request.')
     theClient = TelegramClient()
-    return await theClient._process_message(req)
\ No newline at end of file
+    queue = update_queue()
+    if queue is not None:
+        return await theClient._enqueue_message(req, queue)
+    with track_invocation("telegram"), inline_replies():
+        return await theClient._process_message(req)
+
+# Queue ingestion (TELEGRAM_UPDATE_QUEUE=azure): updates queued by the webhook are handled here,
+# host.json bounds how many run at once per instance. Raising hands the message back for a retry,
+# after maxDequeueCount attempts the host moves it to the poison queue
+if TELEGRAM_UPDATE_QUEUE == "azure":
+    @app.queue_trigger(arg_name="msg", queue_name=QUEUE_NAME, connection=QUEUE_CONNECTION_SETTING)
+    async def process_telegram_update(msg: func.QueueMessage) -> None:
+        logging.warning(f'Python queue trigger function "processTelegramUpdate" processed update {msg.id}.')
+        theClient = TelegramClient()
+        await theClient._process_queued_update(msg.get_json(), final_attempt=(msg.dequeue_count or 1) >= MAX_ATTEMPTS)
\ No newline at end of file
@@ -0,0 +1,124 @@
+'''
+Splits chatbot responses into Telegram sized messages.
+
+Text is broken on paragraph boundaries first, fenced code blocks are kept whole when they fit and
+otherwise split on lines with the fence re-opened in every part. Lines longer than a message fall back
+to word boundaries, and only unbroken runs of text are cut mid-word.
+'''
+from typing import List
+import os
+
+# Telegram's limit on message text, counted in UTF-16 code units
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+# Above this many parts the response is uploaded as a document instead (TELEGRAM_DOCUMENT_FALLBACK)
+MAX_MESSAGE_PARTS = int(os.getenv("TELEGRAM_MAX_MESSAGE_PARTS", "5"))
+DOCUMENT_FALLBACK = os.getenv("TELEGRAM_DOCUMENT_FALLBACK", "true").lower() == "true"
+
+_FENCE = "```"
+
+
+def telegram_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _cut(text: str, limit: int) -> List[str]:
+    parts, current, size = [], [], 0
+    for char in text:
+        width = 2 if ord(char) > 0xFFFF else 1
+        if size + width > limit:
+            parts.append("".join(current))
+            current, size = [], 0
+        current.append(char)
+        size += width
+    if current:
+        parts.append("".join(current))
+    return parts
+
+
+def _pack(pieces: List[str], separator: str, limit: int) -> List[str]:
+    '''
+    Greedily join pieces (each within limit) into as few parts as possible
+    '''
+    parts: List[str] = []
+    current = None
+    for piece in pieces:
+        candidate = piece if current is None else f"{current}{separator}{piece}"
+        if telegram_length(candidate) <= limit:
+            current = candidate
+        else:
+            if current is not None:
+                parts.append(current)
+            current = piece
+    if current is not None:
+        parts.append(current)
+    return parts
+
+
+def _fit_text(text: str, limit: int) -> List[str]:
+    if telegram_length(text) <= limit:
+        return [text]
+    for separator in ("\n", " "):
+        if separator in text:
+            pieces = [fitted for piece in text.split(separator) for fitted in _fit_text(piece, limit)]
+            return _pack(pieces, separator, limit)
+    return _cut(text, limit)
+
+
+def _fit_code(block: str, limit: int) -> List[str]:
+    lines = block.split("\n")
+    header = lines[0]
+    body = lines[1:-1] if len(lines) > 1 and lines[-1].strip() == _FENCE else lines[1:]
+    budget = limit - telegram_length(header) - telegram_length(_FENCE) - 2
+    if budget <= 0:
+        return _fit_text(block, limit)
+    return [f"{header}\n{chunk}\n{_FENCE}" for chunk in _fit_text("\n".join(body), budget)]
+
+
+def _blocks(text: str) -> List[str]:
+    '''
+    Paragraphs and fenced code blocks in order, blank lines inside a code block do not end it
+    '''
+    blocks: List[str] = []
+    current: List[str] = []
+    in_code = False
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if in_code:
+            current.append(line)
+            if stripped == _FENCE:
+                blocks.append("\n".join(current))
+                current, in_code = [], False
+        elif stripped.startswith(_FENCE):
+            if current:
+                blocks.append("\n".join(current))
+            current, in_code = [line], True
+        elif stripped == "":
+            if current:
+                blocks.append("\n".join(current))
+            current = []
+        else:
+            current.append(line)
+    if current:
+        blocks.append("\n".join(current))
+    return blocks
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    '''
+    Split text into parts of at most limit UTF-16 code units, text within the limit is returned unchanged.
+    Never empty: callers index the first part
+    '''
+    if telegram_length(text) <= limit:
+        return [text]
+    pieces: List[str] = []
+    for block in _blocks(text):
+        if telegram_length(block) <= limit:
+            pieces.append(block)
+        elif block.lstrip().startswith(_FENCE):
+            pieces.extend(_fit_code(block, limit))
+        else:
+            pieces.extend(_fit_text(block, limit))
+    # Telegram rejects empty messages, blank text is cut to the limit like short blank text is passed through
+    parts = [part for part in _pack(pieces, "\n\n", limit) if part.strip()]
+    return parts or _cut(text, limit)[:1]
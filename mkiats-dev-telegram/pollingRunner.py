@@ -0,0 +1,207 @@
+'''
+Standalone bot runner for use outside Azure Functions: long-polls getUpdates and hands the updates to the
+same handlers the webhook uses.
+
+    python pollingRunner.py
+
+Updates arrive in batches of up to TELEGRAM_POLL_LIMIT. They run on TELEGRAM_WORKER_CONCURRENCY workers:
+different chats in parallel, each chat's updates strictly one after another in update_id order. Polling
+pauses while TELEGRAM_POLL_MAX_PENDING updates are waiting, so a slow chatbot cannot grow the backlog
+without bound.
+
+Telegram refuses getUpdates while a webhook is set. Set TELEGRAM_POLL_DELETE_WEBHOOK=true to remove it
+on start. Updates are confirmed to Telegram once they are handed to a worker, and updates still waiting
+when the process dies are lost. SIGINT/SIGTERM stops polling and lets the waiting updates finish.
+TELEGRAM_API_URL can point at a fake Bot API for load tests (see benchmarks/polling_load.py).
+'''
+import logging
+from dotenv import load_dotenv
+
+# Settings are read when the modules below are imported, load .env first
+load_dotenv()
+
+from botApiClient import BotApiClient
+from collections import deque
+from metrics import LatencyHistogram, track_invocation
+from telegramClient import TelegramClient
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+from updateQueue import WORKER_CONCURRENCY
+import asyncio
+import os
+import signal
+import time
+
+POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", "30"))
+POLL_LIMIT = int(os.getenv("TELEGRAM_POLL_LIMIT", "100"))
+POLL_MAX_PENDING = int(os.getenv("TELEGRAM_POLL_MAX_PENDING", "1000"))
+POLL_DELETE_WEBHOOK = os.getenv("TELEGRAM_POLL_DELETE_WEBHOOK", "false").lower() == "true"
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+
+def _chat_of(payload: Dict[str, Any]) -> Any:
+    message = payload.get("message") or (payload.get("callback_query") or {}).get("message") or {}
+    return (message.get("chat") or {}).get("id")
+
+
+class PollingRunner:
+    '''
+    Every chat with waiting updates sits in the ready queue at most once. A worker takes a chat, handles
+    its oldest update and puts the chat back if more are waiting, which keeps each chat in order while
+    the workers spread over different chats.
+    '''
+    def __init__(
+        self,
+        handler: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None,
+        concurrency: int = WORKER_CONCURRENCY,
+        max_pending: int = POLL_MAX_PENDING
+    ):
+        self.handler = handler or TelegramClient._process_update
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._chats: Dict[Any, Deque[Dict[str, Any]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._space: Optional[asyncio.Condition] = None
+        self._offset: Optional[int] = None
+        self._poller: Optional[asyncio.Task] = None
+        self.pending = 0
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+        self.batches = 0
+        self.handle_latency = LatencyHistogram()
+        self.started_at = time.monotonic()
+
+    async def run(self) -> None:
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        if POLL_DELETE_WEBHOOK:
+            await BotApiClient.shared().call("deleteWebhook")
+        loop = asyncio.get_running_loop()
+        workers = [loop.create_task(self._work()) for _ in range(self.concurrency)]
+        self._poller = loop.create_task(self._poll_forever())
+        logging.warning(f"Polling Telegram with {self.concurrency} workers")
+        try:
+            await self._poller
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self._drain()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await BotApiClient.shared().close()
+            logging.warning(f"Polling stopped: {self.stats()}")
+
+    def stop(self) -> None:
+        '''
+        Stop polling, including a long poll in progress. run() returns once the waiting updates are handled
+        '''
+        if self._poller is not None:
+            self._poller.cancel()
+
+    async def _poll_forever(self) -> None:
+        while True:
+            await self._wait_for_space()
+            try:
+                updates = await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error polling Telegram updates: {str(e)}")
+                await asyncio.sleep(1.0)
+                continue
+            self._accept(updates)
+
+    async def _poll(self) -> List[Dict[str, Any]]:
+        # Never take in more than there is room for, so pending stays within max_pending
+        limit = max(1, min(POLL_LIMIT, self.max_pending - self.pending))
+        payload = {"timeout": POLL_TIMEOUT, "limit": limit, "allowed_updates": ALLOWED_UPDATES}
+        if self._offset is not None:
+            # Confirms every update below the offset, Telegram will not send those again
+            payload["offset"] = self._offset
+        response = await BotApiClient.shared().call("getUpdates", json=payload, read_timeout=POLL_TIMEOUT + 10)
+        if response.status_code == 409:
+            raise Exception("getUpdates conflicts with a webhook or another poller, set TELEGRAM_POLL_DELETE_WEBHOOK=true or stop the other poller")
+        if not response.ok:
+            raise Exception(f"getUpdates failed with {response.status_code}: {response.body[:200]!r}")
+        return response.json().get("result", [])
+
+    def _accept(self, updates: List[Dict[str, Any]]) -> None:
+        if updates:
+            self.batches += 1
+        for payload in updates:
+            update_id = payload.get("update_id")
+            if isinstance(update_id, int):
+                self._offset = max(self._offset or 0, update_id + 1)
+            if not TelegramClient.is_supported_update(payload):
+                continue
+            self.received += 1
+            chat_id = _chat_of(payload)
+            waiting = self._chats.get(chat_id)
+            if waiting is None:
+                # Not queued and not being handled, make the chat ready
+                waiting = self._chats[chat_id] = deque()
+                self._ready.put_nowait(chat_id)
+            waiting.append(payload)
+            self.pending += 1
+
+    async def _wait_for_space(self) -> None:
+        async with self._space:
+            await self._space.wait_for(lambda: self.pending < self.max_pending)
+
+    async def _work(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            waiting = self._chats[chat_id]
+            payload = waiting.popleft()
+            started = time.perf_counter()
+            failed = True
+            try:
+                with track_invocation("telegram"):
+                    await self.handler(payload)
+                failed = False
+            except Exception as e:
+                logging.error(f"Error handling polled update {payload.get('update_id')}: {str(e)}")
+            finally:
+                self.handle_latency.observe((time.perf_counter() - started) * 1000, error=failed)
+                self.processed += 1
+                self.errors += int(failed)
+                if waiting:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chats[chat_id]
+                self.pending -= 1
+                async with self._space:
+                    self._space.notify_all()
+
+    async def _drain(self) -> None:
+        async with self._space:
+            await self._space.wait_for(lambda: self.pending == 0)
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "errors": self.errors,
+            "batches": self.batches,
+            "pending": self.pending,
+            "chats": len(self._chats),
+            "updates_per_second": round(self.processed / elapsed, 2) if elapsed else 0.0,
+            "handle": self.handle_latency.to_dict()
+        }
+
+
+async def main() -> None:
+    runner = PollingRunner()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, runner.stop)
+        except NotImplementedError:
+            pass
+    await runner.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
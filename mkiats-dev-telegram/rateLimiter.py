@@ -0,0 +1,128 @@
+import logging
+from metrics import LatencyHistogram
+from typing import Any, Dict, Hashable, Optional
+import asyncio
+import os
+import time
+
+
+class _Bucket:
+    '''
+    Token bucket kept as a single "theoretical arrival time" (GCRA): a send may go at tat - tolerance,
+    every send pushes tat one interval further. Reserving is synchronous, so callers on the event loop
+    each get their own slot without a lock.
+    '''
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self.tat = 0.0
+        self.blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        send_at = max(now, self.tat - self.tolerance)
+        self.tat = max(self.tat, send_at) + self.interval
+        return send_at
+
+    def defer(self, until: float) -> None:
+        # Nothing may go out before until, and the burst allowance is spent. Sends that reserved
+        # their slot before the 429 see blocked_until when they wake up and reserve again
+        self.tat = max(self.tat, until + self.tolerance)
+        self.blocked_until = max(self.blocked_until, until)
+
+
+class RateLimiter:
+    '''
+    Outbound pacing for the Bot API: a global bucket for the whole bot (~30 messages/s) and one bucket
+    per chat (~1 message/s). Telegram's 429 retry_after defers the chat it was returned for, or the
+    whole bot when the call had no chat. Waiting callers and their wait times are tracked for cache/stats.
+    '''
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+        chat_rate: Optional[float] = None,
+        chat_burst: Optional[int] = None
+    ):
+        self.rate = rate if rate is not None else float(os.getenv("TELEGRAM_RATE_LIMIT", "30"))
+        self.burst = burst if burst is not None else int(os.getenv("TELEGRAM_RATE_BURST", "30"))
+        self.chat_rate = chat_rate if chat_rate is not None else float(os.getenv("TELEGRAM_CHAT_RATE_LIMIT", "1"))
+        self.chat_burst = chat_burst if chat_burst is not None else int(os.getenv("TELEGRAM_CHAT_RATE_BURST", "3"))
+        self._global = _Bucket(self.rate, self.burst)
+        self._chats: Dict[Hashable, _Bucket] = {}
+        self.waiting = 0
+        self.max_waiting = 0
+        self.deferrals = 0
+        self.wait = LatencyHistogram()
+
+    def _chat_bucket(self, chat_id: Hashable, now: float) -> _Bucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                # Idle chats have a tat in the past, their buckets carry no state worth keeping
+                self._chats = {key: value for key, value in self._chats.items() if value.tat > now}
+            bucket = self._chats[chat_id] = _Bucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id: Optional[Hashable] = None) -> float:
+        '''
+        Wait until a message to chat_id may be sent, returns the time waited in ms
+        '''
+        started = time.monotonic()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            chat = self._chat_bucket(chat_id, started) if chat_id is not None else None
+            while True:
+                # Per-chat slot first, then a global slot from that moment on
+                if chat is not None:
+                    await self._sleep_until(chat.reserve(time.monotonic()))
+                await self._sleep_until(self._global.reserve(time.monotonic()))
+                blocked_until = max(self._global.blocked_until, chat.blocked_until if chat is not None else 0.0)
+                if blocked_until <= time.monotonic():
+                    break
+                # A 429 arrived while this send was waiting, its slot is void, queue again behind the block
+                await self._sleep_until(blocked_until)
+        finally:
+            self.waiting -= 1
+        waited_ms = (time.monotonic() - started) * 1000
+        self.wait.observe(waited_ms)
+        return waited_ms
+
+    async def wait_unblocked(self) -> None:
+        '''
+        Wait out a 429 block on the whole bot without taking a message slot, for calls that have no chat
+        '''
+        while self._global.blocked_until > time.monotonic():
+            await self._sleep_until(self._global.blocked_until)
+
+    @staticmethod
+    async def _sleep_until(at: float) -> None:
+        delay = at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def defer(self, retry_after: float, chat_id: Optional[Hashable] = None) -> None:
+        '''
+        Telegram answered 429 with retry_after seconds
+        '''
+        self.deferrals += 1
+        now = time.monotonic()
+        until = now + retry_after
+        if chat_id is not None:
+            self._chat_bucket(chat_id, now).defer(until)
+        else:
+            self._global.defer(until)
+        logging.warning(f"Telegram rate limit hit for {chat_id if chat_id is not None else 'the bot'}, deferring {retry_after}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "chat_rate": self.chat_rate,
+            "chat_burst": self.chat_burst,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "deferrals": self.deferrals,
+            "chats": len(self._chats),
+            "wait": self.wait.to_dict()
+        }
@@ -0,0 +1,166 @@
+import logging
+from azure.cosmos import ContainerProxy
+from cache import TTLCache
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+from cosmos import PATCH_MAX_OPERATIONS, change_feed_watcher, diff_operations, patch_item, query_by_key, query_by_sql, read_item, replace_item
+from typing import Callable, Dict, Any, List, Optional
+import asyncio
+import os
+import random
+
+# chatbot id -> developer_id (the chatbots partition key), filled from every chatbot we see
+_chatbot_partitions: Dict[str, str] = {}
+_chatbot_partitions_warmed = False
+
+# Read-through cache of chatbot documents, kept fresh by the chatbots change feed
+chatbot_cache = TTLCache(
+    maxsize=int(os.getenv("CHATBOT_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("CHATBOT_CACHE_TTL", "300")),
+    name="chatbots"
+)
+
+# How often a chatbot update is re-applied after losing an etag race
+CHATBOT_UPDATE_RETRIES = int(os.getenv("CHATBOT_UPDATE_RETRIES", "3"))
+# Base of the jittered exponential backoff between those retries (seconds), so concurrent writers spread out
+CHATBOT_UPDATE_BACKOFF = float(os.getenv("CHATBOT_UPDATE_BACKOFF", "0.05"))
+
+
+def user_partition(user_id: str) -> str:
+    '''
+    Users and developers are partitioned by /partition, which is id[:4] (see User)
+    '''
+    return str(user_id)[:4]
+
+
+def remember_chatbot(chatbot: Dict[str, Any]) -> None:
+    if chatbot and chatbot.get("id") and chatbot.get("developer_id") is not None:
+        _chatbot_partitions[str(chatbot["id"])] = chatbot["developer_id"]
+
+
+def forget_chatbot(chatbot_id: str) -> None:
+    _chatbot_partitions.pop(str(chatbot_id), None)
+    chatbot_cache.invalidate(str(chatbot_id))
+
+
+def cache_chatbot(chatbot: Dict[str, Any]) -> None:
+    '''
+    Record a chatbot document this worker just wrote, so its own reads see the change immediately
+    '''
+    remember_chatbot(chatbot)
+    chatbot_cache.set(str(chatbot["id"]), chatbot)
+
+
+def _on_chatbot_changes(changes: List[Dict[str, Any]]) -> None:
+    for chatbot in changes:
+        remember_chatbot(chatbot)
+        chatbot_id = str(chatbot.get("id"))
+        # Only refresh what is already cached, the feed should not fill the cache with cold chatbots
+        if chatbot_id in chatbot_cache:
+            chatbot_cache.set(chatbot_id, chatbot)
+
+
+def _watch_chatbots(chatbot_container: ContainerProxy) -> None:
+    watcher = change_feed_watcher(chatbot_container)
+    watcher.subscribe(_on_chatbot_changes)
+    watcher.start()
+
+
+async def _warm_chatbot_partitions(chatbot_container: ContainerProxy) -> None:
+    global _chatbot_partitions_warmed
+    # Set before awaiting so concurrent misses do not all run the scan, cleared again so a failed scan is retried
+    _chatbot_partitions_warmed = True
+    try:
+        results = await query_by_sql(container=chatbot_container, queryStr="SELECT c.id, c.developer_id FROM c")
+    except Exception:
+        _chatbot_partitions_warmed = False
+        raise
+    for chatbot in results:
+        remember_chatbot(chatbot)
+    logging.warning(f"Chatbot partition lookup warmed with {len(_chatbot_partitions)} chatbots")
+
+
+async def get_user(user_container: ContainerProxy, user_id: str) -> Optional[Dict[str, Any]]:
+    return await read_item(user_container, str(user_id), user_partition(user_id))
+
+
+async def get_developer(developer_container: ContainerProxy, developer_id: str) -> Optional[Dict[str, Any]]:
+    return await read_item(developer_container, str(developer_id), user_partition(developer_id))
+
+
+async def get_chatbot(chatbot_container: ContainerProxy, chatbot_id: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+    '''
+    Read-through chatbot lookup. Cache misses point read the chatbot, falling back to a
+    cross-partition query only when its developer_id is unknown.
+    Pass use_cache=False before read-modify-write so the document (and _etag) is current.
+    '''
+    chatbot_id = str(chatbot_id)
+    _watch_chatbots(chatbot_container)
+    if use_cache:
+        chatbot = chatbot_cache.get(chatbot_id)
+        if chatbot is not None:
+            return chatbot
+
+    chatbot = await _load_chatbot(chatbot_container, chatbot_id)
+    if chatbot:
+        chatbot_cache.set(chatbot_id, chatbot)
+    return chatbot
+
+
+async def _load_chatbot(chatbot_container: ContainerProxy, chatbot_id: str) -> Optional[Dict[str, Any]]:
+    if chatbot_id not in _chatbot_partitions and not _chatbot_partitions_warmed:
+        await _warm_chatbot_partitions(chatbot_container)
+
+    if chatbot_id in _chatbot_partitions:
+        chatbot = await read_item(chatbot_container, chatbot_id, _chatbot_partitions[chatbot_id])
+        if chatbot:
+            return chatbot
+        forget_chatbot(chatbot_id)
+
+    query_result = await query_by_key(container=chatbot_container, key="id", val=chatbot_id)
+    if not query_result:
+        return None
+    remember_chatbot(query_result[0])
+    return query_result[0]
+
+
+async def update_chatbot(
+    chatbot_container: ContainerProxy,
+    chatbot_id: str,
+    mutate: Callable[[Dict[str, Any]], Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    '''
+    Optimistic read-modify-write. mutate receives the current document and returns the new one,
+    only the changed fields are patched and only if the document's _etag still matches.
+    The first attempt works from the cached document, a stale copy just costs a 412 and a re-read.
+    Retry n first waits a random delay of up to CHATBOT_UPDATE_BACKOFF * 2^(n-1).
+    None if the chatbot does not exist.
+    '''
+    chatbot_id = str(chatbot_id)
+    for attempt in range(CHATBOT_UPDATE_RETRIES + 1):
+        if attempt > 0:
+            await asyncio.sleep(random.uniform(0, CHATBOT_UPDATE_BACKOFF * 2 ** (attempt - 1)))
+        current = await get_chatbot(chatbot_container, chatbot_id, use_cache=attempt == 0)
+        if not current:
+            return None
+
+        operations = diff_operations(current, mutate(dict(current)))
+        if not operations:
+            return current
+
+        try:
+            if len(operations) > PATCH_MAX_OPERATIONS:
+                updated = dict(current)
+                updated.update({operation["path"][1:]: operation["value"] for operation in operations})
+                response = await replace_item(chatbot_container, body=updated, etag=current.get("_etag"))
+            else:
+                response = await patch_item(chatbot_container, chatbot_id, current["developer_id"], operations, etag=current.get("_etag"))
+        except CosmosAccessConditionFailedError:
+            logging.warning(f"Chatbot {chatbot_id} changed concurrently, retrying update (attempt {attempt + 1})")
+            chatbot_cache.invalidate(chatbot_id)
+            continue
+
+        remember_chatbot(response)
+        chatbot_cache.set(chatbot_id, response)
+        return response
+
+    raise CosmosAccessConditionFailedError(status_code=412, message=f"Chatbot {chatbot_id} kept changing, gave up after {CHATBOT_UPDATE_RETRIES + 1} attempts")
@@ -0,0 +1,78 @@
+'''
+Answers to repeated queries, so identical FAQ-style questions to the same chatbot skip the upstream call.
+
+Chatbots opt in per document: response_cache_ttl > 0 caches their answers for that many seconds,
+response_cache_size bounds how many are kept (TELEGRAM_RESPONSE_CACHE_SIZE when 0). Chatbots flagged
+stateful are never cached, their answers depend on the conversation so far. Entries are keyed by
+chatbot id, version and the normalized query, so a redeployed version starts cold. Each chatbot has
+its own LRU, one busy chatbot cannot evict another's answers. TELEGRAM_RESPONSE_CACHE=false turns the
+cache off for every chatbot.
+'''
+from cache import TTLCache
+from typing import Any, Dict, Optional, Tuple
+import os
+import re
+import unicodedata
+
+RESPONSE_CACHE = os.getenv("TELEGRAM_RESPONSE_CACHE", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.getenv("TELEGRAM_RESPONSE_CACHE_SIZE", "256"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    '''
+    Case, width and spacing differences do not make a different question
+    '''
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", query)).strip().casefold()
+
+
+def response_key(chatbot: Any, query: str) -> Tuple[str, str, str]:
+    return (str(chatbot.id), str(chatbot.version), normalize_query(query))
+
+
+class ResponseCache:
+    '''
+    Per-chatbot TTLCaches, created on a chatbot's first cacheable query. chatbot is a Chatbot entity.
+    '''
+    def __init__(self, enabled: bool = RESPONSE_CACHE, default_size: int = RESPONSE_CACHE_SIZE):
+        self.enabled = enabled
+        self.default_size = default_size
+        self._caches: Dict[str, TTLCache] = {}
+        self.bypassed = 0
+
+    def _cache_for(self, chatbot: Any) -> Optional[TTLCache]:
+        ttl = getattr(chatbot, "response_cache_ttl", 0) or 0
+        if not self.enabled or ttl <= 0 or getattr(chatbot, "stateful", False):
+            return None
+        size = getattr(chatbot, "response_cache_size", 0) or self.default_size
+        cache = self._caches.get(chatbot.id)
+        if cache is None:
+            cache = self._caches[chatbot.id] = TTLCache(maxsize=size, ttl=ttl, name=chatbot.name)
+        else:
+            # Follow changes to the chatbot's settings, smaller sizes take effect on the next store
+            cache.maxsize, cache.ttl, cache.name = size, ttl, chatbot.name
+        return cache
+
+    def get(self, chatbot: Any, query: str) -> Optional[str]:
+        cache = self._cache_for(chatbot)
+        if cache is None:
+            self.bypassed += 1
+            return None
+        return cache.get(response_key(chatbot, query))
+
+    def set(self, chatbot: Any, query: str, response: str) -> None:
+        cache = self._cache_for(chatbot)
+        if cache is None or not response:
+            return
+        cache.set(response_key(chatbot, query), response)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "bypassed": self.bypassed,
+            "chatbots": {chatbot_id: cache.stats() for chatbot_id, cache in self._caches.items()}
+        }
+
+
+response_cache = ResponseCache()
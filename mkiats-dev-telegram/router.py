@@ -0,0 +1,126 @@
+import logging
+from _common import _command_mapper
+from azure.functions import HttpResponse
+from metrics import LatencyHistogram, name_invocation
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from updateContext import UpdateContext
+import time
+
+# handler(context, argument): the command's arguments, the callback payload after the prefix, or the message text
+Handler = Callable[[UpdateContext, str], Awaitable[HttpResponse]]
+# middleware(context, route, argument, call_next) wraps everything after it, call_next() runs the rest of the chain
+Middleware = Callable[[UpdateContext, 'Route', str, Callable[[], Awaitable[HttpResponse]]], Awaitable[HttpResponse]]
+
+
+class Route:
+    def __init__(self, name: str, handler: Handler, load: Optional[str] = None):
+        self.name = name
+        self.handler = handler
+        # What load_context reads before the handler runs: "user" (and the selected chatbot) or "chatbot" (id in the argument)
+        self.load = load
+        self.latency = LatencyHistogram()
+
+
+class Router:
+    '''
+    Table-driven dispatch for Telegram updates. Commands ("/list") and callback prefixes ("select_<id>")
+    are dict lookups, other text goes to the text route and anything else to the fallback.
+    Every route runs through the middleware chain (in registration order) and its latency, middleware
+    included, is recorded per route. Handlers that raise or return a non-2xx response (a reply Telegram
+    refused) count as errors.
+    '''
+    def __init__(self):
+        self._commands: Dict[str, Route] = {}
+        self._callbacks: Dict[str, Route] = {}
+        self._text: Optional[Route] = None
+        self._fallback: Optional[Route] = None
+        self._middleware: List[Middleware] = []
+
+    def use(self, middleware: Middleware) -> Middleware:
+        self._middleware.append(middleware)
+        return middleware
+
+    def command(self, command: str, load: Optional[str] = None) -> Callable[[Handler], Handler]:
+        def register(handler: Handler) -> Handler:
+            self._commands[command] = Route(command, handler, load)
+            return handler
+        return register
+
+    def callback(self, command: str, name: Optional[str] = None, load: Optional[str] = None) -> Callable[[Handler], Handler]:
+        '''
+        Register a callback by its command name (see _command_mapper), matched on the short prefix it maps to
+        '''
+        prefix = _command_mapper(command)
+        if not prefix:
+            raise ValueError(f"No callback prefix for {command}")
+
+        def register(handler: Handler) -> Handler:
+            self._callbacks[prefix] = Route(name or prefix, handler, load)
+            return handler
+        return register
+
+    def text(self, name: str = "query", load: Optional[str] = None) -> Callable[[Handler], Handler]:
+        def register(handler: Handler) -> Handler:
+            self._text = Route(name, handler, load)
+            return handler
+        return register
+
+    def fallback(self, name: str = "unknown") -> Callable[[Handler], Handler]:
+        def register(handler: Handler) -> Handler:
+            self._fallback = Route(name, handler)
+            return handler
+        return register
+
+    def resolve(self, context: UpdateContext) -> Tuple[Optional[Route], str]:
+        if context.callback_data:
+            prefix, _, argument = context.callback_data.partition("_")
+            route = self._callbacks.get(prefix)
+            if route is not None:
+                return route, argument
+        elif context.text:
+            if context.text.startswith("/"):
+                command, _, argument = context.text.partition(" ")
+                # "/list@SomeBot" in group chats
+                route = self._commands.get(command.split("@", 1)[0])
+                if route is not None:
+                    return route, argument.strip()
+            if self._text is not None:
+                return self._text, context.text
+        return self._fallback, context.text or context.callback_data or ""
+
+    async def dispatch(self, context: UpdateContext) -> HttpResponse:
+        route, argument = self.resolve(context)
+        if route is None:
+            return HttpResponse("No route", status_code=404)
+        name_invocation(f"telegram.{route.name}")
+
+        async def call(position: int) -> HttpResponse:
+            if position == len(self._middleware):
+                return await route.handler(context, argument)
+            return await self._middleware[position](context, route, argument, lambda: call(position + 1))
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await call(0)
+            failed = not 200 <= response.status_code < 300
+            return response
+        finally:
+            route.latency.observe((time.perf_counter() - started) * 1000, error=failed)
+
+    def routes(self) -> List[Route]:
+        return [*self._commands.values(), *self._callbacks.values(), *(route for route in (self._text, self._fallback) if route is not None)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {route.name: route.latency.to_dict() for route in self.routes() if route.latency.count}
+
+
+async def load_context(context: UpdateContext, route: Route, argument: str, call_next: Callable[[], Awaitable[HttpResponse]]) -> HttpResponse:
+    '''
+    Load the documents the route declared, so handlers only read the context
+    '''
+    if route.load == "user":
+        await context.load(user=True)
+    elif route.load == "chatbot":
+        await context.load(chatbot_id=argument)
+    return await call_next()
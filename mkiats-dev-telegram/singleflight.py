@@ -0,0 +1,70 @@
+'''
+Coalesces identical calls that are in flight at the same time.
+
+When a lecturer posts a question, many students send it to the same chatbot within seconds. The first
+query starts the upstream call, identical ones that arrive while it runs wait for that call and get its
+result (or its exception) instead of starting their own. Nothing is kept once the call finishes, that
+is the response cache's job (see responseCache). TELEGRAM_COALESCE_QUERIES=false turns it off.
+'''
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+import asyncio
+import os
+
+COALESCE_QUERIES = os.getenv("TELEGRAM_COALESCE_QUERIES", "true").lower() == "true"
+
+T = TypeVar("T")
+
+
+class Singleflight:
+    def __init__(self, name: str = "singleflight", enabled: bool = COALESCE_QUERIES):
+        self.name = name
+        self.enabled = enabled
+        self._flights: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        '''
+        Run call() unless an identical call is in flight, then share its outcome. The call runs as its own
+        task, so a caller that gives up (cancelled) does not cancel it for the others.
+        '''
+        if not self.enabled:
+            return await call()
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.get_running_loop().create_task(call())
+            self._flights[key] = flight
+            self._waiters[key] = 0
+            flight.add_done_callback(lambda done: self._land(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+            logging.warning(f"Joined an in-flight {self.name} call")
+        self._waiters[key] += 1
+        self.max_waiters = max(self.max_waiters, self._waiters[key])
+        return await asyncio.shield(flight)
+
+    def _land(self, key: Hashable, flight: asyncio.Task) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+            del self._waiters[key]
+        # Every waiter may have been cancelled, retrieve the exception so it is not reported as unhandled
+        if not flight.cancelled():
+            flight.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.calls + self.coalesced
+        return {
+            "enabled": self.enabled,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_rate": round(self.coalesced / requests, 4) if requests else 0.0,
+            "in_flight": len(self._flights),
+            "max_waiters": self.max_waiters
+        }
+
+
+chatbot_queries = Singleflight(name="chatbot query")
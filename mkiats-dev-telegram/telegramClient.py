@@ -1,79 +1,150 @@
 import logging
 from typing import Tuple
-from azure.cosmos import ContainerProxy
 from azure.functions import HttpResponse, HttpRequest
-from cosmos import CosmosDB, query_by_key, query_by_sql
 from _startHandler import command_telegram_start
-from _listHandler import command_telegram_list
+from _listHandler import command_telegram_list, command_telegram_list_page
 from _selectHandler import command_telegram_select
 from _queryHandler import command_telegram_query
-from _common import _parse_payload, _command_mapper, _echo_message
-from entities import ChatbotCallbackData
+from _common import _echo_message
 from exceptions import TelegramException, TelegramExceptionCode
+from metrics import name_invocation, track_invocation
+from router import Router, load_context
+from updateQueue import UpdateQueue, ensure_local_worker, worker_slot
+from updateContext import UpdateContext
+from updateDedup import update_dedup
 
 class TelegramClient:
     @staticmethod
     async def _process_message(req: HttpRequest) -> HttpResponse:
+        payload = req.get_json()
+        # Telegram redelivers updates the webhook was slow to answer, answer those without doing the work twice
+        if isinstance(payload, dict) and not await update_dedup.claim(payload.get("update_id")):
+            name_invocation("telegram.duplicate")
+            return HttpResponse("Duplicate", status_code=200)
+        return TelegramClient._ack(await TelegramClient._process_update(payload))
+
+    @staticmethod
+    def _ack(response: HttpResponse) -> HttpResponse:
+        '''
+        The webhook answer for a handled update. Telegram redelivers updates whose webhook does not answer 2xx,
+        which would run the handler (and the chatbot query) again, so a failed reply is logged and counted on
+        its route (see Router.dispatch) but the update is still acked. Inline replies pass through unchanged.
+        '''
+        if 200 <= response.status_code < 300:
+            return response
+        logging.error(f"Reply failed with {response.status_code}: {response.get_body()[:200]!r}, acking the update anyway")
+        return HttpResponse("Handled", status_code=200)
+
+    @staticmethod
+    async def _enqueue_message(req: HttpRequest, queue: UpdateQueue) -> HttpResponse:
+        '''
+        Queue ingestion: validate and enqueue the update, then ack the webhook without waiting for the handler
+        '''
         try:
             payload = req.get_json()
-            message, chat_id, text, callback_query, callback_data = _parse_payload(payload)
-            
-            db = CosmosDB()
-            await db.initialize()
-            
-            response = HttpResponse("Placeholder", status_code=404)
-            if False or text == "/start": # TODO: Remove False condition when finish development
-                logging.warning("Flushing messages...")
-                response = await command_telegram_start(chat_id)
-
-            elif text == "/list":
-                response = await command_telegram_list(chat_id, db.chatbot_container)
-
-            elif callback_data and TelegramClient.validate_callback(callback_data)=="command_callback_select":
-                response = await command_telegram_select(chat_id, callback_data, db.user_container, db.chatbot_container)
-
-            elif text:
-                theSelectedChatbot = await TelegramClient.validate_chatbot_selection(chat_id=chat_id, user_container=db.user_container)
-                # Check if chatbot has already been selected, if yes, then forward query to there
-                if theSelectedChatbot == "":
-                    text = "Chatbot has yet to be selected, /list to view all available chatbot!"
-                    response = await _echo_message(chat_id=chat_id, text=text)
-                else:
-                    response = await command_telegram_query(chat_id=chat_id, chatbot_id=theSelectedChatbot, user_query=text, chatbot_container=db.chatbot_container, user_container=db.user_container)
-                
-            else:
-                logging.warning("Unknown command in _process_message")
-                response = await _echo_message(chat_id=chat_id, text="Unknown command detected...")
-            return response
+        except ValueError:
+            return HttpResponse("Invalid update", status_code=400)
+        if not isinstance(payload, dict) or not isinstance(payload.get("update_id"), int):
+            return HttpResponse("Invalid update", status_code=400)
+        if not TelegramClient.is_supported_update(payload):
+            # Other update types (edits, photos, ...) are not handled, ack them so Telegram does not retry
+            return HttpResponse("Ignored", status_code=200)
+
+        if not await update_dedup.claim(payload["update_id"]):
+            return HttpResponse("Duplicate", status_code=200)
+        try:
+            await queue.put(payload)
+        except Exception:
+            # Not queued, let Telegram's redelivery through
+            await update_dedup.forget(payload["update_id"])
+            raise
+        ensure_local_worker(TelegramClient._process_queued_update)
+        return HttpResponse("Queued", status_code=200)
+
+    @staticmethod
+    async def _process_queued_update(payload: dict, final_attempt: bool = True) -> HttpResponse:
+        '''
+        Handle an update taken off the ingestion queue. Failures raise so the queue retries the update,
+        only the last attempt tells the user something went wrong.
+        '''
+        async with worker_slot():
+            with track_invocation("telegram"):
+                return await TelegramClient._process_update(payload, raise_errors=not final_attempt)
+
+    @staticmethod
+    def is_supported_update(payload: dict) -> bool:
+        message = payload.get("message") or {}
+        callback_query = payload.get("callback_query") or {}
+        if message:
+            return isinstance(message.get("chat"), dict) and "id" in message["chat"] and isinstance(message.get("text"), str)
+        if callback_query:
+            chat = (callback_query.get("message") or {}).get("chat") or {}
+            return "id" in chat and isinstance(callback_query.get("data"), str)
+        return False
+
+    @staticmethod
+    async def _process_update(payload: dict, raise_errors: bool = False) -> HttpResponse:
+        chat_id = None
+        try:
+            context = await UpdateContext.from_payload(payload)
+            context.retry_on_error = raise_errors
+            chat_id = context.chat_id
+            return await router.dispatch(context)
 
         except TelegramException as telegramException:
+            if raise_errors:
+                raise
             response = await _echo_message(chat_id=chat_id, text=f"Telegram exception occured, Try again later")
             return response
 
         except Exception as e:
             logging.error(f"Error processing message in TelegramClient: {str(e)}")
+            if raise_errors:
+                raise
             response = await _echo_message(chat_id=chat_id, text=f"Exception occured, Try again later")
             return response
 
 
-    @staticmethod
-    def validate_callback(callback_data: str) -> str:
-        logging.warning("Executing validate_callback...")
-        [short_command_str, chatbot_id] = ChatbotCallbackData.destructure_callback_str(callback_data)
-        command_str = _command_mapper(command_string=short_command_str, reverse=True)
-        if command_str != "":
-            return command_str
-        else:
-            return ""
-    
-    @staticmethod
-    async def validate_chatbot_selection(chat_id: str, user_container: ContainerProxy) -> str:
-        logging.warning("Executing validate_chatbot_selection...")
-        userResult = await query_by_key(container=user_container, key="id", val=chat_id)
-        theSelectedChatbot = userResult[0].get("selected_chatbot_id")
-        if theSelectedChatbot != "":
-            return theSelectedChatbot
-        else:
-            return ""
-
-        
\ No newline at end of file
+# Routes, see router.Router. Handlers get the update context and the command argument / callback payload / text
+router = Router()
+router.use(load_context)
+
+
+@router.command("/start")
+async def _start(context: UpdateContext, argument: str) -> HttpResponse:
+    return await command_telegram_start(context)
+
+
+@router.command("/list")
+async def _list(context: UpdateContext, argument: str) -> HttpResponse:
+    return await command_telegram_list(context)
+
+
+@router.callback("command_callback_list_next", name="/list.next")
+async def _list_next(context: UpdateContext, cursor: str) -> HttpResponse:
+    return await command_telegram_list_page(context, "command_callback_list_next", cursor)
+
+
+@router.callback("command_callback_list_prev", name="/list.prev")
+async def _list_prev(context: UpdateContext, cursor: str) -> HttpResponse:
+    return await command_telegram_list_page(context, "command_callback_list_prev", cursor)
+
+
+@router.callback("command_callback_select", load="chatbot")
+async def _select(context: UpdateContext, chatbot_id: str) -> HttpResponse:
+    return await command_telegram_select(context, chatbot_id)
+
+
+# Any other text is a query for the selected chatbot, user and chatbot are read together by load_context
+@router.text(load="user")
+async def _query(context: UpdateContext, text: str) -> HttpResponse:
+    # Check if chatbot has already been selected, if yes, then forward query to there
+    if context.selected_chatbot_id == "":
+        return await _echo_message(chat_id=context.chat_id, text="Chatbot has yet to be selected, /list to view all available chatbot!")
+    return await command_telegram_query(context, user_query=text)
+
+
+@router.fallback()
+async def _unknown(context: UpdateContext, argument: str) -> HttpResponse:
+    logging.warning("Unknown command in _process_message")
+    return await _echo_message(chat_id=context.chat_id, text="Unknown command detected...")
@@ -0,0 +1,48 @@
+'''
+Tests run against the in-memory Cosmos backend (cosmosMemory) and fake upstreams, nothing leaves the process.
+Run from mkiats-dev-telegram: python -m pytest tests
+'''
+from aiohttp import web
+import os
+import sys
+
+os.environ.setdefault("COSMOS_DB_BACKEND", "memory")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def serve(app):
+    '''
+    Start an aiohttp app on a free local port, returns (runner, base url). Clean up with runner.cleanup()
+    '''
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def use_bot_api(base_url: str) -> None:
+    '''
+    Point the shared BotApiClient at a fake Bot API
+    '''
+    from botApiClient import BotApiClient
+    os.environ["TELEGRAM_API_URL"] = f"{base_url}/bot"
+    BotApiClient._shared = None
+
+
+class FakeBotApi:
+    def __init__(self, failing_sends: int = 0):
+        self.calls = []
+        self.failing_sends = failing_sends
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls.append((method, await request.json()))
+        if self.failing_sends and method == "sendMessage":
+            self.failing_sends -= 1
+            return web.json_response({"ok": False, "description": "Bad Request"}, status=400)
+        return web.json_response({"ok": True, "result": {"message_id": len(self.calls)}})
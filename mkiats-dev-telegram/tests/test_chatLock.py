@@ -0,0 +1,61 @@
+from chatLock import ChatLock
+from cosmos import CosmosDB, read_item
+import asyncio
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def _lease(chat_id):
+    container = (await CosmosDB.shared()).lease_container
+    return await read_item(container, f"chat-{chat_id}", f"chat-{chat_id}")
+
+
+def test_busy_while_held_on_any_worker():
+    async def scenario():
+        here, there = ChatLock(owner="worker-a"), ChatLock(owner="worker-b")
+        async with here.hold("101") as acquired:
+            assert acquired
+            async with here.hold("101") as again:
+                assert not again
+            async with there.hold("101") as elsewhere:
+                assert not elsewhere
+    run(scenario())
+
+
+def test_release_frees_the_chat_for_other_workers_at_once():
+    async def scenario():
+        here, there = ChatLock(owner="worker-a"), ChatLock(owner="worker-b")
+        async with here.hold("102") as acquired:
+            assert acquired
+        assert (await _lease("102"))["expires_at"] == 0
+        async with there.hold("102") as acquired:
+            assert acquired
+        assert there.takeovers == 1
+    run(scenario())
+
+
+def test_same_worker_retakes_its_lease_after_a_stale_etag():
+    async def scenario():
+        here = ChatLock(owner="worker-a")
+        async with here.hold("103") as acquired:
+            assert acquired
+        # A renewal that landed after the release moved the etag on
+        here._released.set("103", '"stale"')
+        async with here.hold("103") as acquired:
+            assert acquired
+        assert here.reclaimed == 1
+    run(scenario())
+
+
+def test_renewal_keeps_a_long_query_locked():
+    async def scenario():
+        here, there = ChatLock(owner="worker-a", window=0.5), ChatLock(owner="worker-b", window=0.5)
+        lease = await here.acquire("104")
+        await asyncio.sleep(1.2)
+        assert await there.acquire("104") is None
+        await here.release(lease)
+        assert here.renewals >= 2
+        assert await there.acquire("104") is not None
+    run(scenario())
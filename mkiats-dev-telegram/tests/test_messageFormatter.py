@@ -0,0 +1,15 @@
+from messageFormatter import MESSAGE_LIMIT, split_message, telegram_length
+
+
+def test_parts_fit_the_limit():
+    text = "\n\n".join(f"Paragraph {index} " + "word " * 300 for index in range(10))
+    parts = split_message(text)
+    assert len(parts) > 1
+    assert all(0 < telegram_length(part) <= MESSAGE_LIMIT for part in parts)
+
+
+def test_blank_text_over_the_limit_still_gives_one_part():
+    for blank in (" " * (MESSAGE_LIMIT + 10), "\n" * (MESSAGE_LIMIT * 2), " \n\n " * MESSAGE_LIMIT):
+        parts = split_message(blank)
+        assert len(parts) == 1
+        assert telegram_length(parts[0]) <= MESSAGE_LIMIT
@@ -0,0 +1,74 @@
+from _common import _stream_chatbot
+from aiohttp import web
+from chatbotClient import ChatbotClient
+from conftest import FakeBotApi, serve, use_bot_api
+from entities import Chatbot
+from responseCache import response_cache
+import asyncio
+
+
+async def _setup(bot_api, chatbot_app):
+    bot_runner, bot_url = await serve(bot_api.app)
+    chatbot_runner, chatbot_url = await serve(chatbot_app)
+    use_bot_api(bot_url)
+    return (bot_runner, chatbot_runner), f"{chatbot_url}/chat/query"
+
+
+async def _teardown(runners):
+    await ChatbotClient.shared().close()
+    for runner in runners:
+        await runner.cleanup()
+
+
+def test_chatbot_crashing_mid_stream_is_not_cached():
+    async def crashing(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        await response.write(b"Half an ")
+        await asyncio.sleep(0.05)
+        # What the generated route does now: raise instead of ending the body
+        request.transport.close()
+        return response
+
+    async def scenario():
+        chatbot_app = web.Application()
+        chatbot_app.router.add_post("/chat/query/stream", crashing)
+        bot_api = FakeBotApi()
+        runners, endpoint = await _setup(bot_api, chatbot_app)
+        chatbot = Chatbot(id="streaming-bot", name="streaming", endpoint=endpoint, response_cache_ttl=60)
+        try:
+            await _stream_chatbot("1", endpoint, "what is a stream", chatbot=chatbot)
+        finally:
+            await _teardown(runners)
+        assert bot_api.calls[0][1]["text"] == "Half an "
+        assert response_cache.get(chatbot, "what is a stream") is None
+
+    asyncio.run(scenario())
+
+
+def test_failed_first_message_sends_the_reply_once():
+    async def chunked(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for word in ("One ", "two ", "three ", "four."):
+            await response.write(word.encode())
+            await asyncio.sleep(0.02)
+        await response.write_eof()
+        return response
+
+    async def scenario():
+        chatbot_app = web.Application()
+        chatbot_app.router.add_post("/chat/query/stream", chunked)
+        bot_api = FakeBotApi(failing_sends=1)
+        runners, endpoint = await _setup(bot_api, chatbot_app)
+        try:
+            response = await _stream_chatbot("1", endpoint, "count to four")
+        finally:
+            await _teardown(runners)
+        assert response.status_code == 200
+        assert [method for method, _ in bot_api.calls] == ["sendMessage", "sendMessage"]
+        assert bot_api.calls[-1][1]["text"] == "One two three four."
+
+    asyncio.run(scenario())
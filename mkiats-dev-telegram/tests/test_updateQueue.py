@@ -0,0 +1,50 @@
+from aiohttp import web
+from chatbotClient import ChatbotClient
+from conftest import FakeBotApi, serve, use_bot_api
+from cosmos import CosmosDB, upsert_item
+from entities import Chatbot, ChatbotStatus, User
+from telegramClient import TelegramClient
+from updateQueue import MAX_ATTEMPTS, MemoryUpdateQueue, UpdateWorker
+import asyncio
+
+
+def test_failing_chatbot_query_is_retried_by_the_queue():
+    attempts = []
+
+    async def failing_chatbot(request):
+        attempts.append(await request.json())
+        return web.json_response({"error": "model overloaded"}, status=503)
+
+    async def scenario():
+        chatbot_app = web.Application()
+        chatbot_app.router.add_post("/chat/query", failing_chatbot)
+        bot_api = FakeBotApi()
+        bot_runner, bot_url = await serve(bot_api.app)
+        chatbot_runner, chatbot_url = await serve(chatbot_app)
+        use_bot_api(bot_url)
+
+        db = await CosmosDB.shared()
+        chatbot = Chatbot(id="queued-bot", name="queued", endpoint=f"{chatbot_url}/chat/query", developer_id="dev-1",
+                          status=ChatbotStatus.ACTIVE, telegram_support=True)
+        await upsert_item(db.chatbot_container, body=chatbot.to_dict())
+        await upsert_item(db.user_container, body=User(id="5550001", selected_chatbot_id="queued-bot").to_dict())
+
+        queue = MemoryUpdateQueue()
+        worker = UpdateWorker(queue, TelegramClient._process_queued_update)
+        worker.start()
+        await queue.put({"update_id": 1, "message": {"message_id": 1, "chat": {"id": 5550001}, "text": "hello"}})
+        for _ in range(100):
+            if bot_api.calls:
+                break
+            await asyncio.sleep(0.05)
+        await worker.stop()
+        await ChatbotClient.shared().close()
+        await bot_runner.cleanup()
+        await chatbot_runner.cleanup()
+
+        # Every attempt reached the chatbot, only the last one told the user
+        assert len(attempts) == MAX_ATTEMPTS
+        assert [method for method, _ in bot_api.calls] == ["sendMessage"]
+        assert "Unknown error" in bot_api.calls[0][1]["text"]
+
+    asyncio.run(scenario())
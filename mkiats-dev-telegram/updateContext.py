@@ -0,0 +1,88 @@
+import logging
+from _common import _parse_payload
+from cache import TTLCache
+from cosmos import CosmosDB
+from repository import get_chatbot, get_user
+from typing import Any, Dict, Optional
+import asyncio
+import os
+
+# chat id -> chatbot id it last selected on this worker. Only a hint: it lets the selected chatbot be read
+# alongside the user instead of after it, the user document still decides which chatbot is used
+selection_hints = TTLCache(
+    maxsize=int(os.getenv("TELEGRAM_SELECTION_HINT_SIZE", "4096")),
+    ttl=float(os.getenv("TELEGRAM_SELECTION_HINT_TTL", "3600")),
+    name="selections"
+)
+
+
+def remember_selection(chat_id: str, chatbot_id: str) -> None:
+    selection_hints.set(str(chat_id), str(chatbot_id))
+
+
+async def _nothing() -> None:
+    return None
+
+
+class UpdateContext:
+    '''
+    Everything the handlers need about one update, built once by TelegramClient._process_update.
+    The user and chatbot documents are loaded here (see load) and handlers read them from the
+    context instead of querying Cosmos again.
+    '''
+    def __init__(self, db: CosmosDB, message: dict, chat_id: str, text: str, callback_query: dict, callback_data: str):
+        self.db = db
+        self.message = message
+        self.chat_id = chat_id
+        self.text = text
+        self.callback_query = callback_query
+        self.callback_data = callback_data
+        self.user: Optional[Dict[str, Any]] = None
+        self.chatbot: Optional[Dict[str, Any]] = None
+        # Set for queued updates with attempts left: handlers re-raise instead of replying with an error,
+        # so the queue retries the update (see TelegramClient._process_queued_update)
+        self.retry_on_error = False
+
+    @classmethod
+    async def from_payload(cls, payload: dict) -> 'UpdateContext':
+        message, chat_id, text, callback_query, callback_data = _parse_payload(payload)
+        return cls(await CosmosDB.shared(), message, chat_id, text, callback_query, callback_data)
+
+    @property
+    def callback_message_id(self) -> Optional[int]:
+        '''
+        The message whose inline keyboard was pressed
+        '''
+        return ((self.callback_query or {}).get("message") or {}).get("message_id")
+
+    @property
+    def selected_chatbot_id(self) -> str:
+        return (self.user or {}).get("selected_chatbot_id") or ""
+
+    async def load(self, user: bool = False, chatbot_id: Optional[str] = None) -> None:
+        '''
+        Load the user and/or a chatbot concurrently. With user=True and no chatbot_id the user's selected
+        chatbot is loaded, speculatively from the selection hint and re-read only if the hint was wrong.
+        Chatbots come through the chatbot cache, so the usual cost is a single user point read.
+        '''
+        speculative = chatbot_id is None and user
+        if speculative:
+            chatbot_id = selection_hints.get(str(self.chat_id))
+
+        the_user, the_chatbot = await asyncio.gather(
+            get_user(self.db.user_container, self.chat_id) if user else _nothing(),
+            get_chatbot(self.db.chatbot_container, chatbot_id) if chatbot_id else _nothing()
+        )
+        if user:
+            self.user = the_user
+
+        if speculative:
+            selected = self.selected_chatbot_id
+            if selected and selected != chatbot_id:
+                logging.warning(f"Selection hint for chat {self.chat_id} was stale, reading chatbot {selected}")
+                the_chatbot = await get_chatbot(self.db.chatbot_container, selected)
+            elif not selected:
+                the_chatbot = None
+            if selected:
+                remember_selection(self.chat_id, selected)
+        self.chatbot = the_chatbot
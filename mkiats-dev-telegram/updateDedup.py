@@ -0,0 +1,111 @@
+'''
+Drops Telegram updates we have already taken in.
+
+Telegram redelivers an update when the webhook is slow or fails, and each redelivery would otherwise
+forward the same query to the chatbot again. Updates are claimed by update_id when they arrive:
+    local   a per-worker TTL/LRU set, repeats seen by this worker stop here without any I/O
+    cosmos  a marker document per update in the "leases" container, created with a ttl so it cleans
+            itself up. Losing the create (409) means another worker took the update first
+The "leases" container is only created by CosmosDB.provision() (COSMOS_DB_PROVISION=true). Without it
+updates are deduplicated locally only, checked once per worker. TELEGRAM_DEDUP=local skips the shared
+store, TELEGRAM_DEDUP=off disables deduplication.
+Claims are made at ingestion (webhook or poller), never by the queue consumer, so retries of our own
+failed attempts are not mistaken for duplicates.
+'''
+import logging
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosResourceNotFoundError
+from cache import TTLCache
+from cosmos import CosmosDB, create_item, delete_item
+from typing import Any, Dict, Optional
+import os
+
+DEDUP_BACKEND = os.getenv("TELEGRAM_DEDUP", "cosmos").lower()
+# Telegram keeps undelivered updates for 24 hours
+DEDUP_TTL = int(os.getenv("TELEGRAM_DEDUP_TTL", "86400"))
+
+
+class UpdateDeduplicator:
+    def __init__(self, backend: str = DEDUP_BACKEND, ttl: int = DEDUP_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self._seen = TTLCache(
+            maxsize=int(os.getenv("TELEGRAM_DEDUP_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("TELEGRAM_DEDUP_CACHE_TTL", "3600")),
+            name="updates"
+        )
+        self.shared: Optional[bool] = None
+        self.claimed = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    async def _use_shared(self) -> bool:
+        if self.backend != "cosmos":
+            return False
+        if self.shared is None:
+            self.shared = await (await CosmosDB.shared()).has_container("leases")
+            if not self.shared:
+                logging.warning("No leases container, updates are only deduplicated per worker")
+        return self.shared
+
+    @staticmethod
+    def _key(update_id: Any) -> str:
+        return f"update-{update_id}"
+
+    async def claim(self, update_id: Optional[int]) -> bool:
+        '''
+        True the first time an update_id is seen (process it), False for a redelivery
+        '''
+        if self.backend == "off" or update_id is None:
+            return True
+        key = self._key(update_id)
+        if key in self._seen:
+            self.duplicates += 1
+            return False
+
+        # Mark locally before awaiting anything, so a concurrent redelivery on this worker stops above
+        self._seen.set(key, True)
+        try:
+            if await self._use_shared():
+                container = (await CosmosDB.shared()).lease_container
+                await create_item(container, {"id": key, "ttl": self.ttl})
+        except CosmosResourceExistsError:
+            self.duplicates += 1
+            return False
+        except Exception as e:
+            # Fail open, a duplicate answer is better than a lost one
+            self.errors += 1
+            logging.error(f"Update dedup store error for update {update_id}, deduplicating locally only: {str(e)}")
+        self.claimed += 1
+        return True
+
+    async def forget(self, update_id: Optional[int]) -> None:
+        '''
+        Drop a claim whose update could not be taken in, so Telegram's redelivery is accepted
+        '''
+        if self.backend == "off" or update_id is None:
+            return
+        key = self._key(update_id)
+        self._seen.invalidate(key)
+        try:
+            if await self._use_shared():
+                container = (await CosmosDB.shared()).lease_container
+                await delete_item(container, key, key)
+        except CosmosResourceNotFoundError:
+            pass
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Could not release update {update_id}, its redelivery will be dropped: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "shared": self.shared,
+            "ttl": self.ttl,
+            "claimed": self.claimed,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "local": self._seen.stats()
+        }
+
+
+update_dedup = UpdateDeduplicator()
@@ -0,0 +1,307 @@
+'''
+Ingestion queue between the Telegram webhook and the update handlers.
+
+With TELEGRAM_UPDATE_QUEUE set, the webhook only validates and enqueues each update and acks Telegram
+straight away, handlers run later off the queue so slow chatbots never hold a webhook open.
+    azure   Azure Storage Queue (TELEGRAM_UPDATE_QUEUE_CONNECTION / TELEGRAM_UPDATE_QUEUE_NAME),
+            consumed by the process_telegram_update queue trigger
+    sqlite  local file queue (TELEGRAM_UPDATE_QUEUE_PATH), consumed by an UpdateWorker in this process
+    memory  in-process queue, consumed by an UpdateWorker in this process (lost on restart)
+Unset keeps the old behaviour of handling the update inside the webhook.
+'''
+import logging
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+TELEGRAM_UPDATE_QUEUE = os.getenv("TELEGRAM_UPDATE_QUEUE", "").lower()
+QUEUE_NAME = os.getenv("TELEGRAM_UPDATE_QUEUE_NAME", "telegram-updates")
+QUEUE_CONNECTION_SETTING = "TELEGRAM_UPDATE_QUEUE_CONNECTION"
+# An update that failed this many times is dropped (the Azure queue moves it to <name>-poison instead),
+# keep it equal to maxDequeueCount in host.json
+MAX_ATTEMPTS = int(os.getenv("TELEGRAM_UPDATE_MAX_ATTEMPTS", "5"))
+# How long a claimed update stays hidden from other consumers before it is retried
+VISIBILITY_TIMEOUT = int(os.getenv("TELEGRAM_UPDATE_VISIBILITY_TIMEOUT", "300"))
+WORKER_CONCURRENCY = int(os.getenv("TELEGRAM_WORKER_CONCURRENCY", "8"))
+
+
+class QueuedUpdate:
+    def __init__(self, payload: Dict[str, Any], receipt: Any = None, attempts: int = 1):
+        self.payload = payload
+        self.receipt = receipt
+        self.attempts = attempts
+
+
+class UpdateQueue(ABC):
+    '''
+    At-least-once queue of Telegram update payloads. get() claims an update, ack() removes it,
+    release() hands it back for another attempt.
+    '''
+    @abstractmethod
+    async def put(self, payload: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    async def get(self, wait: float = 1.0) -> Optional[QueuedUpdate]:
+        ...
+
+    @abstractmethod
+    async def ack(self, update: QueuedUpdate) -> None:
+        ...
+
+    @abstractmethod
+    async def release(self, update: QueuedUpdate) -> None:
+        ...
+
+
+class MemoryUpdateQueue(UpdateQueue):
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+
+    def _get_queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def put(self, payload: Dict[str, Any]) -> None:
+        self._get_queue().put_nowait(QueuedUpdate(payload))
+
+    async def get(self, wait: float = 1.0) -> Optional[QueuedUpdate]:
+        try:
+            return await asyncio.wait_for(self._get_queue().get(), timeout=wait)
+        except asyncio.TimeoutError:
+            return None
+
+    async def ack(self, update: QueuedUpdate) -> None:
+        pass
+
+    async def release(self, update: QueuedUpdate) -> None:
+        self._get_queue().put_nowait(QueuedUpdate(update.payload, attempts=update.attempts + 1))
+
+
+class SqliteUpdateQueue(UpdateQueue):
+    '''
+    File-backed queue for local runs, survives restarts and can be shared by several local processes
+    '''
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path: Optional[str] = None, visibility_timeout: int = VISIBILITY_TIMEOUT):
+        self.path = path or os.getenv("TELEGRAM_UPDATE_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "telegram_updates.sqlite"))
+        self.visibility_timeout = visibility_timeout
+        self._local = threading.local()
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS updates ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, "
+            "visible_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, kept open: closing the last WAL connection forces a checkpoint
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # WAL keeps enqueues cheap, a crash can at worst lose the last few updates
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> None:
+        self._connect().execute(sql, parameters)
+
+    def _put(self, payload: Dict[str, Any]) -> None:
+        self._execute("INSERT INTO updates (payload, visible_at) VALUES (?, ?)", (json.dumps(payload), time.time()))
+
+    def _claim(self) -> Optional[QueuedUpdate]:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = connection.execute(
+                "SELECT id, payload, attempts FROM updates WHERE visible_at <= ? ORDER BY id LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute(
+                "UPDATE updates SET visible_at = ?, attempts = attempts + 1 WHERE id = ?", (now + self.visibility_timeout, row[0])
+            )
+            connection.execute("COMMIT")
+            return QueuedUpdate(json.loads(row[1]), receipt=row[0], attempts=row[2] + 1)
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    async def put(self, payload: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._put, payload)
+
+    async def get(self, wait: float = 1.0) -> Optional[QueuedUpdate]:
+        deadline = time.monotonic() + wait
+        while True:
+            update = await asyncio.to_thread(self._claim)
+            if update is not None or time.monotonic() >= deadline:
+                return update
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def ack(self, update: QueuedUpdate) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM updates WHERE id = ?", (update.receipt,))
+
+    async def release(self, update: QueuedUpdate) -> None:
+        await asyncio.to_thread(self._execute, "UPDATE updates SET visible_at = ? WHERE id = ?", (time.time(), update.receipt))
+
+
+class AzureStorageUpdateQueue(UpdateQueue):
+    '''
+    Azure Storage Queue backend. Messages are base64 encoded JSON, which is what the Functions queue trigger expects.
+    azure-storage-queue is only imported when this backend is used.
+    '''
+    def __init__(self, connection_string: Optional[str] = None, queue_name: str = QUEUE_NAME, visibility_timeout: int = VISIBILITY_TIMEOUT):
+        self.connection_string = connection_string or os.getenv(QUEUE_CONNECTION_SETTING)
+        self.queue_name = queue_name
+        self.visibility_timeout = visibility_timeout
+        self._client = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            from azure.storage.queue import TextBase64DecodePolicy, TextBase64EncodePolicy
+            from azure.storage.queue.aio import QueueClient
+            self._client = QueueClient.from_connection_string(
+                self.connection_string,
+                self.queue_name,
+                message_encode_policy=TextBase64EncodePolicy(),
+                message_decode_policy=TextBase64DecodePolicy()
+            )
+            self._loop = loop
+        return self._client
+
+    async def put(self, payload: Dict[str, Any]) -> None:
+        await self._get_client().send_message(json.dumps(payload))
+
+    async def get(self, wait: float = 1.0) -> Optional[QueuedUpdate]:
+        message = await self._get_client().receive_message(visibility_timeout=self.visibility_timeout)
+        if message is None:
+            await asyncio.sleep(wait)
+            return None
+        return QueuedUpdate(json.loads(message.content), receipt=message, attempts=message.dequeue_count or 1)
+
+    async def ack(self, update: QueuedUpdate) -> None:
+        await self._get_client().delete_message(update.receipt)
+
+    async def release(self, update: QueuedUpdate) -> None:
+        await self._get_client().update_message(update.receipt, visibility_timeout=0)
+
+
+_queue: Optional[UpdateQueue] = None
+
+
+def update_queue() -> Optional[UpdateQueue]:
+    '''
+    The configured ingestion queue, None when updates are handled inside the webhook
+    '''
+    global _queue
+    if _queue is None and TELEGRAM_UPDATE_QUEUE:
+        if TELEGRAM_UPDATE_QUEUE == "azure":
+            _queue = AzureStorageUpdateQueue()
+        elif TELEGRAM_UPDATE_QUEUE == "sqlite":
+            _queue = SqliteUpdateQueue()
+        elif TELEGRAM_UPDATE_QUEUE == "memory":
+            _queue = MemoryUpdateQueue()
+        else:
+            raise ValueError(f"Unknown TELEGRAM_UPDATE_QUEUE {TELEGRAM_UPDATE_QUEUE}")
+    return _queue
+
+
+_worker_slots: Optional[asyncio.Semaphore] = None
+
+
+@asynccontextmanager
+async def worker_slot() -> AsyncIterator[None]:
+    '''
+    Bounds how many queued updates this worker handles at once (TELEGRAM_WORKER_CONCURRENCY)
+    '''
+    global _worker_slots
+    if _worker_slots is None:
+        _worker_slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    async with _worker_slots:
+        yield
+
+
+class UpdateWorker:
+    '''
+    In-process consumer for the local queues. The Azure queue is consumed by the queue trigger instead.
+    handler(payload, final_attempt) raises to have the update retried, final_attempt is True on the last try.
+    '''
+    def __init__(self, queue: UpdateQueue, handler: Callable[[Dict[str, Any], bool], Awaitable[Any]], concurrency: int = WORKER_CONCURRENCY):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _run(self) -> None:
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            try:
+                update = await self.queue.get(wait=1.0)
+            except Exception as e:
+                slots.release()
+                logging.error(f"Error reading telegram update queue: {str(e)}")
+                await asyncio.sleep(1.0)
+                continue
+            if update is None:
+                slots.release()
+                continue
+            task = asyncio.get_running_loop().create_task(self._handle(update, slots))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _handle(self, update: QueuedUpdate, slots: asyncio.Semaphore) -> None:
+        try:
+            await self.handler(update.payload, update.attempts >= MAX_ATTEMPTS)
+            await self.queue.ack(update)
+        except Exception as e:
+            logging.error(f"Error handling queued telegram update (attempt {update.attempts}): {str(e)}")
+            if update.attempts >= MAX_ATTEMPTS:
+                logging.error(f"Dropping telegram update after {update.attempts} attempts: {json.dumps(update.payload)}")
+                await self.queue.ack(update)
+            else:
+                await self.queue.release(update)
+        finally:
+            slots.release()
+
+
+_worker: Optional[UpdateWorker] = None
+
+
+def ensure_local_worker(handler: Callable[[Dict[str, Any], bool], Awaitable[Any]]) -> None:
+    '''
+    Start the in-process consumer for the memory/sqlite queues (no-op for azure)
+    '''
+    global _worker
+    queue = update_queue()
+    if queue is None or isinstance(queue, AzureStorageUpdateQueue):
+        return
+    if _worker is None:
+        _worker = UpdateWorker(queue, handler)
+    _worker.start()